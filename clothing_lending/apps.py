@@ -6,4 +6,5 @@ class ClothingLendingConfig(AppConfig):
     name = 'clothing_lending'
 
     def ready(self):
-        import clothing_lending.signals
\ No newline at end of file
+        import clothing_lending.signals
+        import clothing_lending.tasks
\ No newline at end of file
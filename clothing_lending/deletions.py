@@ -0,0 +1,116 @@
+"""
+Deferred, batched deletes of stored images (see storage.py).
+
+Nothing deletes stored objects during a request. schedule_s3_deletion()
+records the keys in PendingDeletion and queues one flush_s3_deletions job,
+which removes up to 1,000 keys per delete_many() call (one DeleteObjects
+request on S3). Deleting an Item or Patron (directly or through a cascade)
+schedules its images from a post_delete signal.
+
+sweep_s3_orphans() catches whatever still leaks. It lists storage page by
+page and schedules objects that no Item, Patron or unfinished image job
+refers to.
+"""
+
+from datetime import timedelta
+
+from django.db.models import F
+from django.utils import timezone
+
+from .images import variant_keys
+from .jobs import enqueue
+from .models import Item, Job, Patron, PendingDeletion
+from .s3_utils import DELETE_BATCH_SIZE
+from .storage import get_storage
+
+SWEEP_PREFIXES = ('items/', 'profile_pics/')
+
+
+def schedule_s3_deletion(keys):
+    """
+    Queue stored objects for deletion. Keys already queued are skipped.
+    """
+    keys = [key for key in keys if key]
+    if not keys:
+        return
+    PendingDeletion.objects.bulk_create([PendingDeletion(key=key) for key in keys], ignore_conflicts=True)
+    # One queued flush picks up every pending key, so don't pile up more
+    if not Job.objects.filter(kind='flush_s3_deletions', status='PENDING').exists():
+        enqueue('flush_s3_deletions')
+
+
+def _keys_in_use(keys):
+    return set(Item.objects.filter(s3_image_key__in=keys).values_list('s3_image_key', flat=True)) | set(
+        Patron.objects.filter(s3_profile_picture_key__in=keys).values_list('s3_profile_picture_key', flat=True)
+    )
+
+
+def flush_pending_deletions(batch_size=DELETE_BATCH_SIZE):
+    """
+    Delete every pending key, one delete_many() call per batch. Each row is
+    tried once per flush. Failed rows stay queued with the error.
+    Keys an Item or Patron points at again are dropped without deleting them.
+
+    Two flushes running at once may send the same keys; S3 deletes are
+    idempotent, so that only costs a request.
+
+    :return: (deleted, failed) counts
+    """
+    deleted = failed = 0
+    last_id = 0
+    while True:
+        batch = list(
+            PendingDeletion.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', 'key')[:batch_size]
+        )
+        if not batch:
+            break
+        last_id = batch[-1][0]
+
+        in_use = _keys_in_use([key for pk, key in batch])
+        errors = get_storage().delete_many([key for pk, key in batch if key not in in_use])
+        PendingDeletion.objects.filter(pk__in=[pk for pk, key in batch if key not in errors]).delete()
+        for key, error in errors.items():
+            PendingDeletion.objects.filter(key=key).update(attempts=F('attempts') + 1, last_error=error)
+        deleted += len(batch) - len(in_use) - len(errors)
+        failed += len(errors)
+    return deleted, failed
+
+
+def _referenced_keys():
+    referenced = set()
+    for key, variants in Item.objects.exclude(s3_image_key='').values_list('s3_image_key', 'image_variants').iterator():
+        referenced.add(key)
+        referenced.update(variant_keys(variants))
+    referenced.update(
+        Patron.objects.filter(s3_profile_picture_key__gt='').values_list('s3_profile_picture_key', flat=True).iterator()
+    )
+    # Direct uploads that are still waiting to be attached to their item
+    for payload in Job.objects.filter(kind='process_item_image').exclude(status='DONE').values_list('payload', flat=True):
+        referenced.add(payload.get('key'))
+    return referenced
+
+
+def sweep_s3_orphans(prefixes=SWEEP_PREFIXES, min_age=timedelta(days=1), dry_run=False):
+    """
+    Schedule the deletion of objects under `prefixes` that nothing refers to.
+
+    Objects younger than `min_age` are left alone, since an upload in
+    progress isn't referenced yet. The referenced keys are loaded once, then
+    storage is listed a page (1,000 keys) at a time.
+
+    :param dry_run: Only count the orphans
+    :return: (scanned, orphaned) counts
+    """
+    referenced = _referenced_keys()
+    cutoff = timezone.now() - min_age
+    storage = get_storage()
+
+    scanned = orphaned = 0
+    for prefix in prefixes:
+        for page in storage.list(prefix):
+            scanned += len(page)
+            orphans = [key for key, modified in page if key not in referenced and modified < cutoff]
+            orphaned += len(orphans)
+            if orphans and not dry_run:
+                schedule_s3_deletion(orphans)
+    return scanned, orphaned
@@ -0,0 +1,216 @@
+"""
+Seeded synthetic data for local load testing.
+
+generate_fake_data() fills the database with librarians, patrons, items,
+categories, public and private collections, lendings in every state and
+ratings, using bulk_create throughout. bulk_create skips model signals, so
+the derived tables those signals normally maintain (item privacy, patron
+visibility, the search index and rating aggregates) are rebuilt at the end.
+"""
+
+import random
+import uuid
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import User, Librarian, Patron, Item, Category, Collection, Lending, Rating
+from .ratings import rebuild_rating_aggregates
+from .search import index_items
+from .visibility import recompute_item_privacy, refresh_item_access
+
+COLORS = ['black', 'white', 'navy', 'olive', 'rust', 'cream', 'burgundy', 'grey', 'camel', 'teal', 'mustard', 'blush']
+MATERIALS = ['denim', 'linen', 'wool', 'silk', 'leather', 'cotton', 'cashmere', 'suede', 'velvet', 'corduroy', 'tweed', 'satin']
+GARMENTS = [
+    'jacket', 'shirt', 'sweater', 'dress', 'boots', 'hoodie', 'blazer', 'skirt', 'scarf', 'coat',
+    'trousers', 'cardigan', 'vest', 'jumpsuit', 'loafers', 'beanie', 'parka', 'blouse', 'shorts', 'tote',
+]
+FILLER = [
+    'worn', 'once', 'great', 'condition', 'fits', 'true', 'to', 'size', 'perfect', 'for', 'fall', 'weddings',
+    'interviews', 'weekend', 'layering', 'slightly', 'oversized', 'cropped', 'relaxed', 'tailored', 'vintage',
+    'classic', 'minimal', 'statement', 'piece', 'pockets', 'buttons', 'zip', 'lined', 'breathable', 'warm',
+]
+WORDS = COLORS + MATERIALS + GARMENTS + FILLER
+CATEGORIES = ['Tops', 'Bottoms', 'Outerwear', 'Dresses', 'Shoes', 'Accessories', 'Formal', 'Vintage']
+
+BATCH_SIZE = 2000
+
+
+def default_counts(items):
+    """
+    Sizes of everything else for a catalog of `items`, roughly in the
+    proportions of a busy lending library.
+    """
+    return {
+        'librarians': max(2, items // 2000),
+        'patrons': max(10, items // 10),
+        'items': items,
+        'collections': max(4, items // 100),
+        'lendings': items // 2,
+        'ratings': items,
+    }
+
+
+def _sample_pairs(rng, left, right, count):
+    # Distinct (left, right) pairs without materializing the full product
+    count = min(count, len(left) * len(right))
+    pairs = set()
+    while len(pairs) < count:
+        pairs.add((rng.randrange(len(left)), rng.randrange(len(right))))
+    return [(left[i], right[j]) for i, j in sorted(pairs)]
+
+
+def generate_fake_data(librarians, patrons, items, collections, lendings, ratings,
+                       private_ratio=0.3, seed=0, prefix='fake'):
+    """
+    Add a synthetic lending library to the database.
+
+    :param librarians: Number of librarian accounts
+    :param patrons: Number of patron accounts
+    :param items: Number of items
+    :param collections: Number of collections, `private_ratio` of them private
+    :param lendings: Number of lending records across all states
+    :param ratings: Number of ratings (at most one per patron and item)
+    :param seed: Random seed; the same seed produces the same library
+    :param prefix: Username prefix, used by delete_fake_data() to find them again
+    :return: Dict of how many rows of each kind were created
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    # Usernames must be unique across runs; everything else follows from the seed
+    run = uuid.uuid4().hex[:8]
+
+    users = User.objects.bulk_create(
+        [User(username=f'{prefix}-{run}-librarian-{i}', email=f'{prefix}-{run}-librarian-{i}@example.com',
+              password='!', user_type=1) for i in range(librarians)] +
+        [User(username=f'{prefix}-{run}-patron-{i}', email=f'{prefix}-{run}-patron-{i}@example.com',
+              password='!', user_type=2) for i in range(patrons)],
+        batch_size=BATCH_SIZE,
+    )
+    librarian_rows = Librarian.objects.bulk_create(
+        [Librarian(user=user) for user in users[:librarians]], batch_size=BATCH_SIZE
+    )
+    patron_rows = Patron.objects.bulk_create(
+        [Patron(user=user, custom_username=f'patron{i}') for i, user in enumerate(users[librarians:])],
+        batch_size=BATCH_SIZE,
+    )
+
+    category_rows = [Category.objects.get_or_create(name=name)[0] for name in CATEGORIES]
+    sizes = [code for code, label in Item.SIZE_CHOICES]
+    conditions = [code for code, label in Item.CONDITION_CHOICES]
+    item_categories = [rng.sample(category_rows, rng.randint(1, 3)) for _ in range(items)]
+    item_rows = Item.objects.bulk_create(
+        [
+            Item(
+                name=f"{rng.choice(COLORS)} {rng.choice(MATERIALS)} {rng.choice(GARMENTS)}".title(),
+                description=' '.join(rng.choices(WORDS, k=12)),
+                category=categories[0].name,
+                size=rng.choice(sizes),
+                condition=rng.choice(conditions),
+                created_by=rng.choice(librarian_rows),
+            )
+            for categories in item_categories
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    ItemCategory = Item.categories.through
+    ItemCategory.objects.bulk_create(
+        [
+            ItemCategory(item_id=item.id, category_id=category.id)
+            for item, categories in zip(item_rows, item_categories)
+            for category in categories
+        ],
+        batch_size=BATCH_SIZE,
+    )
+
+    collection_rows = Collection.objects.bulk_create(
+        [
+            Collection(
+                name=f"{rng.choice(COLORS)} {rng.choice(GARMENTS)} edit {i}".title(),
+                description=' '.join(rng.choices(WORDS, k=8)),
+                created_by=rng.choice(librarian_rows).user,
+                is_private=rng.random() < private_ratio,
+            )
+            for i in range(collections)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    # About a third of the catalog sits in exactly one collection
+    CollectionItem = Item.collections.through
+    collected = rng.sample(item_rows, len(item_rows) // 3) if collection_rows else []
+    CollectionItem.objects.bulk_create(
+        [CollectionItem(item_id=item.id, collection_id=rng.choice(collection_rows).id) for item in collected],
+        batch_size=BATCH_SIZE,
+    )
+    CollectionPatron = Collection.allowed_patrons.through
+    CollectionPatron.objects.bulk_create(
+        [
+            CollectionPatron(collection_id=collection.id, patron_id=patron.id)
+            for collection in collection_rows if collection.is_private
+            for patron in rng.sample(patron_rows, min(len(patron_rows), rng.randint(1, 20)))
+        ],
+        batch_size=BATCH_SIZE,
+    )
+
+    # Every item has at most one open (pending or approved) lending; the rest is history
+    open_items = rng.sample(item_rows, min(len(item_rows), lendings // 4))
+    open_ids = {item.id for item in open_items}
+    lending_rows = []
+    for i in range(lendings):
+        requested = now - timedelta(days=rng.randint(0, 365), minutes=rng.randint(0, 1440))
+        if i < len(open_items):
+            item = open_items[i]
+            status = rng.choice(['PENDING', 'APPROVED', 'APPROVED'])
+        else:
+            item = rng.choice(item_rows)
+            status = rng.choice(['RETURNED', 'RETURNED', 'REJECTED'])
+        lending = Lending(item=item, borrower=rng.choice(patron_rows), request_date=requested, status=status)
+        if status in ('APPROVED', 'RETURNED'):
+            lending.approved_date = requested + timedelta(days=1)
+            lending.due_date = lending.approved_date + timedelta(days=14)
+            lending.return_requested = status == 'APPROVED' and rng.random() < 0.2
+        if status == 'RETURNED':
+            lending.return_date = lending.approved_date + timedelta(days=rng.randint(1, 14))
+        if status == 'REJECTED':
+            lending.rejected_date = requested + timedelta(days=1)
+        lending_rows.append(lending)
+    Lending.objects.bulk_create(lending_rows, batch_size=BATCH_SIZE)
+    Item.objects.filter(pk__in=list(open_ids)).update(available=False)
+
+    rating_rows = Rating.objects.bulk_create(
+        [
+            Rating(item=item, rater=patron, num_rating=rng.choices(range(1, 6), weights=[1, 1, 3, 5, 5])[0],
+                   comment=' '.join(rng.choices(FILLER, k=8)),
+                   rate_date=now - timedelta(days=rng.randint(0, 365), minutes=rng.randint(0, 1440)))
+            for item, patron in _sample_pairs(rng, item_rows, patron_rows, ratings)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+
+    item_ids = [item.id for item in item_rows]
+    recompute_item_privacy(item_ids)
+    refresh_item_access(item_ids)
+    index_items(item_ids)
+    rebuild_rating_aggregates(item_ids)
+
+    return {
+        'librarians': len(librarian_rows),
+        'patrons': len(patron_rows),
+        'items': len(item_rows),
+        'collections': len(collection_rows),
+        'lendings': len(lending_rows),
+        'ratings': len(rating_rows),
+    }
+
+
+def delete_fake_data(prefix='fake'):
+    """
+    Remove every account created by generate_fake_data() with `prefix`, and
+    (through cascades) their items, collections, lendings and ratings.
+
+    :return: Number of accounts removed
+    """
+    users = User.objects.filter(username__startswith=f'{prefix}-')
+    count = users.count()
+    users.delete()
+    return count
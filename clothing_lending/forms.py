@@ -1,7 +1,56 @@
 from django import forms
+from django.core import signing
 from .models import Collection, Item, Patron, Rating
+from .images import MAX_IMAGE_SIZE
+from .storage import get_storage
 from django.db.models import Q
 
+
+UPLOAD_KEY_SALT = 'clothing_lending.direct_upload'
+# Long enough for someone to finish filling in the form after the upload
+UPLOAD_KEY_MAX_AGE = 24 * 60 * 60
+
+
+def sign_upload_key(key):
+    """
+    The token presign_upload hands out for `key`, which the form exchanges
+    back for the key.
+    """
+    return signing.dumps(key, salt=UPLOAD_KEY_SALT)
+
+
+class DirectUploadMixin:
+    """
+    Accepts an image the browser has already uploaded to storage with a
+    presigned POST (see the presign_upload view). The form then receives only
+    the signed token for the object's key in `uploaded_key`, so only keys
+    presign_upload issued are accepted. Storage is asked (a HEAD request on
+    S3) whether the object exists and is an image within the size limit
+    before the key is accepted.
+    """
+
+    def upload_key_prefix(self):
+        raise NotImplementedError
+
+    def clean_uploaded_key(self):
+        token = self.cleaned_data.get('uploaded_key')
+        if not token:
+            return ''
+        try:
+            key = signing.loads(token, salt=UPLOAD_KEY_SALT, max_age=UPLOAD_KEY_MAX_AGE)
+        except signing.BadSignature:
+            raise forms.ValidationError("Invalid upload. Please choose the image again.")
+        if not key.startswith(self.upload_key_prefix()) or '..' in key:
+            raise forms.ValidationError("Invalid upload. Please choose the image again.")
+        info = get_storage().info(key)
+        if info is None:
+            raise forms.ValidationError("The uploaded image could not be found. Please upload it again.")
+        if not info['content_type'].startswith('image/'):
+            raise forms.ValidationError("File is not an image")
+        if info['size'] > MAX_IMAGE_SIZE:
+            raise forms.ValidationError("Image file too large (> 10MB)")
+        return key
+
 class CollectionForm(forms.ModelForm):
     class Meta:
         model = Collection
@@ -14,8 +63,9 @@ class CollectionForm(forms.ModelForm):
         }
 
 
-class ItemForm(forms.ModelForm):
+class ItemForm(DirectUploadMixin, forms.ModelForm):
     image = forms.ImageField(required=False, widget=forms.FileInput(attrs={'class': 'form-control'}))
+    uploaded_key = forms.CharField(required=False, widget=forms.HiddenInput())
     new_category = forms.CharField(required=False, label='New Category')
     
     class Meta:
@@ -48,11 +98,20 @@ class ItemForm(forms.ModelForm):
                 raise forms.ValidationError("File is not an image")
                 
             # Check file size (10MB limit)
-            if image.size > 10 * 1024 * 1024:
+            if image.size > MAX_IMAGE_SIZE:
                 raise forms.ValidationError("Image file too large (> 10MB)")
                 
         return image
 
+    def upload_key_prefix(self):
+        return 'items/'
+
+    def clean_uploaded_key(self):
+        key = super().clean_uploaded_key()
+        if key and Item.objects.filter(s3_image_key=key).exclude(pk=self.instance.pk).exists():
+            raise forms.ValidationError("Invalid upload. Please choose the image again.")
+        return key
+
 class PromoteUserForm(forms.Form):
     email = forms.EmailField(widget=forms.EmailInput(attrs={'class': 'form-control', 'placeholder': 'Enter user email'}))
 
@@ -111,8 +170,9 @@ class AddItemToCollectionFromCollectionForm(forms.Form):
         widget=forms.SelectMultiple(attrs={'class': 'form-control'})
     )
 
-class PatronProfileForm(forms.ModelForm):
+class PatronProfileForm(DirectUploadMixin, forms.ModelForm):
     profile_picture = forms.ImageField(required=False, widget=forms.FileInput(attrs={'class': 'form-control'}))
+    uploaded_key = forms.CharField(required=False, widget=forms.HiddenInput())
     
     class Meta:
         model = Patron
@@ -130,10 +190,13 @@ class PatronProfileForm(forms.ModelForm):
                 return image # return the URL
             if not image.content_type.startswith('image/'):
                 raise forms.ValidationError("File is not an image")
-            if image.size > 10 * 1024 * 1024:  # 10MB limit
+            if image.size > MAX_IMAGE_SIZE:  # 10MB limit
                 raise forms.ValidationError("Image file too large (> 10MB)")
             return image
 
+    def upload_key_prefix(self):
+        return f"profile_pics/{self.instance.user_id}/"
+
 # and now I need to add a rating form argghhh
 class RateItemForm(forms.ModelForm):
     num_rating = forms.IntegerField(
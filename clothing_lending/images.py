@@ -0,0 +1,139 @@
+"""
+Resized copies of item images.
+
+When an item image is uploaded, Pillow renders it at a few widths in WebP and
+JPEG and the copies are stored next to the original under derived keys
+(items/<uuid>.png -> items/<uuid>_w600.webp). Item.image_variants records
+them as {"webp": {"200": key, ...}, "jpeg": {...}} so pages can offer the
+browser a srcset and let it fetch the smallest copy that fits, rather than
+the full upload.
+"""
+
+import io
+import os
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+from .storage import get_storage
+
+# Largest image accepted, whether uploaded through Django or straight from the browser
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+
+VARIANT_WIDTHS = getattr(settings, 'ITEM_IMAGE_WIDTHS', (200, 600, 1200))
+
+# Pillow format name, file extension, content type and encoder options
+VARIANT_FORMATS = {
+    'webp': ('WEBP', 'webp', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def variant_key(original_key, width, fmt):
+    """
+    Storage key for the `width`px `fmt` copy of `original_key`.
+    """
+    base = os.path.splitext(original_key)[0]
+    return f"{base}_w{width}.{VARIANT_FORMATS[fmt][1]}"
+
+
+def render_variants(file_obj, widths=VARIANT_WIDTHS):
+    """
+    Resize an uploaded image to each of `widths` in every variant format.
+    Images are never scaled up: widths larger than the original collapse into
+    one copy at the original width.
+
+    :param file_obj: Readable file with the original image
+    :return: List of (width, format, bytes) tuples
+    :raises PIL.UnidentifiedImageError: if the file isn't an image Pillow can read
+    """
+    file_obj.seek(0)
+    with Image.open(file_obj) as original:
+        # Phone photos are often stored sideways with an EXIF rotation flag
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+            # JPEG has no alpha channel, so flatten transparent areas onto white
+            image = image.convert('RGBA')
+            flattened = Image.new('RGB', image.size, 'white')
+            flattened.paste(image, mask=image.getchannel('A'))
+            image = flattened
+        else:
+            image = image.convert('RGB')
+    file_obj.seek(0)
+
+    targets = sorted({min(width, image.width) for width in widths})
+    variants = []
+    for width in targets:
+        height = max(1, round(image.height * width / image.width))
+        resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+        for fmt, (pil_format, ext, content_type, options) in VARIANT_FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, pil_format, **options)
+            variants.append((width, fmt, buffer.getvalue()))
+    return variants
+
+
+def upload_image_variants(original_key, file_obj):
+    """
+    Render and store the resized copies of an image that was just stored at
+    `original_key`.
+
+    :return: The mapping to store on Item.image_variants
+    """
+    storage = get_storage()
+    variants = {}
+    for width, fmt, data in render_variants(file_obj):
+        key = variant_key(original_key, width, fmt)
+        storage.save(
+            key,
+            io.BytesIO(data),
+            content_type=VARIANT_FORMATS[fmt][2],
+            # Every upload gets a new key, so a copy never changes once written
+            cache_control='public, max-age=31536000, immutable',
+        )
+        variants.setdefault(fmt, {})[str(width)] = key
+    print(f"Uploaded {sum(len(keys) for keys in variants.values())} image variants for {original_key}")
+    return variants
+
+
+def variant_keys(variants):
+    """
+    Every storage key in an Item.image_variants mapping.
+    """
+    return [key for keys in (variants or {}).values() for key in keys.values()]
+
+
+def fallback_key(variants, width=600):
+    """
+    Key of the JPEG copy for browsers without srcset support: the smallest
+    one at least `width` wide, or the largest there is. None without copies.
+    """
+    keys = (variants or {}).get('jpeg')
+    if not keys:
+        return None
+    widths = sorted(int(w) for w in keys)
+    chosen = next((w for w in widths if w >= width), widths[-1])
+    return keys[str(chosen)]
+
+
+def signed_srcsets(variants, expiration=3600):
+    """
+    Sign every copy's URL and build srcset strings.
+
+    :param variants: An Item.image_variants mapping
+    :return: {"webp": "<url> 200w, <url> 600w", "jpeg": ...}, leaving out
+             formats whose URLs couldn't be signed
+    """
+    storage = get_storage()
+    srcsets = {}
+    for fmt, keys in (variants or {}).items():
+        entries = []
+        for width, key in sorted(keys.items(), key=lambda entry: int(entry[0])):
+            url = storage.signed_url(key, expiration=expiration)
+            if url is None:
+                break
+            entries.append(f"{url} {width}w")
+        else:
+            if entries:
+                srcsets[fmt] = ', '.join(entries)
+    return srcsets
@@ -0,0 +1,287 @@
+"""
+Background jobs for slow work that shouldn't hold up a request (S3 uploads,
+deletes and image resizing).
+
+Views call enqueue(), which records a Job row and returns straight away.
+Where the job runs depends on JOB_RUNNER:
+
+- 'thread' (default): a small thread pool in the web process picks it up
+  once the request's transaction commits. A sweeper thread, started from
+  wsgi.py, also hands the pool every due job every JOB_SWEEP_INTERVAL
+  seconds, so jobs queued or retrying when a process stopped are picked up
+  by the next one.
+- 'worker': nothing runs in the web process; `manage.py run_jobs` polls the
+  table.
+- 'sync': the job runs inside enqueue() (used by the tests).
+
+Because every job is a row, jobs survive restarts: the sweeper or
+`manage.py run_jobs` picks up whatever a stopped process left behind. A job
+that raises is retried with exponential backoff. After max_attempts it is
+marked DEAD (the dead-letter list) and its on_dead hook runs.
+`run_jobs --retry-dead` puts DEAD jobs back in the queue.
+"""
+
+import os
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.move import file_move_safe
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+_handlers = {}
+
+
+def job(kind, on_dead=None):
+    """
+    Register a function as the handler for jobs of `kind`. The job's payload
+    is passed as keyword arguments, so it must be JSON-serializable.
+
+    :param on_dead: Called with the same payload once the job has run out of attempts
+    """
+    def register(fn):
+        _handlers[kind] = (fn, on_dead)
+        return fn
+    return register
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    # Like the S3 client, a pool inherited across fork() has no threads behind it
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=_setting('JOB_WORKERS', 4), thread_name_prefix='clothing-lending-job'
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _submit(job_id, delay=0):
+    if delay > 0:
+        timer = threading.Timer(delay, _submit, args=[job_id])
+        timer.daemon = True
+        timer.start()
+        return
+    _get_executor().submit(_run_in_thread, job_id)
+
+
+def _run_in_thread(job_id):
+    # Pool threads get their own database connection; don't leave it open
+    close_old_connections()
+    try:
+        run_job(job_id)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        close_old_connections()
+
+
+def enqueue(kind, max_attempts=None, **payload):
+    """
+    Queue a job and return its Job row.
+
+    :param kind: A name registered with @job
+    :param max_attempts: Attempts before the job is marked DEAD (default JOB_MAX_ATTEMPTS)
+    :param payload: Keyword arguments for the handler
+    """
+    if kind not in _handlers:
+        raise ValueError(f"No job handler registered for {kind!r}")
+    queued = Job.objects.create(
+        kind=kind, payload=payload, max_attempts=max_attempts or _setting('JOB_MAX_ATTEMPTS', 5)
+    )
+    runner = _setting('JOB_RUNNER', 'thread')
+    if runner == 'sync':
+        run_job(queued.pk)
+    elif runner == 'thread':
+        # The pool's own connection can't see the row until the request commits
+        transaction.on_commit(lambda: _submit(queued.pk))
+    return queued
+
+
+def retry_delay(attempts):
+    """
+    How long to wait before the next try after `attempts` failed ones.
+    """
+    base = _setting('JOB_RETRY_BASE_DELAY', 10)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), 3600))
+
+
+def _claim(job_id):
+    # The conditional UPDATE makes sure only one thread or worker runs a job
+    now = timezone.now()
+    claimed = Job.objects.filter(pk=job_id, status='PENDING', run_after__lte=now).update(
+        status='RUNNING', locked_at=now, attempts=F('attempts') + 1
+    )
+    return Job.objects.get(pk=job_id) if claimed else None
+
+
+def run_job(job_id):
+    """
+    Run one job if it is due and nobody else has claimed it.
+
+    :return: 'done', 'retry' or 'dead', or None if the job wasn't run
+    """
+    claimed = _claim(job_id)
+    if claimed is None:
+        return None
+
+    handler, on_dead = _handlers.get(claimed.kind, (None, None))
+    try:
+        if handler is None:
+            raise LookupError(f"No job handler registered for {claimed.kind!r}")
+        handler(**claimed.payload)
+    except Exception as e:
+        error = traceback.format_exc()
+        print(f"Job {claimed.kind} #{claimed.pk} failed (attempt {claimed.attempts}/{claimed.max_attempts}): {e}")
+        if claimed.attempts >= claimed.max_attempts:
+            Job.objects.filter(pk=claimed.pk).update(
+                status='DEAD', last_error=error, locked_at=None, finished_at=timezone.now()
+            )
+            if on_dead is not None:
+                try:
+                    on_dead(**claimed.payload)
+                except Exception:
+                    traceback.print_exc()
+            return 'dead'
+
+        delay = retry_delay(claimed.attempts)
+        Job.objects.filter(pk=claimed.pk).update(
+            status='PENDING', last_error=error, locked_at=None, run_after=timezone.now() + delay
+        )
+        if _setting('JOB_RUNNER', 'thread') == 'thread':
+            _submit(claimed.pk, delay.total_seconds())
+        return 'retry'
+
+    Job.objects.filter(pk=claimed.pk).update(status='DONE', locked_at=None, finished_at=timezone.now())
+    return 'done'
+
+
+def run_due_jobs(limit=100):
+    """
+    Run up to `limit` jobs that are due, oldest first. Returns how many ran.
+    """
+    due = Job.objects.filter(status='PENDING', run_after__lte=timezone.now()).order_by('run_after', 'id')
+    ran = 0
+    for job_id in due.values_list('id', flat=True)[:limit]:
+        if run_job(job_id) is not None:
+            ran += 1
+    return ran
+
+
+def release_stale_jobs():
+    """
+    Put back RUNNING jobs whose process died before finishing them (locked
+    longer than JOB_LOCK_TIMEOUT seconds). The interrupted try still counts.
+    """
+    cutoff = timezone.now() - timedelta(seconds=_setting('JOB_LOCK_TIMEOUT', 600))
+    return Job.objects.filter(status='RUNNING', locked_at__lt=cutoff).update(
+        status='PENDING', locked_at=None, run_after=timezone.now()
+    )
+
+
+def sweep_jobs(limit=100):
+    """
+    Release abandoned jobs and hand up to `limit` due ones to the thread
+    pool. A job that is already on its way (a pending on_commit, a retry
+    timer) may be submitted twice; only one run claims it.
+
+    :return: How many jobs were submitted
+    """
+    release_stale_jobs()
+    due = Job.objects.filter(status='PENDING', run_after__lte=timezone.now()).order_by('run_after', 'id')
+    job_ids = list(due.values_list('id', flat=True)[:limit])
+    for job_id in job_ids:
+        _submit(job_id)
+    return len(job_ids)
+
+
+def _sweep_forever():
+    while True:
+        close_old_connections()
+        try:
+            sweep_jobs()
+        except Exception:
+            traceback.print_exc()
+        finally:
+            close_old_connections()
+        time.sleep(_setting('JOB_SWEEP_INTERVAL', 30))
+
+
+_sweeper_pid = None
+
+
+def start_job_sweeper():
+    """
+    Start the sweeper thread for the 'thread' runner, once per process.
+    Does nothing for the other runners.
+    """
+    global _sweeper_pid
+    if _setting('JOB_RUNNER', 'thread') != 'thread':
+        return
+    with _executor_lock:
+        if _sweeper_pid == os.getpid():
+            return
+        _sweeper_pid = os.getpid()
+    threading.Thread(target=_sweep_forever, name='clothing-lending-job-sweeper', daemon=True).start()
+
+
+def retry_dead_jobs(job_ids=None):
+    """
+    Move DEAD jobs (all of them, or `job_ids`) back to the queue with fresh attempts.
+    """
+    dead = Job.objects.filter(status='DEAD')
+    if job_ids is not None:
+        dead = dead.filter(pk__in=job_ids)
+    return dead.update(status='PENDING', attempts=0, run_after=timezone.now(), finished_at=None)
+
+
+def stash_upload(file_obj):
+    """
+    Copy an uploaded file somewhere a job can read it after the request ends.
+
+    The 'worker' runner needs JOB_UPLOAD_DIR on storage the worker shares
+    with the web processes.
+
+    :return: Payload fields (path, name, content_type) describing the copy
+    """
+    directory = _setting('JOB_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'clothing_lending_uploads'))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{uuid.uuid4()}{os.path.splitext(file_obj.name)[1]}")
+    if hasattr(file_obj, 'temporary_file_path'):
+        # Already spooled to disk by Django; a rename on the same filesystem
+        file_move_safe(file_obj.temporary_file_path(), path)
+    else:
+        with open(path, 'wb') as f:
+            for chunk in file_obj.chunks():
+                f.write(chunk)
+    return {
+        'path': path,
+        'name': file_obj.name,
+        'content_type': getattr(file_obj, 'content_type', None) or 'application/octet-stream',
+    }
+
+
+def discard_upload(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
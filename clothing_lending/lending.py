@@ -0,0 +1,120 @@
+"""
+Borrowing items, and every later change to a Lending.
+
+Item.available is the lock. A borrow flips it with one conditional UPDATE
+(available=True -> False) and inserts the PENDING lending in the same short
+transaction, so of any number of patrons borrowing at once exactly one
+matches the row and the rest are turned away without waiting on a lock. The
+one_active_lending_per_item constraint backs this up: should available ever
+be True while a lending is active, the insert fails and the claim is rolled
+back.
+
+After that a lending only moves along TRANSITIONS, through transition().
+Each move is an UPDATE conditional on the status it starts from, the item
+release that goes with it and a LendingEvent row, all in one transaction, so
+two librarians clicking at once (or a stale page) can't apply a move twice or
+out of order. LendingEvent is append-only; events_after() reads it
+incrementally.
+"""
+
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import Item, Lending, LendingEvent
+
+LOAN_PERIOD = timedelta(days=14)
+
+# action: (status it starts from, status it leads to, whether it makes the item available again)
+TRANSITIONS = {
+    'approve': ('PENDING', 'APPROVED', False),
+    'reject': ('PENDING', 'REJECTED', True),
+    'request_return': ('APPROVED', 'APPROVED', False),
+    'return': ('APPROVED', 'RETURNED', True),
+}
+
+
+class ItemUnavailable(Exception):
+    pass
+
+
+class InvalidTransition(Exception):
+    pass
+
+
+def borrow_item(item_id, patron):
+    """
+    Create a PENDING lending of the item for `patron` and mark the item unavailable.
+
+    :raises ItemUnavailable: if the item is already lent or requested
+    :return: The new Lending
+    """
+    try:
+        with transaction.atomic():
+            claimed = Item.objects.filter(pk=item_id, available=True).update(available=False)
+            if not claimed:
+                raise ItemUnavailable(item_id)
+            lending = Lending.objects.create(item_id=item_id, borrower=patron, status='PENDING',
+                                             request_date=timezone.now())
+            LendingEvent.objects.create(lending=lending, action='request', to_status='PENDING',
+                                        actor_id=patron.user_id, created_at=lending.request_date)
+            return lending
+    except IntegrityError:
+        raise ItemUnavailable(item_id)
+
+
+def _changes(action, now):
+    """
+    The fields an action sets besides status, and any extra condition the row must meet.
+    """
+    if action == 'approve':
+        return {'approved_date': now, 'due_date': now + LOAN_PERIOD}, {}
+    if action == 'reject':
+        return {'rejected_date': now}, {}
+    if action == 'request_return':
+        # Asking twice changes nothing
+        return {'return_requested': True}, {'return_requested': False}
+    return {'return_date': now}, {}
+
+
+def transition(lending, action, actor=None):
+    """
+    Apply `action` to the lending, if its current status in the database allows it.
+    `lending` is updated to match.
+
+    :param actor: The User making the change, recorded on the event
+    :raises InvalidTransition: if the action is unknown or not allowed from the lending's status
+    :return: The LendingEvent recorded
+    """
+    if action not in TRANSITIONS:
+        raise InvalidTransition(f"Unknown action {action!r}")
+    from_status, to_status, releases_item = TRANSITIONS[action]
+    now = timezone.now()
+    changes, conditions = _changes(action, now)
+
+    with transaction.atomic():
+        updated = Lending.objects.filter(pk=lending.pk, status=from_status, **conditions).update(
+            status=to_status, **changes
+        )
+        if not updated:
+            raise InvalidTransition(f"Can't {action} a lending that isn't {from_status.lower()}")
+        if releases_item:
+            Item.objects.filter(pk=lending.item_id).update(available=True)
+        event = LendingEvent.objects.create(lending_id=lending.pk, action=action, from_status=from_status,
+                                            to_status=to_status, actor=actor, created_at=now)
+
+    lending.status = to_status
+    for field, value in changes.items():
+        setattr(lending, field, value)
+    return event
+
+
+def events_after(last_id=0, limit=1000):
+    """
+    Events recorded after the one with id `last_id`, oldest first. Pass the
+    last id seen to read the next page. Ids are assigned before commit, so a
+    transaction still in flight can land just behind a reader's last id;
+    readers that must see every event should stay a few seconds behind.
+    """
+    return list(LendingEvent.objects.filter(pk__gt=last_id).order_by('pk')[:limit])
@@ -0,0 +1,39 @@
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from clothing_lending.s3_utils import create_s3_client, get_s3_client, reset_s3_client
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the per-call cost of building a new S3 client (the old behaviour) "
+        "with reusing the shared one. Signs a URL each call; no network access needed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200)
+
+    def handle(self, *args, **options):
+        calls = options['calls']
+
+        def sign(client):
+            client.generate_presigned_url('get_object', Params={'Bucket': 'benchmark', 'Key': 'key'}, ExpiresIn=3600)
+
+        reset_s3_client()
+        per_call = self._time(lambda: sign(create_s3_client()), calls)
+        pooled = self._time(lambda: sign(get_s3_client()), calls)
+
+        for label, (p50, p95) in (('new client per call', per_call), ('shared client', pooled)):
+            self.stdout.write(f"{label:>20}: p50={p50:8.3f}ms  p95={p95:8.3f}ms")
+        self.stdout.write(f"Speedup at p50: {per_call[0] / pooled[0]:.0f}x")
+
+    def _time(self, fn, calls):
+        samples = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        return statistics.median(samples), samples[min(calls - 1, int(calls * 0.95))]
@@ -0,0 +1,88 @@
+import random
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from clothing_lending.fake_data import COLORS, MATERIALS, GARMENTS, WORDS, CATEGORIES
+from clothing_lending.models import User, Librarian, Item, Category
+from clothing_lending.search import index_items, search_items
+
+
+class Command(BaseCommand):
+    help = (
+        "Time browse search queries against the full-text index and the old icontains scan. "
+        "Synthetic items are created inside a transaction that is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=100000, help="Number of synthetic items to add")
+        parser.add_argument('--repeat', type=int, default=20, help="Timed runs per query")
+        parser.add_argument('--page-size', type=int, default=24)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--query', action='append', dest='queries',
+                            help="Query to time (repeatable). Defaults to a few single and multi-word queries.")
+
+    def handle(self, *args, **options):
+        queries = options['queries'] or ['jacket', 'vintage denim', 'cashmere scarf', 'boots']
+        rng = random.Random(options['seed'])
+
+        with transaction.atomic():
+            self._populate(options['items'], rng)
+            self.stdout.write(f"Catalog size: {Item.objects.count()} items")
+            for query in queries:
+                legacy = self._time(lambda: list(self._legacy(query)[:options['page_size']]), options['repeat'])
+                indexed = self._time(
+                    lambda: list(search_items(Item.objects.all(), query)
+                                 .order_by('-search_rank', '-created_at', '-id')[:options['page_size']]),
+                    options['repeat'],
+                )
+                self.stdout.write(
+                    f"{query!r:>20}  icontains p50={legacy[0]:8.2f}ms p95={legacy[1]:8.2f}ms  "
+                    f"index p50={indexed[0]:8.2f}ms p95={indexed[1]:8.2f}ms"
+                )
+            transaction.set_rollback(True)
+
+    def _legacy(self, query):
+        return Item.objects.filter(
+            Q(name__icontains=query) | Q(categories__name__icontains=query)
+        ).distinct().order_by('-created_at', '-id')
+
+    def _time(self, fn, repeat):
+        fn()  # warm up
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def _populate(self, count, rng):
+        user = User.objects.create(username=f'benchmark-{uuid.uuid4()}', user_type=1)
+        librarian, created = Librarian.objects.get_or_create(user=user)
+        categories = [Category.objects.get_or_create(name=name)[0] for name in CATEGORIES]
+        sizes = [code for code, label in Item.SIZE_CHOICES]
+        conditions = [code for code, label in Item.CONDITION_CHOICES]
+
+        items = [
+            Item(
+                name=f"{rng.choice(COLORS)} {rng.choice(MATERIALS)} {rng.choice(GARMENTS)}".title(),
+                description=' '.join(rng.choices(WORDS, k=12)),
+                size=rng.choice(sizes),
+                condition=rng.choice(conditions),
+                created_by=librarian,
+            )
+            for _ in range(count)
+        ]
+        Item.objects.bulk_create(items, batch_size=2000)
+        Through = Item.categories.through
+        Through.objects.bulk_create(
+            [Through(item_id=item.id, category_id=rng.choice(categories).id) for item in items],
+            batch_size=2000,
+        )
+        # bulk_create skips the signals that keep the index in sync
+        index_items([item.id for item in items])
@@ -0,0 +1,167 @@
+import io
+import os
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from django.conf import settings
+from django.core.files.uploadhandler import load_handler
+from django.core.management.base import BaseCommand
+from django.http.multipartparser import MultiPartParser
+from django.test import override_settings
+from django.test.client import BOUNDARY, encode_multipart
+
+from clothing_lending.s3_utils import get_s3_health, reset_s3_client, upload_file_to_s3, upload_memory_bound
+
+MB = 1024 * 1024
+
+# What uploads ran with before: files up to 10MB held in memory, boto3's default transfer settings
+BASELINE_SETTINGS = {
+    'FILE_UPLOAD_MAX_MEMORY_SIZE': 10 * MB,
+    'AWS_S3_MULTIPART_THRESHOLD': 8 * MB,
+    'AWS_S3_MULTIPART_CHUNKSIZE': 8 * MB,
+    'AWS_S3_MAX_CONCURRENCY': 10,
+}
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    """
+    Just enough of the S3 API for upload_fileobj: HEAD bucket, PutObject and
+    the multipart calls. Bodies are read and thrown away.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status=200, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _drain(self):
+        remaining = int(self.headers.get('Content-Length', 0))
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            self.server.bytes_received += len(chunk)
+            remaining -= len(chunk)
+
+    def do_HEAD(self):
+        self._reply()
+
+    def do_PUT(self):
+        self._drain()
+        self._reply(headers={'ETag': f'"{uuid.uuid4().hex}"'})
+
+    def do_POST(self):
+        self._drain()
+        query = parse_qs(urlparse(self.path).query, keep_blank_values=True)
+        if 'uploads' in query:
+            body = (f'<InitiateMultipartUploadResult><UploadId>{uuid.uuid4().hex}</UploadId>'
+                    f'</InitiateMultipartUploadResult>')
+        else:
+            body = f'<CompleteMultipartUploadResult><ETag>"{uuid.uuid4().hex}"</ETag></CompleteMultipartUploadResult>'
+        self._reply(body=body.encode(), headers={'Content-Type': 'application/xml'})
+
+    def do_DELETE(self):
+        self._reply(204)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure upload throughput and peak memory of the upload path (multipart parsing plus "
+        "upload_file_to_s3), with the current settings and with the old in-memory/default-transfer "
+        "settings. Runs against a local S3 stand-in unless --endpoint-url is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='0.1,2,8,40', help="Comma-separated file sizes in MB")
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--endpoint-url', default=None,
+                            help="S3-compatible endpoint to upload to, e.g. MinIO (default: built-in stand-in)")
+
+    def handle(self, *args, **options):
+        sizes = [float(size) for size in options['sizes'].split(',')]
+        server = None
+        endpoint_url = options['endpoint_url']
+        if endpoint_url is None:
+            server = ThreadingHTTPServer(('127.0.0.1', 0), _StandInHandler)
+            server.bytes_received = 0
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            endpoint_url = f'http://127.0.0.1:{server.server_port}'
+            credentials = {'AWS_ACCESS_KEY_ID': 'benchmark', 'AWS_SECRET_ACCESS_KEY': 'benchmark'}
+        else:
+            credentials = {}
+
+        try:
+            with override_settings(AWS_S3_ENDPOINT_URL=endpoint_url, **credentials):
+                reset_s3_client()
+                if not get_s3_health(force=True)['success']:
+                    self.stderr.write(f"Can't reach the bucket at {endpoint_url}")
+                    return
+                self.stdout.write(f"Uploading to {endpoint_url}")
+                self.stdout.write(f"{'size':>8} {'settings':>9} {'p50 ms':>9} {'MB/s':>8} {'peak MB':>8} {'bound MB':>9}")
+                for size in sizes:
+                    with tempfile.TemporaryDirectory() as directory:
+                        body_path = self._write_request_body(directory, int(size * MB))
+                        for label, overrides in (('before', BASELINE_SETTINGS), ('current', {})):
+                            with override_settings(**overrides):
+                                timings, peaks = self._measure(body_path, options['repeat'])
+                                bound = upload_memory_bound(int(size * MB))
+                            p50 = statistics.median(timings)
+                            self.stdout.write(
+                                f"{size:>7g}M {label:>9} {p50 * 1000:>9.1f} {size / p50:>8.1f} "
+                                f"{max(peaks) / MB:>8.2f} {bound / MB:>9.2f}"
+                            )
+        finally:
+            reset_s3_client()
+            if server is not None:
+                self.stdout.write(f"Stand-in received {server.bytes_received / MB:.1f}MB")
+                server.shutdown()
+                server.server_close()
+
+    def _write_request_body(self, directory, size):
+        # Build the multipart request body on disk so it isn't counted against the upload
+        path = os.path.join(directory, 'body')
+        upload = io.BytesIO(os.urandom(size))
+        upload.name = 'benchmark.jpg'
+        with open(path, 'wb') as f:
+            f.write(encode_multipart(BOUNDARY, {'image': upload}))
+        return path
+
+    def _measure(self, body_path, repeat):
+        meta = {
+            'CONTENT_TYPE': f'multipart/form-data; boundary={BOUNDARY}',
+            'CONTENT_LENGTH': str(os.path.getsize(body_path)),
+        }
+        timings, peaks = [], []
+        for _ in range(repeat):
+            tracemalloc.start()
+            try:
+                start = time.perf_counter()
+                with open(body_path, 'rb') as body:
+                    # The same parsing and upload handlers a real request goes through
+                    parser = MultiPartParser(meta, body, self._upload_handlers(), 'utf-8')
+                    post, files = parser.parse()
+                    upload = files['image']
+                    if upload_file_to_s3(upload, object_name=f'benchmark/{uuid.uuid4()}.jpg') is None:
+                        raise RuntimeError("Upload failed")
+                    upload.close()
+                timings.append(time.perf_counter() - start)
+                peaks.append(tracemalloc.get_traced_memory()[1])
+            finally:
+                tracemalloc.stop()
+        return timings, peaks
+
+    def _upload_handlers(self):
+        return [load_handler(path) for path in settings.FILE_UPLOAD_HANDLERS]
@@ -0,0 +1,37 @@
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from clothing_lending.images import upload_image_variants
+from clothing_lending.models import Item
+from clothing_lending.storage import get_storage
+
+
+class Command(BaseCommand):
+    help = "Create the resized WebP/JPEG copies for item images uploaded before they existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help="Rebuild copies for items that already have them")
+
+    def handle(self, *args, **options):
+        items = Item.objects.exclude(s3_image_key='')
+        if not options['force']:
+            items = items.filter(image_variants={})
+
+        storage = get_storage()
+        built = failed = 0
+        for item_id, key in items.values_list('id', 's3_image_key').iterator():
+            try:
+                with tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE) as original:
+                    storage.download(key, original)
+                    variants = upload_image_variants(key, original)
+            except Exception as e:
+                self.stderr.write(f"{item_id}: {e}")
+                failed += 1
+                continue
+            Item.objects.filter(pk=item_id).update(image_variants=variants)
+            built += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Built image variants for {built} items ({failed} failed)."))
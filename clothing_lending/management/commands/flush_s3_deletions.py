@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from clothing_lending.deletions import flush_pending_deletions
+from clothing_lending.models import PendingDeletion
+
+
+class Command(BaseCommand):
+    help = "Delete the S3 objects queued in PendingDeletion now, up to 1,000 per DeleteObjects call."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--list-failed', action='store_true', help="List queued keys that failed to delete and exit")
+
+    def handle(self, *args, **options):
+        if options['list_failed']:
+            for pending in PendingDeletion.objects.filter(attempts__gt=0).order_by('pk'):
+                self.stdout.write(f"{pending.key} ({pending.attempts} attempts): {pending.last_error}")
+            return
+
+        deleted, failed = flush_pending_deletions()
+        self.stdout.write(f"Deleted {deleted} objects ({failed} failed).")
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from clothing_lending.fake_data import default_counts, generate_fake_data, delete_fake_data
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill the database with a seeded synthetic library: librarians, patrons, items, categories, "
+        "public and private collections, lendings in every state and ratings. "
+        "Counts default to proportions of --items."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=1000)
+        parser.add_argument('--librarians', type=int)
+        parser.add_argument('--patrons', type=int)
+        parser.add_argument('--collections', type=int)
+        parser.add_argument('--lendings', type=int)
+        parser.add_argument('--ratings', type=int)
+        parser.add_argument('--private-ratio', type=float, default=0.3,
+                            help="Share of collections that are private")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='fake', help="Username prefix for generated accounts")
+        parser.add_argument('--flush', action='store_true',
+                            help="Delete data from earlier runs with the same prefix first")
+
+    def handle(self, *args, **options):
+        counts = default_counts(options['items'])
+        for name in counts:
+            if options.get(name) is not None:
+                counts[name] = options[name]
+
+        with transaction.atomic():
+            if options['flush']:
+                removed = delete_fake_data(options['prefix'])
+                self.stdout.write(f"Removed {removed} accounts from earlier runs.")
+            created = generate_fake_data(
+                private_ratio=options['private_ratio'], seed=options['seed'], prefix=options['prefix'], **counts
+            )
+
+        summary = ', '.join(f"{count} {name}" for name, count in created.items())
+        self.stdout.write(self.style.SUCCESS(f"Created {summary}."))
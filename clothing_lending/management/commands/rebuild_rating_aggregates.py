@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from clothing_lending.ratings import rebuild_rating_aggregates
+
+
+class Command(BaseCommand):
+    help = "Recompute every item's rating count, sum and star histogram from the ratings table."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            updated = rebuild_rating_aggregates()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt rating aggregates for {updated} items."))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from clothing_lending.models import Item
+from clothing_lending.search import create_search_index, index_items
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text search index for every item (e.g. after bulk_create)."
+
+    def handle(self, *args, **options):
+        with connection.schema_editor() as schema_editor:
+            create_search_index(schema_editor)
+        with transaction.atomic():
+            index_items()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {Item.objects.count()} items."))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from clothing_lending.models import PatronItemAccess
+from clothing_lending.visibility import refresh_item_access
+
+
+class Command(BaseCommand):
+    help = "Rebuild the materialized patron/item visibility table from collection memberships."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            refresh_item_access()
+        self.stdout.write(self.style.SUCCESS(f"{PatronItemAccess.objects.count()} visibility rows."))
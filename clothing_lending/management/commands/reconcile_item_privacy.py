@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from clothing_lending.visibility import reconcile_item_privacy
+
+
+class Command(BaseCommand):
+    help = "Fix Item.private_collection flags that disagree with the items' collections."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report how many items are out of sync.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            made_private, made_public = reconcile_item_privacy(dry_run=options['dry_run'])
+        verb = "would be" if options['dry_run'] else "were"
+        self.stdout.write(self.style.SUCCESS(
+            f"{made_private} items {verb} marked private, {made_public} items {verb} marked public."
+        ))
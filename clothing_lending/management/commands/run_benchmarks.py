@@ -0,0 +1,191 @@
+import json
+import logging
+import random
+import re
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from clothing_lending.fake_data import default_counts, generate_fake_data
+from clothing_lending.models import Collection, Item, Lending, Patron
+
+QUERY_COUNT = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return statistics.median(samples), samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Time the main pages and the borrow/approve/return cycle against synthetic libraries of "
+        "increasing size. Each library is generated inside a transaction that is rolled back "
+        "afterwards. Results (p50/p95 latency and query counts) can be saved as JSON and "
+        "compared with an earlier run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', default='1000,10000,100000',
+                            help="Comma-separated item counts to benchmark")
+        parser.add_argument('--repeat', type=int, default=20, help="Timed requests per page")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Write results to this JSON file")
+        parser.add_argument('--compare', help="JSON results from an earlier run to compare against")
+
+    def handle(self, *args, **options):
+        try:
+            scales = [int(scale) for scale in options['scales'].split(',')]
+        except ValueError:
+            raise CommandError("--scales must be a comma-separated list of item counts")
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        # One log line per request would drown the output; budget warnings still show
+        request_logger = logging.getLogger('clothing_lending.requests')
+        level = request_logger.level
+        request_logger.setLevel(logging.WARNING)
+        try:
+            results = {}
+            for scale in scales:
+                results[str(scale)] = self._run_scale(scale, options['repeat'], options['seed'])
+        finally:
+            request_logger.setLevel(level)
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'seed': options['seed'],
+            'repeat': options['repeat'],
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Wrote results to {options['output']}")
+        if baseline is not None:
+            self._compare(baseline, report)
+
+    def _run_scale(self, scale, repeat, seed):
+        with transaction.atomic():
+            start = time.perf_counter()
+            generate_fake_data(seed=seed, prefix='benchmark', **default_counts(scale))
+            self.stdout.write(f"\n{scale} items (generated in {time.perf_counter() - start:.1f}s)")
+
+            targets = self._pick_targets(seed)
+            results = {}
+            for name, user, url in [
+                ('browse', targets['patron'].user, reverse('browse')),
+                ('item_detail', targets['patron'].user, reverse('item_detail', args=[targets['item'].id])),
+                ('collection_detail', targets['patron'].user,
+                 reverse('collection_detail', args=[targets['collection'].id])),
+                ('librarian_page', targets['librarian'], reverse('librarian_page')),
+                ('patron_page', targets['patron'].user, reverse('patron_page')),
+            ]:
+                results[name] = self._time_page(user, url, repeat)
+                self._report(name, results[name])
+
+            results['borrow_cycle'] = self._time_borrow_cycle(targets, repeat)
+            self._report('borrow_cycle', results['borrow_cycle'])
+            transaction.set_rollback(True)
+        return results
+
+    def _pick_targets(self, seed):
+        rng = random.Random(seed)
+        # The busiest patron and a well-reviewed public item make the pages do the most work
+        patron = (Patron.objects.filter(user__username__startswith='benchmark-')
+                  .annotate(lending_count=Count('lending')).order_by('-lending_count', 'id')
+                  .select_related('user').first())
+        item = rng.choice(list(
+            Item.objects.filter(available=True, private_collection=False, created_by__user__username__startswith='benchmark-')
+            .order_by('-rating_count', 'id').select_related('created_by__user')[:20]
+        ))
+        collection = (Collection.objects.filter(is_private=False, created_by__username__startswith='benchmark-')
+                      .order_by('id').first())
+        if patron is None or collection is None:
+            raise CommandError("Scale is too small to produce a patron, item and public collection")
+        return {'patron': patron, 'item': item, 'collection': collection, 'librarian': item.created_by.user}
+
+    def _client(self, user):
+        client = Client(HTTP_HOST='localhost')
+        client.force_login(user)
+        return client
+
+    def _request(self, client, method, url, data=None):
+        start = time.perf_counter()
+        response = getattr(client, method)(url, data)
+        elapsed = (time.perf_counter() - start) * 1000
+        if response.status_code >= 400:
+            raise CommandError(f"{method.upper()} {url} returned {response.status_code}")
+        match = QUERY_COUNT.search(response.get('Server-Timing', ''))
+        return elapsed, int(match.group(1)) if match else None
+
+    def _summary(self, samples, queries):
+        p50, p95 = percentiles(samples)
+        return {'p50_ms': round(p50, 2), 'p95_ms': round(p95, 2), 'queries': queries}
+
+    def _time_page(self, user, url, repeat):
+        client = self._client(user)
+        self._request(client, 'get', url)  # warm up
+        samples, queries = [], None
+        for _ in range(repeat):
+            elapsed, queries = self._request(client, 'get', url)
+            samples.append(elapsed)
+        return self._summary(samples, queries)
+
+    def _time_borrow_cycle(self, targets, repeat):
+        # The same item goes round the whole cycle each time, ending up available again
+        patron = self._client(targets['patron'].user)
+        librarian = self._client(targets['librarian'])
+        item = targets['item']
+        samples, queries = [], None
+        for _ in range(repeat):
+            total_ms, total_queries = 0.0, 0
+            elapsed, count = self._request(patron, 'post', reverse('request_borrow', args=[item.id]))
+            total_ms, total_queries = total_ms + elapsed, total_queries + (count or 0)
+            lending = Lending.objects.filter(item=item, status='PENDING').latest('id')
+            for client, name, data in [
+                (librarian, 'manage_lending_request', {'action': 'approve'}),
+                (patron, 'request_return', None),
+                (librarian, 'manage_lending_request', {'action': 'return'}),
+            ]:
+                elapsed, count = self._request(client, 'post', reverse(name, args=[lending.id]), data)
+                total_ms, total_queries = total_ms + elapsed, total_queries + (count or 0)
+            lending.refresh_from_db()
+            if lending.status != 'RETURNED':
+                raise CommandError(f"Borrow cycle ended in {lending.status}, not RETURNED")
+            samples.append(total_ms)
+            queries = total_queries
+        return self._summary(samples, queries)
+
+    def _report(self, name, result):
+        self.stdout.write(
+            f"  {name:>18}  p50={result['p50_ms']:8.2f}ms  p95={result['p95_ms']:8.2f}ms  "
+            f"queries={result['queries']}"
+        )
+
+    def _compare(self, baseline, report):
+        self.stdout.write(f"\nCompared with the run from {baseline.get('created_at', 'unknown')}:")
+        for scale, pages in report['results'].items():
+            before_pages = baseline.get('results', {}).get(scale)
+            if before_pages is None:
+                continue
+            self.stdout.write(f"{scale} items")
+            for name, after in pages.items():
+                before = before_pages.get(name)
+                if before is None:
+                    continue
+                change = (after['p50_ms'] - before['p50_ms']) / before['p50_ms'] * 100 if before['p50_ms'] else 0
+                self.stdout.write(
+                    f"  {name:>18}  p50 {before['p50_ms']:8.2f} -> {after['p50_ms']:8.2f}ms ({change:+.0f}%)  "
+                    f"p95 {before['p95_ms']:8.2f} -> {after['p95_ms']:8.2f}ms  "
+                    f"queries {before['queries']} -> {after['queries']}"
+                )
@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from clothing_lending.jobs import run_due_jobs, release_stale_jobs, retry_dead_jobs
+from clothing_lending.models import Job
+
+
+class Command(BaseCommand):
+    help = (
+        "Run queued background jobs (S3 uploads, deletes, image resizing). Loops until stopped, "
+        "or runs what is due once with --once. Also picks up jobs a restarted web process left behind."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run the jobs that are due, then exit")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds to sleep when the queue is empty")
+        parser.add_argument('--list-dead', action='store_true', help="List jobs that ran out of attempts and exit")
+        parser.add_argument('--retry-dead', action='store_true', help="Queue every dead job again with fresh attempts")
+
+    def handle(self, *args, **options):
+        if options['list_dead']:
+            for dead in Job.objects.filter(status='DEAD').order_by('finished_at'):
+                last_line = dead.last_error.strip().splitlines()[-1] if dead.last_error.strip() else ''
+                self.stdout.write(f"#{dead.pk} {dead.kind} ({dead.attempts} attempts, {dead.finished_at}): {last_line}")
+            return
+
+        if options['retry_dead']:
+            self.stdout.write(f"Requeued {retry_dead_jobs()} dead jobs.")
+
+        while True:
+            released = release_stale_jobs()
+            if released:
+                self.stdout.write(f"Released {released} abandoned jobs.")
+            ran = run_due_jobs()
+            if ran:
+                self.stdout.write(f"Ran {ran} jobs.")
+            if options['once']:
+                break
+            if not ran:
+                time.sleep(options['poll_interval'])
@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from clothing_lending.deletions import SWEEP_PREFIXES, sweep_s3_orphans
+
+
+class Command(BaseCommand):
+    help = (
+        "Queue for deletion the S3 objects under items/ and profile_pics/ that no item, patron "
+        "or pending image job refers to. The flush_s3_deletions job then deletes them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--prefix', action='append', dest='prefixes',
+                            help=f"Bucket prefix to sweep (repeatable, default {', '.join(SWEEP_PREFIXES)})")
+        parser.add_argument('--min-age-hours', type=float, default=24,
+                            help="Leave objects younger than this alone, so uploads in progress survive")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the orphans")
+
+    def handle(self, *args, **options):
+        scanned, orphaned = sweep_s3_orphans(
+            prefixes=options['prefixes'] or SWEEP_PREFIXES,
+            min_age=timedelta(hours=options['min_age_hours']),
+            dry_run=options['dry_run'],
+        )
+        action = "found" if options['dry_run'] else "queued for deletion"
+        self.stdout.write(f"Scanned {scanned} objects, {action} {orphaned} orphans.")
@@ -0,0 +1,154 @@
+"""
+Per-request cost accounting: SQL queries, S3 calls and template rendering.
+
+RequestBudgetMiddleware (middleware.py) opens a RequestMetrics for each
+request. While it is open, every database query, every S3 API call made
+through a client from s3_utils, and every top-level template render adds its
+count and time to it.
+"""
+
+import time
+from contextvars import ContextVar
+
+from django.template.backends.django import DjangoTemplates
+
+_current_metrics = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    """
+    Counters for one request. Times are in seconds.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        self.queries = 0
+        self.db_time = 0.0
+        self.s3_calls = 0
+        self.s3_time = 0.0
+        self.template_time = 0.0
+
+    @property
+    def total_time(self):
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return end - self.started
+
+    def as_dict(self):
+        return {
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 2),
+            's3_calls': self.s3_calls,
+            's3_ms': round(self.s3_time * 1000, 2),
+            'template_ms': round(self.template_time * 1000, 2),
+            'total_ms': round(self.total_time * 1000, 2),
+        }
+
+    def server_timing(self):
+        """
+        Value for the Server-Timing response header.
+        """
+        return ', '.join([
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries"',
+            f's3;dur={self.s3_time * 1000:.2f};desc="{self.s3_calls} calls"',
+            f'tpl;dur={self.template_time * 1000:.2f}',
+            f'total;dur={self.total_time * 1000:.2f}',
+        ])
+
+
+def start_request_metrics():
+    """
+    Start collecting for the current request. Returns the metrics and a token
+    for finish_request_metrics().
+    """
+    metrics = RequestMetrics()
+    return metrics, _current_metrics.set(metrics)
+
+
+def finish_request_metrics(token):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.finished = time.perf_counter()
+    _current_metrics.reset(token)
+    return metrics
+
+
+def current_metrics():
+    return _current_metrics.get()
+
+
+def count_query(execute, sql, params, many, context):
+    """
+    connection.execute_wrapper() hook that times every query.
+    """
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.db_time += time.perf_counter() - start
+
+
+def _s3_call_started(context, **kwargs):
+    if _current_metrics.get() is not None:
+        context['metrics_started'] = time.perf_counter()
+
+
+def _s3_call_finished(context, **kwargs):
+    metrics = _current_metrics.get()
+    started = context.pop('metrics_started', None)
+    if metrics is not None and started is not None:
+        metrics.s3_calls += 1
+        metrics.s3_time += time.perf_counter() - started
+
+
+def instrument_s3_client(client):
+    """
+    Count and time every API call made with `client`. Presigning makes no
+    network call and isn't counted.
+    """
+    events = client.meta.events
+    # before-parameter-build always fires, unlike before-call, whose handlers
+    # stop running once one of them supplies a response (as botocore's Stubber does)
+    events.register('before-parameter-build.s3', _s3_call_started)
+    events.register('after-call.s3', _s3_call_finished)
+    events.register('after-call-error.s3', _s3_call_finished)
+    return client
+
+
+class TimedTemplate:
+    """
+    Wraps a backend template so render() time is added to the request's metrics.
+    """
+
+    def __init__(self, template):
+        self._template = template
+
+    def __getattr__(self, name):
+        return getattr(self._template, name)
+
+    def render(self, context=None, request=None):
+        metrics = _current_metrics.get()
+        if metrics is None:
+            return self._template.render(context, request)
+        start = time.perf_counter()
+        try:
+            return self._template.render(context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    The Django template backend with render timing. Templates pulled in with
+    {% include %} or {% extends %} are counted as part of their parent.
+    """
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
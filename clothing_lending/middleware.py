@@ -0,0 +1,64 @@
+import json
+import logging
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from .metrics import start_request_metrics, finish_request_metrics, count_query
+
+logger = logging.getLogger('clothing_lending.requests')
+
+
+class QueryBudgetExceeded(Exception):
+    """
+    Raised when a view runs more queries than its budget allows and
+    REQUEST_BUDGET_ACTION is 'raise' (the default under `manage.py test`).
+    """
+
+
+class RequestBudgetMiddleware:
+    """
+    Records what each request cost (SQL queries and time, S3 calls and time,
+    template rendering and total latency). The numbers are sent back in a
+    Server-Timing header and logged as one JSON line per request.
+
+    REQUEST_QUERY_BUDGETS maps URL names to the most queries that view may
+    run. A view over its budget is logged as a warning, or raises
+    QueryBudgetExceeded when REQUEST_BUDGET_ACTION is 'raise'.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics, token = start_request_metrics()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(count_query))
+                response = self.get_response(request)
+        finally:
+            finish_request_metrics(token)
+
+        view_name = request.resolver_match.url_name if request.resolver_match else None
+        response['Server-Timing'] = metrics.server_timing()
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'view': view_name,
+            'status': response.status_code,
+            **metrics.as_dict(),
+        }))
+
+        self.check_budget(view_name, metrics)
+        return response
+
+    def check_budget(self, view_name, metrics):
+        budget = getattr(settings, 'REQUEST_QUERY_BUDGETS', {}).get(view_name)
+        if budget is None or metrics.queries <= budget:
+            return
+        message = f"{view_name} ran {metrics.queries} queries, over its budget of {budget}"
+        if getattr(settings, 'REQUEST_BUDGET_ACTION', 'warn') == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
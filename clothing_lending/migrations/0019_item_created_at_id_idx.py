@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clothing_lending', '0018_lending_rejected_date'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='item',
+            index=models.Index(fields=['created_at', 'id'], name='item_created_at_id_idx'),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Full-text search index for browse queries. The tsvector column (Postgres) and
+# FTS5 table (SQLite) live outside the model, see clothing_lending/search.py.
+# The SQL is copied here as it stood when this migration was written, so later
+# changes to search.py don't change what it does.
+
+from django.db import migrations
+
+CATEGORY_NAMES = (
+    "(SELECT {aggregate} FROM clothing_lending_item_categories ic "
+    "JOIN clothing_lending_category c ON c.id = ic.category_id "
+    "WHERE ic.item_id = i.id)"
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        category_names = CATEGORY_NAMES.format(aggregate="string_agg(c.name, ' ')")
+        schema_editor.execute("ALTER TABLE clothing_lending_item ADD COLUMN IF NOT EXISTS search_vector tsvector")
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS item_search_vector_gin ON clothing_lending_item USING GIN (search_vector)"
+        )
+        schema_editor.execute(
+            "UPDATE clothing_lending_item AS i SET search_vector = "
+            "setweight(to_tsvector('english', coalesce(i.name, '')), 'A') || "
+            f"setweight(to_tsvector('english', coalesce({category_names}, '')), 'B') || "
+            "setweight(to_tsvector('english', coalesce(i.description, '')), 'C')"
+        )
+    elif vendor == 'sqlite':
+        category_names = CATEGORY_NAMES.format(aggregate="group_concat(c.name, ' ')")
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS clothing_lending_item_fts USING fts5("
+            "name, description, categories, tokenize='porter unicode61')"
+        )
+        schema_editor.execute("DELETE FROM clothing_lending_item_fts")
+        schema_editor.execute(
+            "INSERT INTO clothing_lending_item_fts (rowid, name, description, categories) "
+            f"SELECT i.rowid, i.name, i.description, coalesce({category_names}, '') FROM clothing_lending_item i"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS item_search_vector_gin")
+        schema_editor.execute("ALTER TABLE clothing_lending_item DROP COLUMN IF EXISTS search_vector")
+    elif vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS clothing_lending_item_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clothing_lending', '0019_item_created_at_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
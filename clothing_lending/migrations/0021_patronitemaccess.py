@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_item_access(apps, schema_editor):
+    Item = apps.get_model('clothing_lending', 'Item')
+    PatronItemAccess = apps.get_model('clothing_lending', 'PatronItemAccess')
+    pairs = (
+        Item.collections.through.objects
+        .filter(collection__is_private=True, collection__allowed_patrons__isnull=False)
+        .values_list('item_id', 'collection__allowed_patrons')
+        .distinct()
+    )
+    PatronItemAccess.objects.bulk_create(
+        (PatronItemAccess(item_id=item_id, patron_id=patron_id) for item_id, patron_id in pairs.iterator()),
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clothing_lending', '0020_item_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatronItemAccess',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='patron_access', to='clothing_lending.item')),
+                ('patron', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='item_access', to='clothing_lending.patron')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('patron', 'item'), name='unique_patron_item_access')],
+            },
+        ),
+        migrations.RunPython(backfill_item_access, migrations.RunPython.noop),
+    ]
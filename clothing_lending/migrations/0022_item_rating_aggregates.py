@@ -0,0 +1,75 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:31
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def aggregate_expressions(Rating):
+    # Frozen copy of ratings.aggregate_expressions() for the historical Rating model
+    def per_item(aggregate, **filters):
+        rows = (
+            Rating.objects.filter(item=OuterRef('pk'), **filters)
+            .order_by().values('item').annotate(value=aggregate).values('value')
+        )
+        return Coalesce(Subquery(rows), 0)
+
+    expressions = {
+        'rating_count': per_item(Count('pk')),
+        'rating_sum': per_item(Sum('num_rating')),
+    }
+    for stars in range(1, 6):
+        expressions[f'rating_{stars}'] = per_item(Count('pk'), num_rating=stars)
+    return expressions
+
+
+def backfill_rating_aggregates(apps, schema_editor):
+    Item = apps.get_model('clothing_lending', 'Item')
+    Rating = apps.get_model('clothing_lending', 'Rating')
+    Item.objects.update(**aggregate_expressions(Rating))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clothing_lending', '0021_patronitemaccess'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='rating_1',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='rating_2',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='rating_3',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='rating_4',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='rating_5',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='rating_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='item',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_rating_aggregates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:32
+
+from django.db import migrations, models
+from django.db.models import Count, Exists, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def aggregate_expressions(Rating):
+    # Frozen copy of ratings.aggregate_expressions() for the historical Rating model
+    def per_item(aggregate, **filters):
+        rows = (
+            Rating.objects.filter(item=OuterRef('pk'), **filters)
+            .order_by().values('item').annotate(value=aggregate).values('value')
+        )
+        return Coalesce(Subquery(rows), 0)
+
+    expressions = {
+        'rating_count': per_item(Count('pk')),
+        'rating_sum': per_item(Sum('num_rating')),
+    }
+    for stars in range(1, 6):
+        expressions[f'rating_{stars}'] = per_item(Count('pk'), num_rating=stars)
+    return expressions
+
+
+def remove_duplicate_ratings(apps, schema_editor):
+    # Keep each patron's latest review of an item so the unique constraint can be added
+    Item = apps.get_model('clothing_lending', 'Item')
+    Rating = apps.get_model('clothing_lending', 'Rating')
+    newer = Rating.objects.filter(
+        Q(rate_date__gt=OuterRef('rate_date')) | Q(rate_date=OuterRef('rate_date'), id__gt=OuterRef('id')),
+        item=OuterRef('item'),
+        rater=OuterRef('rater'),
+    )
+    duplicates = Rating.objects.filter(Exists(newer))
+    item_ids = list(duplicates.values_list('item_id', flat=True).distinct())
+    if item_ids:
+        duplicates.delete()
+        Item.objects.filter(pk__in=item_ids).update(**aggregate_expressions(Rating))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clothing_lending', '0022_item_rating_aggregates'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_ratings, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='rating',
+            index=models.Index(fields=['item', 'rate_date', 'id'], name='rating_item_rate_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='rating',
+            constraint=models.UniqueConstraint(fields=('item', 'rater'), name='unique_item_rater'),
+        ),
+    ]
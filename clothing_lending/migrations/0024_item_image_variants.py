@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clothing_lending', '0023_rating_review_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
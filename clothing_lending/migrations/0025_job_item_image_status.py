@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:54
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+def mark_existing_images_ready(apps, schema_editor):
+    Item = apps.get_model('clothing_lending', 'Item')
+    Item.objects.exclude(s3_image_key='').update(image_status='READY')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clothing_lending', '0024_item_image_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='item',
+            name='image_status',
+            field=models.CharField(choices=[('NONE', 'No image'), ('PROCESSING', 'Processing'), ('READY', 'Ready'), ('FAILED', 'Failed')], default='NONE', max_length=10),
+        ),
+        migrations.RunPython(mark_existing_images_ready, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=50)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('DONE', 'Done'), ('DEAD', 'Dead')], default='PENDING', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('max_attempts', models.PositiveSmallIntegerField(default=5)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'run_after'], name='job_status_run_after_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:14
+
+from django.db import migrations, models
+from django.db.models import Count
+from django.utils import timezone
+
+
+def reject_duplicate_lendings(apps, schema_editor):
+    # Keep one active lending per item so the unique constraint can be added: the
+    # approved one if there is one ('APPROVED' sorts before 'PENDING'), else the oldest request
+    Lending = apps.get_model('clothing_lending', 'Lending')
+    active = Lending.objects.filter(status__in=['PENDING', 'APPROVED'])
+    item_ids = active.values('item').annotate(lendings=Count('pk')).filter(lendings__gt=1).values_list('item', flat=True)
+    for item_id in list(item_ids):
+        keep = active.filter(item_id=item_id).order_by('status', 'request_date', 'pk').first()
+        active.filter(item_id=item_id).exclude(pk=keep.pk).update(status='REJECTED', rejected_date=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clothing_lending', '0026_pendingdeletion'),
+    ]
+
+    operations = [
+        migrations.RunPython(reject_duplicate_lendings, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='lending',
+            constraint=models.UniqueConstraint(condition=models.Q(('status__in', ['PENDING', 'APPROVED'])), fields=('item',), name='one_active_lending_per_item'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:17
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_events(apps, schema_editor):
+    # Rebuild each existing lending's history from its timestamps
+    Lending = apps.get_model('clothing_lending', 'Lending')
+    LendingEvent = apps.get_model('clothing_lending', 'LendingEvent')
+    events = []
+    for lending in Lending.objects.order_by('request_date', 'pk').iterator():
+        history = [('request', '', 'PENDING', lending.request_date)]
+        if lending.rejected_date:
+            history.append(('reject', 'PENDING', 'REJECTED', lending.rejected_date))
+        if lending.approved_date:
+            history.append(('approve', 'PENDING', 'APPROVED', lending.approved_date))
+        if lending.return_date:
+            history.append(('return', 'APPROVED', 'RETURNED', lending.return_date))
+        events.extend(
+            LendingEvent(lending_id=lending.pk, action=action, from_status=from_status, to_status=to_status,
+                         created_at=created_at)
+            for action, from_status, to_status, created_at in history
+        )
+        if len(events) >= 1000:
+            LendingEvent.objects.bulk_create(events)
+            events = []
+    LendingEvent.objects.bulk_create(events)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clothing_lending', '0027_lending_one_active_per_item'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LendingEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('request', 'Requested'), ('approve', 'Approved'), ('reject', 'Rejected'), ('request_return', 'Return requested'), ('return', 'Returned')], max_length=20)),
+                ('from_status', models.CharField(blank=True, max_length=10)),
+                ('to_status', models.CharField(max_length=10)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('actor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('lending', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='events', to='clothing_lending.lending')),
+            ],
+        ),
+        migrations.RunPython(backfill_events, migrations.RunPython.noop),
+    ]
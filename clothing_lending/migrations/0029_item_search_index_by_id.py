@@ -0,0 +1,52 @@
+# The SQLite FTS5 table was keyed on the item table's rowid, which SQLite
+# renumbers whenever it rebuilds the table (Django's AddField in 0022 does, as
+# does VACUUM). Recreate it with the item id in an UNINDEXED column and
+# rebuild it. Postgres keeps its tsvector column on the item row and is left alone.
+# The SQL is copied here as it stood when this migration was written.
+
+from django.db import migrations
+
+SQLITE_INDEX_ITEMS = (
+    "INSERT INTO clothing_lending_item_fts (item_id, name, description, categories) "
+    "SELECT i.id, i.name, i.description, coalesce((SELECT group_concat(c.name, ' ') "
+    "FROM clothing_lending_item_categories ic JOIN clothing_lending_category c ON c.id = ic.category_id "
+    "WHERE ic.item_id = i.id), '') FROM clothing_lending_item i"
+)
+
+
+def key_search_index_by_id(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS clothing_lending_item_fts")
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE clothing_lending_item_fts USING fts5("
+        "item_id UNINDEXED, name, description, categories, tokenize='porter unicode61')"
+    )
+    schema_editor.execute(SQLITE_INDEX_ITEMS)
+
+
+def key_search_index_by_rowid(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE IF EXISTS clothing_lending_item_fts")
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE clothing_lending_item_fts USING fts5("
+        "name, description, categories, tokenize='porter unicode61')"
+    )
+    schema_editor.execute(
+        "INSERT INTO clothing_lending_item_fts (rowid, name, description, categories) "
+        "SELECT i.rowid, i.name, i.description, coalesce((SELECT group_concat(c.name, ' ') "
+        "FROM clothing_lending_item_categories ic JOIN clothing_lending_category c ON c.id = ic.category_id "
+        "WHERE ic.item_id = i.id), '') FROM clothing_lending_item i"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clothing_lending', '0028_lendingevent'),
+    ]
+
+    operations = [
+        migrations.RunPython(key_search_index_by_id, key_search_index_by_rowid),
+    ]
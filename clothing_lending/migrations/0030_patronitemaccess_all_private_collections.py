@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:02
+
+from django.db import migrations
+from django.db.models import Exists, OuterRef
+
+
+def drop_partial_item_access(apps, schema_editor):
+    # A patron now needs every private collection holding the item, not just one;
+    # drop the rows backfilled for patrons missing from any of them
+    Item = apps.get_model('clothing_lending', 'Item')
+    Collection = apps.get_model('clothing_lending', 'Collection')
+    PatronItemAccess = apps.get_model('clothing_lending', 'PatronItemAccess')
+    allowed = Collection.allowed_patrons.through.objects.filter(
+        collection_id=OuterRef('collection_id'), patron_id=OuterRef(OuterRef('patron_id'))
+    )
+    blocked = Item.collections.through.objects.filter(
+        item_id=OuterRef('item_id'), collection__is_private=True
+    ).exclude(Exists(allowed))
+    PatronItemAccess.objects.filter(Exists(blocked)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clothing_lending', '0029_item_search_index_by_id'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_partial_item_access, migrations.RunPython.noop),
+    ]
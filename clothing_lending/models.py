@@ -73,6 +73,13 @@ class Item(models.Model):
         ('XXXL', 'Triple Extra Large'),
         ('OS', 'One Size'),
     )
+
+    IMAGE_STATUS_CHOICES = [
+        ('NONE', 'No image'),
+        ('PROCESSING', 'Processing'),
+        ('READY', 'Ready'),
+        ('FAILED', 'Failed'),
+    ]
     
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=100)
@@ -83,6 +90,10 @@ class Item(models.Model):
     condition = models.CharField(max_length=20, choices=CONDITION_CHOICES)
     image_url = models.TextField(blank=True)
     s3_image_key = models.CharField(max_length=255, blank=True)
+    # Resized WebP/JPEG copies of the image, keyed by format then width (see images.py)
+    image_variants = models.JSONField(default=dict, blank=True)
+    # Uploads run as background jobs (see jobs.py); PROCESSING until the image is in S3
+    image_status = models.CharField(max_length=10, choices=IMAGE_STATUS_CHOICES, default='NONE')
     collections = models.ManyToManyField(Collection, related_name='items', blank=True)
     available = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
@@ -90,9 +101,60 @@ class Item(models.Model):
     created_by = models.ForeignKey(Librarian, on_delete=models.CASCADE, related_name='items')
     private_collection = models.BooleanField(default=False)
 
+    # Rating aggregates, maintained alongside Rating rows (see ratings.py)
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    rating_1 = models.PositiveIntegerField(default=0)
+    rating_2 = models.PositiveIntegerField(default=0)
+    rating_3 = models.PositiveIntegerField(default=0)
+    rating_4 = models.PositiveIntegerField(default=0)
+    rating_5 = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Backs keyset pagination of the browse page, newest first
+            models.Index(fields=['created_at', 'id'], name='item_created_at_id_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
+    @property
+    def average_rating(self):
+        if not self.rating_count:
+            return 0
+        return round(self.rating_sum / self.rating_count, 1)
+
+    @property
+    def rating_histogram(self):
+        """
+        Star counts from 5 down to 1, with each bucket's share of all ratings.
+        """
+        histogram = []
+        for stars in range(5, 0, -1):
+            count = getattr(self, f'rating_{stars}')
+            percent = round(100 * count / self.rating_count) if self.rating_count else 0
+            histogram.append({'stars': stars, 'count': count, 'percent': percent})
+        return histogram
+
+
+# Materialized visibility: one row per (patron, item) for every item in a private
+# collection the patron has been let into. Kept up to date by the signals in
+# signals.py (see visibility.py) so "can this patron see this item" is a single
+# lookup on the unique index instead of a join through collections and allowed_patrons.
+# The (patron, collection) half is the allowed_patrons through table itself.
+class PatronItemAccess(models.Model):
+    patron = models.ForeignKey(Patron, on_delete=models.CASCADE, related_name='item_access')
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='patron_access')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['patron', 'item'], name='unique_patron_item_access'),
+        ]
+
+    def __str__(self):
+        return f"{self.patron} can see {self.item_id}"
+
 
 class Lending(models.Model):
     STATUS_CHOICES = [
@@ -112,10 +174,47 @@ class Lending(models.Model):
     return_date = models.DateTimeField(null=True, blank=True)
     rejected_date = models.DateTimeField(null=True, blank=True)
 
+    # A lending in one of these holds its item
+    ACTIVE_STATUSES = ('PENDING', 'APPROVED')
+
+    class Meta:
+        constraints = [
+            # At most one pending or approved lending per item, whatever races the views lose
+            models.UniqueConstraint(
+                fields=['item'], condition=models.Q(status__in=['PENDING', 'APPROVED']),
+                name='one_active_lending_per_item',
+            ),
+        ]
+
     def __str__(self):
         return f"{self.borrower} - {self.item.name} ({self.get_status_display()})"
     
 
+class LendingEvent(models.Model):
+    """
+    One status change of a Lending, written by lending.py in the same
+    transaction as the change. Rows are only ever appended, so readers can
+    follow the table by id.
+    """
+    ACTION_CHOICES = [
+        ('request', 'Requested'),
+        ('approve', 'Approved'),
+        ('reject', 'Rejected'),
+        ('request_return', 'Return requested'),
+        ('return', 'Returned'),
+    ]
+
+    lending = models.ForeignKey(Lending, on_delete=models.CASCADE, related_name='events')
+    action = models.CharField(max_length=20, choices=ACTION_CHOICES)
+    from_status = models.CharField(max_length=10, blank=True)
+    to_status = models.CharField(max_length=10)
+    actor = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.lending_id}: {self.action} ({self.from_status or '-'} -> {self.to_status})"
+
+
 # Modifying the Lending class to create a collection Invite model to add users to a private collection
 class Invite(models.Model):
     STATUS_CHOICES = [
@@ -142,3 +241,59 @@ class Rating(models.Model):
     rate_date = models.DateTimeField(default=timezone.now)
     num_rating = models.IntegerField(default=1, validators=[MinValueValidator(1), MaxValueValidator(5)]) #https://stackoverflow.com/questions/42425933/how-do-i-set-a-default-max-and-min-value-for-an-integerfield-django
     comment = models.TextField(max_length=200)
+
+    class Meta:
+        indexes = [
+            # Backs keyset pagination of an item's reviews, newest first
+            models.Index(fields=['item', 'rate_date', 'id'], name='rating_item_rate_date_idx'),
+        ]
+        constraints = [
+            # One review per patron per item; also makes "has this patron reviewed" an index lookup
+            models.UniqueConstraint(fields=['item', 'rater'], name='unique_item_rater'),
+        ]
+
+
+# Background work (S3 uploads, deletes, image resizing) queued by views and run
+# by jobs.py, either in a thread pool inside the web process or by `manage.py run_jobs`.
+# Rows stay behind once finished; DEAD rows are jobs that ran out of attempts.
+class Job(models.Model):
+    STATUS_CHOICES = [
+        ('PENDING', 'Pending'),
+        ('RUNNING', 'Running'),
+        ('DONE', 'Done'),
+        ('DEAD', 'Dead'),
+    ]
+
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='PENDING')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Backs the worker's "next due job" lookup
+            models.Index(fields=['status', 'run_after'], name='job_status_run_after_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} #{self.pk} ({self.get_status_display()})"
+
+
+class PendingDeletion(models.Model):
+    """
+    An S3 object waiting to be deleted. Rows are removed in batches by the
+    flush_s3_deletions job (see deletions.py).
+    """
+    key = models.CharField(max_length=1024, unique=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.key
@@ -0,0 +1,205 @@
+import base64
+import binascii
+import json
+import uuid
+from datetime import datetime
+from decimal import Decimal
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    """
+    Raised when a cursor from the query string can't be decoded.
+    """
+
+
+def _encode_value(value):
+    # DjangoJSONEncoder truncates microseconds, which would break the
+    # equality half of the keyset comparison, so serialize by hand.
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (uuid.UUID, Decimal)):
+        return str(value)
+    return value
+
+
+def encode_cursor(values):
+    """
+    Turn the ordering values of the last row on a page into an opaque,
+    URL-safe cursor string.
+    """
+    payload = json.dumps([_encode_value(v) for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    """
+    Decode a cursor produced by encode_cursor.
+
+    :param cursor: Cursor string taken from the request
+    :param length: Number of ordering fields the cursor must contain
+    :return: List of ordering values
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidCursor(cursor)
+    return values
+
+
+def _keyset_filter(ordering, values):
+    """
+    Build the "strictly after this row" filter for a lexicographic ordering,
+    e.g. for ('-created_at', '-id'):
+        created_at < v0 OR (created_at = v0 AND id < v1)
+    """
+    condition = Q()
+    equal_prefix = {}
+    for field, value in zip(ordering, values):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        condition |= Q(**equal_prefix, **{f'{name}__{lookup}': value})
+        equal_prefix[name] = value
+    return condition
+
+
+def _ordering_field(queryset, name):
+    # A model field, or an annotation such as search_rank
+    try:
+        return queryset.model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return queryset.query.annotations[name].output_field
+
+
+def _cursor_values(queryset, ordering, cursor):
+    """
+    Decode a cursor and convert each value to its ordering field's type, so a
+    tampered cursor is rejected here rather than failing inside the query.
+    """
+    values = decode_cursor(cursor, len(ordering))
+    try:
+        values = [_ordering_field(queryset, field.lstrip('-')).to_python(value) for field, value in zip(ordering, values)]
+    except (ValidationError, TypeError, ValueError):
+        raise InvalidCursor(cursor)
+    # The orderings are all non-null, and a NULL can't be compared anyway
+    if any(value is None for value in values):
+        raise InvalidCursor(cursor)
+    return values
+
+
+class KeysetPage:
+    """
+    One page of a keyset-paginated queryset.
+    """
+
+    def __init__(self, object_list, next_cursor, cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.cursor = cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def is_first(self):
+        return not self.cursor
+
+
+def keyset_paginate(queryset, ordering, cursor=None, page_size=24):
+    """
+    Return one page of `queryset` ordered by `ordering`, starting after `cursor`.
+
+    The ordering must be unique (end it with the primary key) so that every
+    row has exactly one position. Only a bounded number of rows is read no
+    matter how deep the page is, unlike OFFSET pagination.
+
+    :param queryset: Queryset to paginate
+    :param ordering: Sequence of field names, e.g. ('-created_at', '-id')
+    :param cursor: Cursor string from a previous page, or None for the first page
+    :param page_size: Number of rows per page
+    :return: KeysetPage
+    """
+    ordering = tuple(ordering)
+    queryset = queryset.order_by(*ordering)
+    if cursor:
+        queryset = queryset.filter(_keyset_filter(ordering, _cursor_values(queryset, ordering, cursor)))
+
+    # Fetch one extra row to learn whether there is a next page
+    rows = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, field.lstrip('-')) for field in ordering])
+
+    return KeysetPage(rows, next_cursor, cursor)
+
+
+class OffsetPage:
+    """
+    One numbered page of a result set whose total size was counted separately,
+    for short lists where jumping between page numbers matters more than depth.
+    """
+
+    def __init__(self, object_list, number, page_size, count):
+        self.object_list = object_list
+        self.number = number
+        self.page_size = page_size
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+    @property
+    def num_pages(self):
+        return max(-(-self.count // self.page_size), 1)
+
+    @property
+    def has_next(self):
+        return self.number < self.num_pages
+
+    @property
+    def has_previous(self):
+        return self.number > 1
+
+    @property
+    def start_row(self):
+        # Row numbers are 1-based, matching SQL's ROW_NUMBER()
+        return (self.number - 1) * self.page_size + 1
+
+    @property
+    def end_row(self):
+        return self.number * self.page_size
+
+
+def get_page_number(value, count, page_size):
+    """
+    Parse a ?page= style value, clamping it to the pages that exist.
+    """
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        number = 1
+    last = max(-(-count // page_size), 1)
+    return min(max(number, 1), last)
@@ -0,0 +1,114 @@
+"""
+Who can see which items and collections.
+
+Librarians see everything. Everyone else sees public items and collections,
+and patrons additionally see private collections they have been let into and
+the items all of whose private collections they have been let into (see
+visibility.py for the tables behind that). Checks are
+made for whole batches at once, so a page costs the same number of permission
+queries whether it shows one object or a hundred.
+"""
+
+from django.db.models import Model, Q
+
+from .models import Collection, Item, Patron
+from .visibility import collection_visible_to_patron, item_visible_to_patron
+
+
+def is_librarian_user(user):
+    return user.is_authenticated and user.user_type == 1
+
+
+def get_patron(user):
+    """
+    The Patron row for `user`, or None for guests, librarians and patron
+    accounts whose Patron row is missing.
+    """
+    if not user.is_authenticated or user.user_type != 2:
+        return None
+    try:
+        return user.patron
+    except Patron.DoesNotExist:
+        return None
+
+
+def item_visibility(user):
+    """
+    Q matching the items `user` may see.
+    """
+    if is_librarian_user(user):
+        return Q()
+    patron = get_patron(user)
+    if patron is None:
+        return Q(private_collection=False)
+    return item_visible_to_patron(patron)
+
+
+def collection_visibility(user):
+    """
+    Q matching the collections `user` may see.
+    """
+    if is_librarian_user(user):
+        return Q()
+    patron = get_patron(user)
+    if patron is None:
+        return Q(is_private=False)
+    return collection_visible_to_patron(patron)
+
+
+def visible_items(user, items=None):
+    """
+    Restrict an Item queryset (all items by default) to those `user` may see.
+    """
+    if items is None:
+        items = Item.objects.all()
+    return items.filter(item_visibility(user))
+
+
+def visible_collections(user, collections=None):
+    """
+    Restrict a Collection queryset (all collections by default) to those `user` may see.
+    """
+    if collections is None:
+        collections = Collection.objects.all()
+    return collections.filter(collection_visibility(user))
+
+
+def _visible_pks(user, model, objs, is_private, visibility):
+    # Public objects need no query and guests never see private ones; only a
+    # patron's private objects are checked, all together
+    visible = {obj.pk for obj in objs if not is_private(obj)}
+    private_pks = [obj.pk for obj in objs if is_private(obj)]
+    if not private_pks:
+        return visible
+    if is_librarian_user(user):
+        visible.update(private_pks)
+    elif get_patron(user) is not None:
+        rows = model.objects.filter(pk__in=private_pks).filter(visibility(user)).values_list('pk', flat=True)
+        visible.update(rows)
+    return visible
+
+
+def can_view(user, objs):
+    """
+    Check which items and/or collections `user` may see, with at most one
+    query per model.
+
+    :param user: request.user, possibly anonymous
+    :param objs: An Item or Collection, or an iterable of them
+    :return: A bool for a single object, otherwise the set of visible primary keys
+    """
+    single = isinstance(objs, Model)
+    batch = [objs] if single else list(objs)
+
+    items = [obj for obj in batch if isinstance(obj, Item)]
+    collections = [obj for obj in batch if isinstance(obj, Collection)]
+    visible = set()
+    if items:
+        visible |= _visible_pks(user, Item, items, lambda item: item.private_collection, item_visibility)
+    if collections:
+        visible |= _visible_pks(user, Collection, collections, lambda c: c.is_private, collection_visibility)
+
+    if single:
+        return objs.pk in visible
+    return visible
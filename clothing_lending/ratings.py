@@ -0,0 +1,102 @@
+"""
+Denormalized rating aggregates on Item.
+
+Every item stores its rating count, the sum of its stars and a 1-5 star
+histogram so pages can show averages without reading the Rating table. The
+views that create, edit and delete ratings adjust these columns in the same
+transaction with F() expressions, and a pre_delete signal on Patron does the
+same for ratings that cascade away with a deleted or promoted patron.
+`manage.py rebuild_rating_aggregates` recomputes them from scratch if they
+ever drift.
+"""
+
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Item, Rating
+
+STARS = range(1, 6)
+
+
+def star_field(stars):
+    return f'rating_{stars}'
+
+
+def aggregate_expressions(rating_model=Rating):
+    """
+    Subquery expressions that compute every aggregate column from the ratings
+    table, for use in Item.objects.update(). Takes the Rating model so that
+    migrations can pass their historical version.
+    """
+    def per_item(aggregate, **filters):
+        rows = (
+            rating_model.objects.filter(item=OuterRef('pk'), **filters)
+            .order_by().values('item').annotate(value=aggregate).values('value')
+        )
+        return Coalesce(Subquery(rows), 0)
+
+    expressions = {
+        'rating_count': per_item(Count('pk')),
+        'rating_sum': per_item(Sum('num_rating')),
+    }
+    for stars in STARS:
+        expressions[star_field(stars)] = per_item(Count('pk'), num_rating=stars)
+    return expressions
+
+
+def rebuild_rating_aggregates(item_ids=None):
+    """
+    Recompute the aggregates for the given items (or all items) with one UPDATE.
+    Returns the number of items updated.
+    """
+    items = Item.objects.all()
+    if item_ids is not None:
+        items = items.filter(pk__in=item_ids)
+    return items.update(**aggregate_expressions())
+
+
+def record_rating(item_id, stars):
+    """
+    Count a new rating of `stars` for the item.
+    """
+    Item.objects.filter(pk=item_id).update(
+        rating_count=F('rating_count') + 1,
+        rating_sum=F('rating_sum') + stars,
+        **{star_field(stars): F(star_field(stars)) + 1},
+    )
+
+
+def change_rating(item_id, old_stars, new_stars):
+    """
+    Move an existing rating from `old_stars` to `new_stars`.
+    """
+    if old_stars == new_stars:
+        return
+    Item.objects.filter(pk=item_id).update(
+        rating_sum=F('rating_sum') + (new_stars - old_stars),
+        **{
+            star_field(old_stars): F(star_field(old_stars)) - 1,
+            star_field(new_stars): F(star_field(new_stars)) + 1,
+        },
+    )
+
+
+def remove_rating(item_id, stars):
+    """
+    Forget a deleted rating of `stars` for the item.
+    """
+    Item.objects.filter(pk=item_id).update(
+        rating_count=F('rating_count') - 1,
+        rating_sum=F('rating_sum') - stars,
+        **{star_field(stars): F(star_field(stars)) - 1},
+    )
+
+
+def remove_patron_ratings(patron_id):
+    """
+    Forget every rating by a patron about to be deleted, whose ratings
+    cascade away without going through the views.
+    """
+    # A patron rates each item at most once (unique_item_rater)
+    for item_id, stars in Rating.objects.filter(rater_id=patron_id).values_list('item_id', 'num_rating'):
+        remove_rating(item_id, stars)
@@ -1,45 +1,143 @@
 import os
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from django.conf import settings
+from django.core.cache import caches
 import uuid
 
-def get_s3_client():
+from .metrics import instrument_s3_client
+
+def create_s3_client():
     """
-    Create and return an S3 client with the configured credentials.
+    Create a new S3 client with the configured credentials, connection pool
+    size, timeouts and retry mode. Prefer get_s3_client(), which reuses one.
     """
-    return boto3.client(
-        's3',
+    # A private session: boto3's default session isn't safe to share across threads
+    session = boto3.session.Session(
         aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
         aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
         region_name=settings.AWS_S3_REGION_NAME
     )
+    endpoint_url = getattr(settings, 'AWS_S3_ENDPOINT_URL', None)
+    config = Config(
+        max_pool_connections=getattr(settings, 'AWS_S3_MAX_POOL_CONNECTIONS', 10),
+        connect_timeout=getattr(settings, 'AWS_S3_CONNECT_TIMEOUT', 5),
+        read_timeout=getattr(settings, 'AWS_S3_READ_TIMEOUT', 30),
+        retries={
+            'mode': getattr(settings, 'AWS_S3_RETRY_MODE', 'standard'),
+            'max_attempts': getattr(settings, 'AWS_S3_MAX_ATTEMPTS', 3),
+        },
+        # S3 stand-ins (MinIO, moto) don't serve bucket subdomains
+        s3={'addressing_style': 'path'} if endpoint_url else None,
+    )
+    return instrument_s3_client(session.client('s3', endpoint_url=endpoint_url, config=config))
+
+
+def get_transfer_config():
+    """
+    Transfer settings for upload_fileobj/download_fileobj.
+
+    Uploads below AWS_S3_MULTIPART_THRESHOLD go up as one PutObject that
+    streams from the file. Bigger ones are split into parts of
+    AWS_S3_MULTIPART_CHUNKSIZE, and s3transfer reads each part into memory,
+    so about AWS_S3_MAX_CONCURRENCY parts are held at once (see
+    upload_memory_bound()).
+    """
+    concurrency = getattr(settings, 'AWS_S3_MAX_CONCURRENCY', 4)
+    config = TransferConfig(
+        multipart_threshold=getattr(settings, 'AWS_S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024),
+        multipart_chunksize=getattr(settings, 'AWS_S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024),
+        max_concurrency=concurrency,
+    )
+    # Not a boto3 argument, but read by the s3transfer manager boto3 hands the config to
+    config.max_in_memory_upload_chunks = concurrency
+    return config
+
+
+def upload_memory_bound(size, config=None):
+    """
+    Most bytes of a `size`-byte file upload_fileobj buffers at once, on top
+    of the file itself if it is already in memory.
+    """
+    if config is None:
+        config = get_transfer_config()
+    if size < config.multipart_threshold:
+        return 0
+    parts = math.ceil(size / config.multipart_chunksize)
+    # Plus the part being read while the in-memory slots are full
+    return min(parts, config.max_in_memory_upload_chunks + 1) * config.multipart_chunksize
+
+
+_s3_client = None
+_s3_client_pid = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """
+    Return the process-wide S3 client, creating it on first use.
+
+    Building a client resolves credentials and endpoints and starts a cold
+    connection pool, so it is done once per process. A client inherited from
+    a parent process (e.g. the gunicorn master before forking workers) is
+    never reused, since its pooled sockets are shared with the parent.
+    """
+    global _s3_client, _s3_client_pid
+    client, pid = _s3_client, _s3_client_pid
+    if client is not None and pid == os.getpid():
+        return client
+    with _s3_client_lock:
+        if _s3_client is None or _s3_client_pid != os.getpid():
+            _s3_client = create_s3_client()
+            _s3_client_pid = os.getpid()
+        return _s3_client
+
+
+def reset_s3_client():
+    """
+    Drop the shared client so the next get_s3_client() call builds a new one,
+    and forget the last health check, which was made with the old client.
+    """
+    global _s3_client, _s3_client_pid, _s3_client_lock, _s3_health_checked_at
+    _s3_client = None
+    _s3_client_pid = None
+    # The lock may have been held by another thread at fork time
+    _s3_client_lock = threading.Lock()
+    _s3_health_checked_at = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_s3_client)
 
 def check_aws_credentials():
     """
-    Check if AWS credentials are properly configured.
+    Check if AWS credentials are properly configured and the bucket is reachable.
+
+    Makes a network call; use get_s3_health() for the cached result.
     """
     try:
-        # Print AWS settings for debugging
-        print(f"AWS_ACCESS_KEY_ID: {'*' * len(settings.AWS_ACCESS_KEY_ID)}")
-        print(f"AWS_SECRET_ACCESS_KEY: {'*' * len(settings.AWS_SECRET_ACCESS_KEY)}")
-        print(f"AWS_STORAGE_BUCKET_NAME: {settings.AWS_STORAGE_BUCKET_NAME}")
-        print(f"AWS_S3_REGION_NAME: {settings.AWS_S3_REGION_NAME}")
-        
-        # Try to create an S3 client
         s3_client = get_s3_client()
-        
-        # Try to list buckets to verify credentials
-        response = s3_client.list_buckets()
-        buckets = [bucket['Name'] for bucket in response['Buckets']]
-        
-        # Check if our bucket exists
-        bucket_exists = settings.AWS_STORAGE_BUCKET_NAME in buckets
-        
+
+        # One HEAD request checks both the credentials and access to our bucket
+        s3_client.head_bucket(Bucket=settings.AWS_STORAGE_BUCKET_NAME)
+
         return {
             'success': True,
-            'buckets': buckets,
-            'bucket_exists': bucket_exists
+            'bucket_exists': True
+        }
+    except ClientError as e:
+        bucket_missing = e.response.get('Error', {}).get('Code') in ('404', 'NoSuchBucket')
+        return {
+            'success': False,
+            'bucket_exists': not bucket_missing,
+            'error': str(e)
         }
     except Exception as e:
         import traceback
@@ -49,14 +147,52 @@ def check_aws_credentials():
             'error': str(e)
         }
 
-def upload_file_to_s3(file_obj, bucket_name=None, object_name=None):
+
+_s3_health = None
+_s3_health_checked_at = None
+_s3_health_lock = threading.Lock()
+
+
+def get_s3_health(force=False):
+    """
+    Return the result of check_aws_credentials(), re-running the check at
+    most once every AWS_HEALTH_CHECK_INTERVAL seconds.
+    """
+    global _s3_health, _s3_health_checked_at
+    interval = getattr(settings, 'AWS_HEALTH_CHECK_INTERVAL', 300)
+    with _s3_health_lock:
+        stale = _s3_health_checked_at is None or time.monotonic() - _s3_health_checked_at >= interval
+        if force or stale:
+            _s3_health = check_aws_credentials()
+            _s3_health_checked_at = time.monotonic()
+            if not _s3_health['success']:
+                print(f"AWS credentials check failed: {_s3_health['error']}")
+        return _s3_health
+
+
+def s3_object_url(object_key, bucket_name=None):
+    """
+    Public (unsigned) URL of an object, as stored on Item.image_url.
+    """
+    if bucket_name is None:
+        bucket_name = settings.AWS_STORAGE_BUCKET_NAME
+    endpoint_url = getattr(settings, 'AWS_S3_ENDPOINT_URL', None)
+    if endpoint_url:
+        return f"{endpoint_url.rstrip('/')}/{bucket_name}/{object_key}"
+    return f"https://{bucket_name}.s3.amazonaws.com/{object_key}"
+
+
+def upload_file_to_s3(file_obj, bucket_name=None, object_name=None, content_type=None, cache_control=None):
     """
     Upload a file to an S3 bucket and return the URL and key.
+
+    :param content_type: Defaults to the file's content_type attribute
+    :param cache_control: Cache-Control header to store with the object
     """
-    # Check AWS credentials first
-    creds_check = check_aws_credentials()
-    if not creds_check['success']:
-        print(f"AWS credentials check failed: {creds_check['error']}")
+    # Fail fast if the last credentials check (cached for a few minutes) failed
+    health = get_s3_health()
+    if not health['success']:
+        print(f"Skipping upload, S3 is unhealthy: {health['error']}")
         return None
         
     if bucket_name is None:
@@ -76,19 +212,30 @@ def upload_file_to_s3(file_obj, bucket_name=None, object_name=None):
         print(f"Uploading to S3: bucket={bucket_name}, key={object_name}")
         
         # Upload the file
+        transfer_config = get_transfer_config()
+        size = getattr(file_obj, 'size', None)
+        started = time.perf_counter()
+        extra_args = {
+            'ContentType': content_type or getattr(file_obj, 'content_type', 'application/octet-stream')
+        }
+        if cache_control:
+            extra_args['CacheControl'] = cache_control
         s3_client.upload_fileobj(
             file_obj,
             bucket_name,
             object_name,
-            ExtraArgs={
-                'ContentType': getattr(file_obj, 'content_type', 'application/octet-stream')
-            }
+            ExtraArgs=extra_args,
+            Config=transfer_config,
         )
+        elapsed = time.perf_counter() - started
         
         # Generate URL
-        url = f"https://{bucket_name}.s3.amazonaws.com/{object_name}"
+        url = s3_object_url(object_name, bucket_name)
         
         print(f"Upload successful. URL: {url}")
+        if size is not None:
+            print(f"Uploaded {size} bytes in {elapsed * 1000:.0f}ms, "
+                  f"buffering at most {upload_memory_bound(size, transfer_config)} bytes")
         
         return {
             'url': url,
@@ -101,30 +248,194 @@ def upload_file_to_s3(file_obj, bucket_name=None, object_name=None):
         traceback.print_exc()
         return None
 
-def generate_presigned_url(object_key, bucket_name=None, expiration=3600):
+class PresignedUrlCache:
+    """
+    Thread-safe LRU cache of signed GET URLs.
+
+    Entries are keyed by bucket, object key and expiry so a URL is only
+    reused for callers asking for the same lifetime, and are reissued once
+    fewer than `refresh_margin` seconds of validity remain. Concurrent misses
+    for the same key wait on a per-key lock so only one of them signs.
+    Optionally backed by a shared Django cache so all workers reuse URLs.
+    """
+
+    def __init__(self, max_size=2048, refresh_margin=600, cache_alias=None):
+        self.max_size = max_size
+        self.refresh_margin = refresh_margin
+        self.cache_alias = cache_alias
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.sign_count = 0
+        self.sign_time_total = 0.0
+        self.sign_time_max = 0.0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._key_locks.clear()
+
+    def _shared_cache(self):
+        if not self.cache_alias:
+            return None
+        return caches[self.cache_alias]
+
+    def _shared_key(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return f"presigned-url:{digest}"
+
+    def _lookup(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                url, expires_at = entry
+                if expires_at - now > self.refresh_margin:
+                    self._entries.move_to_end(key)
+                    return url
+                del self._entries[key]
+        return None
+
+    def _store(self, key, url, expires_at):
+        with self._lock:
+            self._entries[key] = (url, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def get_or_sign(self, key, expiration, sign):
+        """
+        Return a cached URL for `key`, or call `sign()` to make one.
+
+        :param key: Hashable cache key
+        :param expiration: Lifetime in seconds the URL is signed for
+        :param sign: Callable returning a new URL, or None on failure
+        :return: URL string or None
+        """
+        now = time.time()
+        url = self._lookup(key, now)
+        if url is not None:
+            with self._lock:
+                self.hits += 1
+            return url
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            try:
+                return self._sign_once(key, expiration, sign)
+            finally:
+                with self._lock:
+                    if self._key_locks.get(key) is key_lock:
+                        del self._key_locks[key]
+
+    def _sign_once(self, key, expiration, sign):
+        """
+        Sign `key` unless it was cached meanwhile. Caller holds the key lock.
+        """
+        # Another thread may have signed it while we waited
+        now = time.time()
+        url = self._lookup(key, now)
+        if url is not None:
+            with self._lock:
+                self.hits += 1
+            return url
+
+        shared = self._shared_cache()
+        if shared is not None:
+            cached = shared.get(self._shared_key(key))
+            if cached is not None and cached[1] - now > self.refresh_margin:
+                self._store(key, *cached)
+                with self._lock:
+                    self.shared_hits += 1
+                return cached[0]
+
+        start = time.perf_counter()
+        url = sign()
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.misses += 1
+            self.sign_count += 1
+            self.sign_time_total += elapsed
+            self.sign_time_max = max(self.sign_time_max, elapsed)
+
+        if url is None:
+            return None
+
+        expires_at = now + expiration
+        self._store(key, url, expires_at)
+        if shared is not None:
+            shared.set(self._shared_key(key), (url, expires_at),
+                       timeout=max(1, int(expiration - self.refresh_margin)))
+        return url
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+                'sign_count': self.sign_count,
+                'sign_time_avg_ms': self.sign_time_total / self.sign_count * 1000 if self.sign_count else 0.0,
+                'sign_time_max_ms': self.sign_time_max * 1000,
+            }
+
+
+presigned_url_cache = PresignedUrlCache(
+    max_size=getattr(settings, 'PRESIGNED_URL_CACHE_SIZE', 2048),
+    refresh_margin=getattr(settings, 'PRESIGNED_URL_REFRESH_MARGIN', 600),
+    cache_alias=getattr(settings, 'PRESIGNED_URL_CACHE_ALIAS', None),
+)
+
+
+def get_presigned_url_cache_stats():
+    """
+    Hit rate and signing time for the presigned URL cache in this process.
+    """
+    return presigned_url_cache.stats()
+
+
+def generate_presigned_url(object_key, bucket_name=None, expiration=3600, s3_client=None):
     """
     Generate a presigned URL to share an S3 object.
+
+    URLs are cached and reused until fewer than PRESIGNED_URL_REFRESH_MARGIN
+    seconds of their validity remain.
     
     :param object_key: Key of the object to share
     :param bucket_name: S3 bucket name. If not specified, uses the default from settings.
     :param expiration: Time in seconds for the presigned URL to remain valid
+    :param s3_client: Client to sign with, so callers signing many URLs can reuse one
     :return: Presigned URL as string. If error, returns None.
     """
     if bucket_name is None:
         bucket_name = settings.AWS_STORAGE_BUCKET_NAME
-    
-    # Get S3 client
-    s3_client = get_s3_client()
-    
-    try:
-        response = s3_client.generate_presigned_url('get_object',
-                                                    Params={'Bucket': bucket_name,
-                                                            'Key': object_key},
-                                                    ExpiresIn=expiration)
-        return response
-    except ClientError as e:
-        print(f"Error generating presigned URL: {e}")
-        return None
+
+    def sign():
+        # Get S3 client
+        client = s3_client if s3_client is not None else get_s3_client()
+
+        try:
+            response = client.generate_presigned_url('get_object',
+                                                     Params={'Bucket': bucket_name,
+                                                             'Key': object_key},
+                                                     ExpiresIn=expiration)
+            return response
+        except ClientError as e:
+            print(f"Error generating presigned URL: {e}")
+            return None
+
+    return presigned_url_cache.get_or_sign((bucket_name, object_key, expiration), expiration, sign)
 
 def delete_file_from_s3(object_key, bucket_name=None):
     """
@@ -146,4 +457,83 @@ def delete_file_from_s3(object_key, bucket_name=None):
         return True
     except ClientError as e:
         print(f"Error deleting file from S3: {e}")
-        return False 
+        return False
+
+
+# DeleteObjects takes at most this many keys per call
+DELETE_BATCH_SIZE = 1000
+
+
+def delete_files_from_s3(object_keys, bucket_name=None):
+    """
+    Delete many objects, up to DELETE_BATCH_SIZE per DeleteObjects call.
+    Deleting a missing key counts as success.
+
+    :param object_keys: Keys of the objects to delete
+    :param bucket_name: S3 bucket name. If not specified, uses the default from settings.
+    :return: {key: error message} for the keys that could not be deleted
+    """
+    if bucket_name is None:
+        bucket_name = settings.AWS_STORAGE_BUCKET_NAME
+
+    s3_client = get_s3_client()
+    errors = {}
+    object_keys = list(object_keys)
+    for start in range(0, len(object_keys), DELETE_BATCH_SIZE):
+        batch = object_keys[start:start + DELETE_BATCH_SIZE]
+        try:
+            response = s3_client.delete_objects(
+                Bucket=bucket_name,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True},
+            )
+        except ClientError as e:
+            print(f"Error deleting files from S3: {e}")
+            errors.update((key, str(e)) for key in batch)
+            continue
+        for error in response.get('Errors', []):
+            errors[error['Key']] = f"{error.get('Code')}: {error.get('Message')}"
+    return errors
+
+
+def generate_presigned_post(object_key, content_type, max_size, bucket_name=None, expiration=600):
+    """
+    Presigned POST letting a browser upload one file straight to S3.
+
+    S3 rejects the upload unless it is stored at exactly `object_key`, has
+    exactly `content_type`, and is at most `max_size` bytes.
+
+    :return: {'url': ..., 'fields': {...}} for a multipart form POST, or None on error
+    """
+    if bucket_name is None:
+        bucket_name = settings.AWS_STORAGE_BUCKET_NAME
+    try:
+        return get_s3_client().generate_presigned_post(
+            bucket_name,
+            object_key,
+            Fields={'Content-Type': content_type},
+            Conditions=[
+                {'Content-Type': content_type},
+                ['content-length-range', 1, max_size],
+            ],
+            ExpiresIn=expiration,
+        )
+    except ClientError as e:
+        print(f"Error generating presigned POST: {e}")
+        return None
+
+
+def get_object_info(object_key, bucket_name=None):
+    """
+    Size and content type of an object, from a HEAD request.
+
+    :return: {'size': int, 'content_type': str}, or None if the object doesn't exist
+    """
+    if bucket_name is None:
+        bucket_name = settings.AWS_STORAGE_BUCKET_NAME
+    try:
+        response = get_s3_client().head_object(Bucket=bucket_name, Key=object_key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return {'size': response['ContentLength'], 'content_type': response.get('ContentType', '')}
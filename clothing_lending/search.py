@@ -0,0 +1,214 @@
+"""
+Full-text search over item names, descriptions and category names.
+
+Production runs on Postgres, where every item row carries a weighted
+`search_vector` tsvector column behind a GIN index. Local SQLite databases use
+an FTS5 virtual table with the item's id in an UNINDEXED column. (Not the
+rowid: Item has a UUID primary key, so its rowid changes whenever SQLite
+rebuilds the table, as Django's AddField and VACUUM do.) Neither column nor
+table is part of the Django model: they are created by migrations 0020 and
+0029 and kept in sync by the signals in signals.py, or rebuilt with
+`manage.py rebuild_search_index`.
+"""
+
+import re
+
+from django.db import connection
+from django.db.models import BooleanField, FloatField, Q, Exists, OuterRef
+from django.db.models.expressions import RawSQL
+
+from .models import Item, Category
+
+FTS_TABLE = 'clothing_lending_item_fts'
+FTS_RANK_TABLE = 'clothing_lending_item_fts_rank'
+SEARCH_VECTOR_COLUMN = 'search_vector'
+SEARCH_INDEX_NAME = 'item_search_vector_gin'
+SEARCH_CONFIG = 'english'
+
+# Relative column weights for SQLite's bm25(): name, description, categories
+FTS_WEIGHTS = (10.0, 1.0, 5.0)
+
+# Keep IN (...) lists under SQLite's host parameter limit
+INDEX_BATCH_SIZE = 500
+
+
+def _tables():
+    qn = connection.ops.quote_name
+    through = Item.categories.through._meta
+    return {
+        'item': qn(Item._meta.db_table),
+        'through': qn(through.db_table),
+        'through_item': qn(through.get_field('item').column),
+        'through_category': qn(through.get_field('category').column),
+        'category': qn(Category._meta.db_table),
+        'fts': qn(FTS_TABLE),
+        'ranks': qn(FTS_RANK_TABLE),
+        'vector': qn(SEARCH_VECTOR_COLUMN),
+        'index': qn(SEARCH_INDEX_NAME),
+    }
+
+
+def create_search_index(schema_editor):
+    """
+    Create the search column/table for the current database. Safe to re-run.
+    """
+    vendor = schema_editor.connection.vendor
+    t = _tables()
+    if vendor == 'postgresql':
+        schema_editor.execute(f"ALTER TABLE {t['item']} ADD COLUMN IF NOT EXISTS {t['vector']} tsvector")
+        schema_editor.execute(f"CREATE INDEX IF NOT EXISTS {t['index']} ON {t['item']} USING GIN ({t['vector']})")
+    elif vendor == 'sqlite':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA table_info({t['fts']})")
+            columns = [row[1] for row in cursor.fetchall()]
+        if columns and 'item_id' not in columns:
+            # Keyed by rowid, as before migration 0029; rebuilt by the caller
+            schema_editor.execute(f"DROP TABLE {t['fts']}")
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {t['fts']} USING fts5("
+            f"item_id UNINDEXED, name, description, categories, tokenize='porter unicode61')"
+        )
+
+
+def drop_search_index(schema_editor):
+    vendor = schema_editor.connection.vendor
+    t = _tables()
+    if vendor == 'postgresql':
+        schema_editor.execute(f"DROP INDEX IF EXISTS {t['index']}")
+        schema_editor.execute(f"ALTER TABLE {t['item']} DROP COLUMN IF EXISTS {t['vector']}")
+    elif vendor == 'sqlite':
+        schema_editor.execute(f"DROP TABLE IF EXISTS {t['fts']}")
+
+
+def _category_names_sql(t, separator):
+    if connection.vendor == 'postgresql':
+        aggregate = f"string_agg(c.name, '{separator}')"
+    else:
+        aggregate = f"group_concat(c.name, '{separator}')"
+    return (
+        f"(SELECT {aggregate} FROM {t['through']} ic "
+        f"JOIN {t['category']} c ON c.id = ic.{t['through_category']} "
+        f"WHERE ic.{t['through_item']} = i.id)"
+    )
+
+
+def _index_batch(cursor, t, where, params):
+    if connection.vendor == 'postgresql':
+        cursor.execute(
+            f"UPDATE {t['item']} AS i SET {t['vector']} = "
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(i.name, '')), 'A') || "
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce({_category_names_sql(t, ' ')}, '')), 'B') || "
+            f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(i.description, '')), 'C') "
+            f"WHERE {where}",
+            params,
+        )
+    elif connection.vendor == 'sqlite':
+        cursor.execute(f"DELETE FROM {t['fts']} WHERE item_id IN (SELECT i.id FROM {t['item']} i WHERE {where})", params)
+        cursor.execute(
+            f"INSERT INTO {t['fts']} (item_id, name, description, categories) "
+            f"SELECT i.id, i.name, i.description, coalesce({_category_names_sql(t, ' ')}, '') "
+            f"FROM {t['item']} i WHERE {where}",
+            params,
+        )
+
+
+def index_items(item_ids=None):
+    """
+    (Re)build the search entries for the given item ids, or for every item
+    when item_ids is None.
+    """
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    t = _tables()
+    with connection.cursor() as cursor:
+        if item_ids is None:
+            if connection.vendor == 'sqlite':
+                cursor.execute(f"DELETE FROM {t['fts']}")
+            _index_batch(cursor, t, '1 = 1', [])
+            return
+
+        pk = Item._meta.pk
+        item_ids = [pk.get_db_prep_value(pk.to_python(i), connection) for i in item_ids]
+        for start in range(0, len(item_ids), INDEX_BATCH_SIZE):
+            batch = item_ids[start:start + INDEX_BATCH_SIZE]
+            placeholders = ', '.join(['%s'] * len(batch))
+            _index_batch(cursor, t, f"i.id IN ({placeholders})", batch)
+
+
+def unindex_items(item_ids):
+    """
+    Remove search entries for items that are about to be deleted. Only SQLite
+    needs this; on Postgres the vector goes away with the row.
+    """
+    if connection.vendor != 'sqlite' or not item_ids:
+        return
+    t = _tables()
+    pk = Item._meta.pk
+    item_ids = [pk.get_db_prep_value(pk.to_python(i), connection) for i in item_ids]
+    with connection.cursor() as cursor:
+        for start in range(0, len(item_ids), INDEX_BATCH_SIZE):
+            batch = item_ids[start:start + INDEX_BATCH_SIZE]
+            placeholders = ', '.join(['%s'] * len(batch))
+            cursor.execute(f"DELETE FROM {t['fts']} WHERE item_id IN ({placeholders})", batch)
+
+
+def _fts_match_expression(query):
+    # Quote every word so FTS5 operators in user input are treated as text,
+    # and prefix-match so "jack" finds "jacket" like the old icontains did.
+    terms = re.findall(r'\w+', query)
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def _fill_sqlite_ranks(match):
+    # bm25() only works in a query driven by MATCH; evaluating it in a correlated
+    # subquery per item re-runs the match for every row. Instead score all
+    # matches in one pass into a connection-local temp table keyed by item id.
+    t = _tables()
+    # bm25() takes a weight for every column, the unindexed item_id included
+    weights = ', '.join(str(w) for w in (0.0,) + FTS_WEIGHTS)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TEMP TABLE IF NOT EXISTS {t['ranks']} "
+            f"(query TEXT, item_id TEXT, rank REAL, PRIMARY KEY (query, item_id))"
+        )
+        cursor.execute(f"DELETE FROM {t['ranks']}")
+        # bm25() is lower-is-better, so negate it to sort like Postgres ranks
+        cursor.execute(
+            f"INSERT INTO {t['ranks']} (query, item_id, rank) "
+            f"SELECT %s, item_id, -bm25({t['fts']}, {weights}) FROM {t['fts']} WHERE {t['fts']} MATCH %s",
+            [match, match],
+        )
+
+
+def search_items(queryset, query):
+    """
+    Restrict an Item queryset to matches for `query` and annotate each row with
+    `search_rank` (higher is more relevant).
+    """
+    t = _tables()
+    if connection.vendor == 'postgresql':
+        tsquery = f"websearch_to_tsquery('{SEARCH_CONFIG}', %s)"
+        return queryset.filter(
+            RawSQL(f"{t['item']}.{t['vector']} @@ {tsquery}", [query], output_field=BooleanField())
+        ).annotate(
+            search_rank=RawSQL(f"ts_rank_cd({t['item']}.{t['vector']}, {tsquery})", [query], output_field=FloatField())
+        )
+
+    if connection.vendor == 'sqlite':
+        match = _fts_match_expression(query)
+        if not match:
+            return queryset.none().annotate(search_rank=RawSQL('0', [], output_field=FloatField()))
+        _fill_sqlite_ranks(match)
+        return queryset.filter(
+            RawSQL(f"{t['item']}.id IN (SELECT item_id FROM {t['ranks']} WHERE query = %s)",
+                   [match], output_field=BooleanField())
+        ).annotate(
+            search_rank=RawSQL(f"(SELECT rank FROM {t['ranks']} WHERE query = %s AND item_id = {t['item']}.id)",
+                               [match], output_field=FloatField())
+        )
+
+    # No search index on other databases: fall back to substring matching
+    in_category = Item.categories.through.objects.filter(item=OuterRef('pk'), category__name__icontains=query)
+    return queryset.filter(
+        Q(name__icontains=query) | Q(description__icontains=query) | Exists(in_category)
+    ).annotate(search_rank=RawSQL('0', [], output_field=FloatField()))
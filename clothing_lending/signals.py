@@ -1,9 +1,14 @@
 # filepath: c:\Users\kaden\CS3240\Lending\project-b-23\clothing_lending\signals.py
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import post_save, pre_save, pre_delete, post_delete
 from django.dispatch import receiver
 from .models import User, Librarian, Patron
 from django.db.models.signals import m2m_changed
-from .models import Item
+from .models import Item, Category, Collection
+from .search import index_items, unindex_items
+from .visibility import refresh_item_access, recompute_item_privacy, items_in_collections
+from .deletions import schedule_s3_deletion
+from .tasks import item_image_keys
+from .ratings import remove_patron_ratings
 
 @receiver(post_save, sender=User)
 def create_or_update_librarian(sender, instance, created, **kwargs):
@@ -46,18 +51,116 @@ def handle_user_type_change(sender, instance, **kwargs):
                 Librarian.objects.get_or_create(user=instance)
 
 @receiver(m2m_changed, sender=Item.collections.through)
-def update_item_privacy(sender, instance, action, **kwargs):
-    if action in ["post_add", "post_remove", "post_clear"]:
-        # Check if we're dealing with an Item instance
-        if hasattr(instance, 'collections'):
-            # Instance is an Item, check if any of its collections are private
+def update_item_privacy(sender, instance, action, reverse, pk_set, **kwargs):
+    # Recompute private_collection and the PatronItemAccess rows for every affected item
+    if not reverse:
+        # Instance is an Item
+        if action in ["post_add", "post_remove", "post_clear"]:
             has_private = instance.collections.filter(is_private=True).exists()
+            Item.objects.filter(pk=instance.pk).update(private_collection=has_private)
             instance.private_collection = has_private
-            instance.save()
-        # If instance is a Collection, we need to update all its items
-        elif hasattr(instance, 'items'):
-            for item in instance.items.all():
-                # Check if any of the item's collections are private
-                has_private = item.collections.filter(is_private=True).exists()
-                item.private_collection = has_private
-        instance.save()
+            refresh_item_access([instance.pk])
+    elif action == "pre_clear":
+        # Instance is a Collection; remember its items before the links are gone
+        instance._affected_item_ids = list(instance.items.values_list('pk', flat=True))
+    elif action in ["post_add", "post_remove", "post_clear"]:
+        item_ids = list(pk_set) if action != "post_clear" else getattr(instance, '_affected_item_ids', [])
+        recompute_item_privacy(item_ids)
+        refresh_item_access(item_ids)
+
+# Keep the full-text search index in step with item names, descriptions and categories
+@receiver(post_save, sender=Item)
+def index_saved_item(sender, instance, **kwargs):
+    index_items([instance.pk])
+
+@receiver(pre_delete, sender=Item)
+def unindex_deleted_item(sender, instance, **kwargs):
+    unindex_items([instance.pk])
+
+@receiver(m2m_changed, sender=Item.categories.through)
+def index_item_categories(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # Instance is an Item
+        if action in ["post_add", "post_remove", "post_clear"]:
+            index_items([instance.pk])
+    elif action == "pre_clear":
+        # Instance is a Category; remember its items before the links are gone
+        instance._search_item_ids = list(instance.items.values_list('pk', flat=True))
+    elif action == "post_clear":
+        index_items(getattr(instance, '_search_item_ids', []))
+    elif action in ["post_add", "post_remove"]:
+        index_items(pk_set)
+
+@receiver(post_save, sender=Category)
+def index_renamed_category(sender, instance, created, **kwargs):
+    if not created:
+        index_items(list(instance.items.values_list('pk', flat=True)))
+
+@receiver(pre_delete, sender=Category)
+def remember_category_items(sender, instance, **kwargs):
+    instance._search_item_ids = list(instance.items.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Category)
+def index_deleted_category(sender, instance, **kwargs):
+    index_items(getattr(instance, '_search_item_ids', []))
+
+
+# Keep the PatronItemAccess visibility table in step with allowed patrons and
+# collection privacy (membership changes are handled in update_item_privacy)
+@receiver(m2m_changed, sender=Collection.allowed_patrons.through)
+def update_patron_access(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear":
+        if reverse:
+            instance._access_collection_ids = list(instance.allowed_collections.values_list('pk', flat=True))
+        else:
+            instance._access_patron_ids = list(instance.allowed_patrons.values_list('pk', flat=True))
+    elif action in ["post_add", "post_remove", "post_clear"]:
+        if reverse:
+            # Instance is a Patron and pk_set holds collection ids
+            collection_ids = pk_set if action != "post_clear" else getattr(instance, '_access_collection_ids', [])
+            refresh_item_access(items_in_collections(list(collection_ids)), [instance.pk])
+        else:
+            # Instance is a Collection and pk_set holds patron ids
+            patron_ids = pk_set if action != "post_clear" else getattr(instance, '_access_patron_ids', [])
+            refresh_item_access(items_in_collections([instance.pk]), list(patron_ids))
+
+@receiver(pre_save, sender=Collection)
+def remember_collection_privacy(sender, instance, **kwargs):
+    if instance.pk:
+        instance._was_private = Collection.objects.filter(pk=instance.pk).values_list('is_private', flat=True).first()
+
+@receiver(post_save, sender=Collection)
+def update_collection_access(sender, instance, created, **kwargs):
+    was_private = getattr(instance, '_was_private', None)
+    if not created and was_private is not None and was_private != instance.is_private:
+        item_ids = list(instance.items.values_list('pk', flat=True))
+        recompute_item_privacy(item_ids)
+        refresh_item_access(item_ids)
+
+@receiver(pre_delete, sender=Collection)
+def remember_collection_items(sender, instance, **kwargs):
+    instance._access_item_ids = list(instance.items.values_list('pk', flat=True))
+
+@receiver(post_delete, sender=Collection)
+def update_deleted_collection_items(sender, instance, **kwargs):
+    item_ids = getattr(instance, '_access_item_ids', [])
+    recompute_item_privacy(item_ids)
+    refresh_item_access(item_ids)
+
+
+# Queue the S3 images of deleted items and patrons for deletion, including
+# deletes cascading from a user or librarian
+@receiver(post_delete, sender=Item)
+def delete_item_images(sender, instance, **kwargs):
+    schedule_s3_deletion(item_image_keys(instance))
+
+@receiver(post_delete, sender=Patron)
+def delete_profile_picture(sender, instance, **kwargs):
+    schedule_s3_deletion([instance.s3_profile_picture_key])
+
+
+# Ratings cascade away with their patron (deleted, or promoted to librarian)
+# without going through the views that keep the item aggregates in step
+@receiver(pre_delete, sender=Patron)
+def remove_deleted_patron_ratings(sender, instance, **kwargs):
+    remove_patron_ratings(instance.pk)
@@ -0,0 +1,363 @@
+"""
+Where item images and profile pictures are kept.
+
+Views, forms, jobs and the image pipeline call get_storage() and use the
+Storage interface below instead of talking to S3. STORAGE_BACKEND picks the
+implementation:
+
+- S3Storage (default): AWS_STORAGE_BUCKET_NAME, through s3_utils.
+- LocalFileSystemStorage: files under STORAGE_LOCAL_ROOT.
+- InMemoryStorage: a dict in the process (tests, benchmarks).
+
+The two non-S3 backends serve files and accept browser uploads through the
+storage_object and storage_upload views, with Django-signed URLs and upload
+policies standing in for S3's presigned ones. Every page and flow, direct
+uploads included, runs unchanged on one machine without AWS.
+"""
+
+import io
+import mimetypes
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core import signing
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare
+from django.utils.module_loading import import_string
+
+from .s3_utils import (
+    delete_files_from_s3, generate_presigned_post, generate_presigned_url, get_object_info, get_s3_client,
+    get_s3_health, get_transfer_config, s3_object_url, upload_file_to_s3,
+)
+
+DEFAULT_BACKEND = 'clothing_lending.storage.S3Storage'
+
+# Keys per page when listing, as S3 returns them
+LIST_PAGE_SIZE = 1000
+
+_signer = signing.Signer(salt='clothing_lending.storage')
+
+
+class StorageError(Exception):
+    pass
+
+
+class Storage:
+    """
+    Keys are '/'-separated paths such as items/<uuid>.png. The URL and upload
+    methods here are for backends whose files Django serves itself.
+    """
+
+    def save(self, key, file_obj, content_type=None, cache_control=None):
+        """
+        Store the contents of `file_obj`, read from its current position.
+
+        :raises StorageError: if the object couldn't be stored
+        """
+        raise NotImplementedError
+
+    def open(self, key):
+        """
+        A readable binary file with the object's contents.
+
+        :raises FileNotFoundError: if there is no such object
+        """
+        raise NotImplementedError
+
+    def download(self, key, file_obj):
+        """
+        Write the object's contents to `file_obj`.
+        """
+        with self.open(key) as source:
+            shutil.copyfileobj(source, file_obj)
+
+    def info(self, key):
+        """
+        :return: {'size': int, 'content_type': str}, or None if there is no such object
+        """
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        """
+        Delete objects. Deleting a missing key counts as success.
+
+        :return: {key: error message} for the keys that could not be deleted
+        """
+        raise NotImplementedError
+
+    def list(self, prefix):
+        """
+        Objects whose key starts with `prefix`, in key order.
+
+        :return: Iterator of pages, each a list of (key, last modified datetime)
+        """
+        raise NotImplementedError
+
+    def health(self):
+        """
+        :return: {'success': True}, or {'success': False, 'error': message}
+        """
+        return {'success': True}
+
+    def url(self, key):
+        """
+        Long-lived URL for the object, as stored on Item.image_url and
+        Patron.profile_picture.
+        """
+        return f"{reverse('storage_object', args=[key])}?sig={_signer.signature(key)}"
+
+    def signed_url(self, key, expiration=3600):
+        """
+        URL for the object that stops working after `expiration` seconds, or
+        None if one couldn't be made.
+        """
+        expires = int(time.time()) + expiration
+        signature = _signer.signature(f'{key}:{expires}')
+        return f"{reverse('storage_object', args=[key])}?expires={expires}&sig={signature}"
+
+    def presigned_post(self, key, content_type, max_size, expiration=600):
+        """
+        A form POST that lets a browser upload one file to `key`: it must be
+        exactly `content_type` and 1..`max_size` bytes.
+
+        :return: {'url': ..., 'fields': {...}}, or None on error
+        """
+        policy = signing.dumps({
+            'key': key, 'content_type': content_type, 'max_size': max_size,
+            'expires': int(time.time()) + expiration,
+        }, salt='clothing_lending.storage.upload')
+        return {
+            'url': reverse('storage_upload'),
+            'fields': {'key': key, 'Content-Type': content_type, 'policy': policy},
+        }
+
+    def verify_url(self, key, signature, expires=None):
+        """
+        Check a signature from url() or signed_url().
+        """
+        if expires is None:
+            return constant_time_compare(signature, _signer.signature(key))
+        try:
+            expired = int(expires) < time.time()
+        except ValueError:
+            return False
+        return not expired and constant_time_compare(signature, _signer.signature(f'{key}:{expires}'))
+
+    def read_policy(self, policy):
+        """
+        Decode an upload policy from presigned_post().
+
+        :return: The policy's key, content_type and max_size, or None if it is forged or expired
+        """
+        try:
+            fields = signing.loads(policy, salt='clothing_lending.storage.upload')
+        except signing.BadSignature:
+            return None
+        if fields['expires'] < time.time():
+            return None
+        return fields
+
+
+class S3Storage(Storage):
+    def __init__(self, bucket_name=None):
+        self.bucket_name = bucket_name or settings.AWS_STORAGE_BUCKET_NAME
+
+    def save(self, key, file_obj, content_type=None, cache_control=None):
+        uploaded = upload_file_to_s3(
+            file_obj, self.bucket_name, key, content_type=content_type, cache_control=cache_control
+        )
+        if uploaded is None:
+            raise StorageError(f"Upload of {key} to S3 failed")
+
+    def open(self, key):
+        try:
+            return get_s3_client().get_object(Bucket=self.bucket_name, Key=key)['Body']
+        except get_s3_client().exceptions.NoSuchKey:
+            raise FileNotFoundError(key)
+
+    def download(self, key, file_obj):
+        get_s3_client().download_fileobj(self.bucket_name, key, file_obj, Config=get_transfer_config())
+
+    def info(self, key):
+        return get_object_info(key, self.bucket_name)
+
+    def delete_many(self, keys):
+        return delete_files_from_s3(keys, self.bucket_name)
+
+    def list(self, prefix):
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            yield [(obj['Key'], obj['LastModified']) for obj in page.get('Contents', [])]
+
+    def health(self):
+        return get_s3_health()
+
+    def url(self, key):
+        return s3_object_url(key, self.bucket_name)
+
+    def signed_url(self, key, expiration=3600):
+        return generate_presigned_url(key, self.bucket_name, expiration)
+
+    def presigned_post(self, key, content_type, max_size, expiration=600):
+        return generate_presigned_post(key, content_type, max_size, self.bucket_name, expiration)
+
+
+def _paginate(entries):
+    page = []
+    for entry in entries:
+        page.append(entry)
+        if len(page) == LIST_PAGE_SIZE:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+class LocalFileSystemStorage(Storage):
+    """
+    Files under `root`, one per key. Content types are guessed from the
+    key's extension.
+    """
+
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root or settings.STORAGE_LOCAL_ROOT)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(self.root + os.sep):
+            raise StorageError(f"Invalid key: {key}")
+        return path
+
+    def save(self, key, file_obj, content_type=None, cache_control=None):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write beside the target and rename, so readers never see half a file
+            partial = f'{path}.{uuid.uuid4().hex}.partial'
+            with open(partial, 'wb') as f:
+                shutil.copyfileobj(file_obj, f)
+            os.replace(partial, path)
+        except OSError as e:
+            raise StorageError(f"Could not write {key}: {e}")
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def info(self, key):
+        try:
+            size = os.path.getsize(self._path(key))
+        except (OSError, StorageError):
+            return None
+        return {'size': size, 'content_type': mimetypes.guess_type(key)[0] or 'application/octet-stream'}
+
+    def delete_many(self, keys):
+        errors = {}
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            except (OSError, StorageError) as e:
+                errors[key] = str(e)
+        return errors
+
+    def list(self, prefix):
+        return _paginate(self._walk(prefix))
+
+    def _walk(self, prefix):
+        # Only the directories that can hold keys starting with `prefix`
+        start = os.path.join(self.root, os.path.dirname(prefix))
+        entries = []
+        for directory, subdirectories, filenames in os.walk(start):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if key.startswith(prefix) and not filename.endswith('.partial'):
+                    modified = datetime.fromtimestamp(os.path.getmtime(path), tz=dt_timezone.utc)
+                    entries.append((key, modified))
+        return sorted(entries)
+
+    def health(self):
+        if os.access(self.root, os.W_OK):
+            return {'success': True}
+        return {'success': False, 'error': f"{self.root} is not writable"}
+
+
+class InMemoryStorage(Storage):
+    """
+    Objects in a dict, gone when the process exits.
+    """
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def save(self, key, file_obj, content_type=None, cache_control=None):
+        data = file_obj.read()
+        content_type = content_type or getattr(file_obj, 'content_type', None) or 'application/octet-stream'
+        with self._lock:
+            self._objects[key] = (data, content_type, datetime.now(dt_timezone.utc))
+
+    def open(self, key):
+        with self._lock:
+            if key not in self._objects:
+                raise FileNotFoundError(key)
+            return io.BytesIO(self._objects[key][0])
+
+    def info(self, key):
+        with self._lock:
+            if key not in self._objects:
+                return None
+            data, content_type, modified = self._objects[key]
+        return {'size': len(data), 'content_type': content_type}
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._objects.pop(key, None)
+        return {}
+
+    def list(self, prefix):
+        with self._lock:
+            entries = sorted((key, modified) for key, (data, content_type, modified) in self._objects.items()
+                             if key.startswith(prefix))
+        return _paginate(entries)
+
+    def keys(self):
+        with self._lock:
+            return sorted(self._objects)
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """
+    The backend named by STORAGE_BACKEND, created once per process (and
+    again if the setting changes, as it does under override_settings).
+    """
+    global _storage
+    path = getattr(settings, 'STORAGE_BACKEND', DEFAULT_BACKEND)
+    current = _storage
+    if current is not None and current[0] == path:
+        return current[1]
+    with _storage_lock:
+        if _storage is None or _storage[0] != path:
+            _storage = (path, import_string(path)())
+        return _storage[1]
+
+
+def reset_storage():
+    """
+    Drop the backend so the next get_storage() call creates a new one
+    (an empty InMemoryStorage, for instance).
+    """
+    global _storage
+    _storage = None
@@ -0,0 +1,166 @@
+"""
+Job handlers for image storage work moved out of the request (see jobs.py).
+"""
+
+import os
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+
+from .images import upload_image_variants, variant_keys
+from .deletions import schedule_s3_deletion, flush_pending_deletions
+from .jobs import job, discard_upload
+from .models import Item, Patron
+from .storage import get_storage
+
+
+def item_image_keys(item):
+    """
+    The original and every resized copy of an item's image.
+    """
+    if not item.s3_image_key:
+        return []
+    return [item.s3_image_key] + variant_keys(item.image_variants)
+
+
+def mark_item_image_failed(item_id, **kwargs):
+    Item.objects.filter(pk=item_id, image_status='PROCESSING').update(image_status='FAILED')
+
+
+def fail_item_image_upload(item_id, path, **kwargs):
+    mark_item_image_failed(item_id)
+    discard_upload(path)
+
+
+def fail_profile_picture_upload(path, **kwargs):
+    discard_upload(path)
+
+
+def _discard_saved_image(item_id, key, variants):
+    """
+    Queue what a failed attempt saved for deletion, unless the item already
+    points at it. Every attempt saves under a new key, so nothing else would
+    clean it up.
+    """
+    if not Item.objects.filter(pk=item_id, s3_image_key=key).exists():
+        schedule_s3_deletion([key] + variant_keys(variants))
+
+
+def _upload_variants(key, original):
+    try:
+        return upload_image_variants(key, original)
+    except Exception as e:
+        # Pages fall back to the original
+        print(f"Error creating image variants for {key}: {e}")
+        return {}
+
+
+def _attach_item_image(item, key, url, variants):
+    """
+    Point `item` at its new image and queue the one it replaces for deletion.
+    """
+    new_keys = [key] + variant_keys(variants)
+    updated = Item.objects.filter(pk=item.pk).update(
+        image_url=url,
+        s3_image_key=key,
+        image_variants=variants,
+        image_status='READY',
+    )
+    # An item deleted while its image uploaded leaves nothing to point at the new objects
+    if updated:
+        stale_keys = [k for k in item_image_keys(item) if k not in new_keys]
+    else:
+        stale_keys = new_keys
+    if stale_keys:
+        schedule_s3_deletion(stale_keys)
+
+
+@job('upload_item_image', on_dead=fail_item_image_upload)
+def upload_item_image(item_id, path, name, content_type):
+    """
+    Upload a stashed item image and its resized copies, then point the item
+    at them and queue the old image for deletion.
+    """
+    item = Item.objects.filter(pk=item_id).first()
+    if item is None:
+        discard_upload(path)
+        return
+
+    storage = get_storage()
+    key = f"items/{uuid.uuid4()}{os.path.splitext(name)[1]}"
+    variants = {}
+    try:
+        with open(path, 'rb') as f:
+            upload = File(f, name=name)
+            storage.save(key, upload, content_type=content_type)
+            variants = _upload_variants(key, upload)
+
+        _attach_item_image(item, key, storage.url(key), variants)
+    except Exception:
+        _discard_saved_image(item_id, key, variants)
+        raise
+    discard_upload(path)
+
+
+@job('process_item_image', on_dead=mark_item_image_failed)
+def process_item_image(item_id, key):
+    """
+    Make the resized copies of an image the browser uploaded straight to storage,
+    then point the item at it and queue the old image for deletion.
+    """
+    item = Item.objects.filter(pk=item_id).first()
+    if item is None:
+        schedule_s3_deletion([key])
+        return
+
+    storage = get_storage()
+    with tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE) as original:
+        storage.download(key, original)
+        variants = _upload_variants(key, original)
+
+    _attach_item_image(item, key, storage.url(key), variants)
+
+
+@job('upload_profile_picture', on_dead=fail_profile_picture_upload)
+def upload_profile_picture(patron_id, path, name, content_type):
+    """
+    Upload a stashed profile picture and queue the old one for deletion.
+    """
+    patron = Patron.objects.filter(pk=patron_id).first()
+    if patron is None:
+        discard_upload(path)
+        return
+
+    storage = get_storage()
+    key = f"profile_pics/{patron.user_id}/{uuid.uuid4()}_{name}"
+    try:
+        with open(path, 'rb') as f:
+            storage.save(key, f, content_type=content_type)
+
+        Patron.objects.filter(pk=patron_id).update(profile_picture=storage.url(key), s3_profile_picture_key=key)
+    except Exception:
+        # Every attempt saves under a new key, so nothing else would clean this one up
+        if not Patron.objects.filter(pk=patron_id, s3_profile_picture_key=key).exists():
+            schedule_s3_deletion([key])
+        raise
+    if patron.s3_profile_picture_key:
+        schedule_s3_deletion([patron.s3_profile_picture_key])
+    discard_upload(path)
+
+
+@job('delete_s3_objects')
+def delete_s3_objects(keys):
+    """
+    Jobs queued before deletes went through PendingDeletion.
+    """
+    schedule_s3_deletion(keys)
+
+
+@job('flush_s3_deletions')
+def flush_s3_deletions():
+    deleted, failed = flush_pending_deletions()
+    if failed:
+        # Retried with backoff; the rows that failed stay queued
+        raise RuntimeError(f"Could not delete {failed} S3 objects ({deleted} deleted)")
@@ -1,4 +1,38 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+
+import boto3
+from allauth.socialaccount.models import SocialApp
+from botocore.stub import Stubber
+from django.contrib.messages import get_messages
+from django.contrib.sites.models import Site
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction, IntegrityError
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from clothing_lending.models import User, Librarian, Patron, Item, Category, Collection, Lending, Rating, PatronItemAccess, Job, PendingDeletion, LendingEvent
+from clothing_lending import views, forms, deletions, s3_utils, permissions, images, jobs, tasks, storage, lending, pagination
+from clothing_lending.metrics import start_request_metrics, finish_request_metrics
+from clothing_lending.middleware import QueryBudgetExceeded
+from clothing_lending.s3_utils import PresignedUrlCache
+from clothing_lending.fake_data import default_counts, generate_fake_data, delete_fake_data
+from clothing_lending.ratings import rebuild_rating_aggregates
+from clothing_lending.visibility import reconcile_item_privacy
 
 # Create your tests here.
 class DummyTestCase(TestCase):
@@ -8,3 +42,1251 @@ class DummyTestCase(TestCase):
     
     def dummy_test_case_pass(self):
         self.assertEqual(1, 1)
+
+
+def make_google_app():
+    # Guest pages render the Google sign-in link, which needs a configured app
+    app = SocialApp.objects.create(provider='google', name='Google', client_id='test', secret='test')
+    app.sites.add(Site.objects.get_current())
+    return app
+
+
+def make_librarian(username='librarian'):
+    user = User.objects.create_user(username=username, email=f'{username}@example.com', password='pw', user_type=1)
+    return Librarian.objects.get(user=user)
+
+
+def make_items(librarian, count, **kwargs):
+    return [
+        Item.objects.create(
+            name=f'Item {i}', description='A test item', size='M', condition='good',
+            created_by=librarian, **kwargs
+        )
+        for i in range(count)
+    ]
+
+
+class BrowsePaginationTestCase(TestCase):
+    def setUp(self):
+        make_google_app()
+        self.librarian = make_librarian()
+        self.items = make_items(self.librarian, 5)
+
+    def test_pages_cover_every_visible_item_once(self):
+        views.BROWSE_PAGE_SIZE, old_size = 2, views.BROWSE_PAGE_SIZE
+        try:
+            seen = []
+            url = reverse('browse')
+            while url:
+                response = self.client.get(url)
+                seen.extend(item.id for item in response.context['items'])
+                next_url = response.context['next_page_url']
+                url = reverse('browse') + next_url if next_url else None
+        finally:
+            views.BROWSE_PAGE_SIZE = old_size
+        self.assertEqual(sorted(seen), sorted(item.id for item in self.items))
+
+    def test_invalid_cursor_falls_back_to_first_page(self):
+        response = self.client.get(reverse('browse'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['items']), 5)
+
+    def test_tampered_cursor_falls_back_to_first_page(self):
+        tampered = [['x', 'y'], [1, 2], ['2024-01-01T00:00:00', 'not-a-uuid'], [None, None]]
+        for values in tampered:
+            response = self.client.get(reverse('browse'), {'cursor': pagination.encode_cursor(values)})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.context['items']), 5)
+        response = self.client.get(reverse('browse'), {'q': 'item', 'cursor': pagination.encode_cursor(['x', 'y', 'z'])})
+        self.assertEqual(response.status_code, 200)
+
+
+class BrowseFilterTestCase(TestCase):
+    def setUp(self):
+        make_google_app()
+        librarian = make_librarian()
+        tops = Category.objects.create(name='Tops')
+        small, medium, large = make_items(librarian, 3)
+        small.size, medium.size, large.size = 'S', 'M', 'L'
+        for item in (small, medium, large):
+            item.save()
+        small.categories.add(tops)
+        medium.categories.add(tops)
+        self.small, self.medium = small, medium
+
+    def test_filters_are_applied_in_sql(self):
+        response = self.client.get(reverse('browse'), {'category': 'Tops', 'size': ['S', 'XL']})
+        self.assertEqual([item.id for item in response.context['items']], [self.small.id])
+
+    def test_facet_counts_ignore_their_own_selection(self):
+        response = self.client.get(reverse('browse'), {'size': 'S'})
+        facets = response.context['facets']
+        sizes = {option['value']: option['count'] for option in facets['size']}
+        self.assertEqual((sizes['S'], sizes['M'], sizes['L'], sizes['XL']), (1, 1, 1, 0))
+        categories = {option['value']: option['count'] for option in facets['category']}
+        self.assertEqual(categories['Tops'], 1)
+
+
+class BrowseSearchTestCase(TestCase):
+    def setUp(self):
+        make_google_app()
+        librarian = make_librarian()
+        self.jacket, self.shirt, self.boots = make_items(librarian, 3)
+        self.jacket.name = 'Denim Jacket'
+        self.jacket.save()
+        self.shirt.description = 'Goes well with a jacket'
+        self.shirt.save()
+        outerwear = Category.objects.create(name='Outerwear')
+        self.boots.categories.add(outerwear)
+
+    def search(self, query):
+        response = self.client.get(reverse('browse'), {'q': query})
+        return [item.id for item in response.context['items']]
+
+    def test_name_matches_rank_above_description_matches(self):
+        self.assertEqual(self.search('jacket'), [self.jacket.id, self.shirt.id])
+
+    def test_index_follows_category_changes(self):
+        self.assertEqual(self.search('outerwear'), [self.boots.id])
+        Category.objects.filter(name='Outerwear').get().delete()
+        self.assertEqual(self.search('outerwear'), [])
+
+    def test_index_survives_the_item_table_being_rebuilt(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest("Only the SQLite index lives outside the item row")
+        self.jacket.delete()
+        # What a table rebuild (AddField, VACUUM) does to rowids
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE clothing_lending_item SET rowid = rowid - 1")
+        self.assertEqual(self.search('goes'), [self.shirt.id])
+        self.assertEqual(self.search('outerwear'), [self.boots.id])
+        self.assertEqual(self.search('denim'), [])
+
+
+class PresignedUrlBatchTestCase(TestCase):
+    def test_signs_every_requested_image_in_one_response(self):
+        librarian = make_librarian()
+        with_image, without_image = make_items(librarian, 2)
+        with_image.s3_image_key = 'items/test.jpg'
+        with_image.save()
+
+        response = self.client.get(reverse('get_presigned_urls'), {'ids': f'{with_image.id},{without_image.id},junk'})
+        data = response.json()
+        self.assertTrue(data['success'])
+        self.assertEqual(list(data['urls']), [str(with_image.id)])
+        self.assertIn('items/test.jpg', data['urls'][str(with_image.id)])
+
+
+class PresignedUrlCacheTestCase(TestCase):
+    def test_reuses_url_until_refresh_margin(self):
+        cache = PresignedUrlCache(max_size=10, refresh_margin=600)
+        calls = []
+
+        def sign():
+            calls.append(1)
+            return f'https://example.com/{len(calls)}'
+
+        self.assertEqual(cache.get_or_sign('a', 3600, sign), 'https://example.com/1')
+        self.assertEqual(cache.get_or_sign('a', 3600, sign), 'https://example.com/1')
+        # A URL with less than the margin left is reissued
+        self.assertEqual(cache.get_or_sign('b', 300, sign), 'https://example.com/2')
+        self.assertEqual(cache.get_or_sign('b', 300, sign), 'https://example.com/3')
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_concurrent_misses_sign_once(self):
+        cache = PresignedUrlCache()
+        calls = []
+
+        def sign():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'https://example.com/url'
+
+        threads = [threading.Thread(target=cache.get_or_sign, args=('key', 3600, sign)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+
+
+class S3HealthTestCase(TestCase):
+    def setUp(self):
+        s3_utils._s3_health_checked_at = None
+
+    def tearDown(self):
+        s3_utils._s3_health_checked_at = None
+
+    def test_check_runs_at_most_once_per_interval(self):
+        with mock.patch.object(s3_utils, 'check_aws_credentials', return_value={'success': True}) as check:
+            s3_utils.get_s3_health()
+            s3_utils.get_s3_health()
+        self.assertEqual(check.call_count, 1)
+
+    def test_upload_fails_fast_when_unhealthy(self):
+        unhealthy = {'success': False, 'error': 'bad credentials'}
+        with mock.patch.object(s3_utils, 'check_aws_credentials', return_value=unhealthy), \
+                mock.patch.object(s3_utils, 'get_s3_client') as get_client:
+            self.assertIsNone(s3_utils.upload_file_to_s3(mock.Mock(name='file'), object_name='items/x.jpg'))
+        get_client.assert_not_called()
+
+
+@override_settings(AWS_S3_MULTIPART_THRESHOLD=16 * 1024 * 1024, AWS_S3_MULTIPART_CHUNKSIZE=8 * 1024 * 1024,
+                   AWS_S3_MAX_CONCURRENCY=4)
+class UploadStreamingTestCase(TestCase):
+    def tearDown(self):
+        s3_utils.reset_s3_client()
+
+    def test_memory_bound_follows_transfer_settings(self):
+        config = s3_utils.get_transfer_config()
+        self.assertEqual((config.max_concurrency, config.max_in_memory_upload_chunks), (4, 4))
+        mb = 1024 * 1024
+        # Images go up in one streamed PutObject
+        self.assertEqual(s3_utils.upload_memory_bound(10 * mb), 0)
+        self.assertEqual(s3_utils.upload_memory_bound(20 * mb), 24 * mb)
+        self.assertEqual(s3_utils.upload_memory_bound(500 * mb), 40 * mb)
+
+    def test_upload_uses_transfer_config(self):
+        upload = SimpleUploadedFile('coat.png', b'png', content_type='image/png')
+        with mock.patch.object(s3_utils, 'get_s3_health', return_value={'success': True}), \
+                mock.patch.object(s3_utils, 'get_s3_client') as get_client:
+            s3_utils.upload_file_to_s3(upload, object_name='items/x.png')
+        config = get_client.return_value.upload_fileobj.call_args.kwargs['Config']
+        self.assertEqual(config.multipart_threshold, 16 * 1024 * 1024)
+
+    def test_spooled_upload_is_moved_not_copied(self):
+        content = os.urandom(4096)
+        upload = TemporaryUploadedFile('big.png', 'image/png', len(content), None)
+        upload.write(content)
+        upload.seek(0)
+        spooled_path = upload.temporary_file_path()
+        stashed = jobs.stash_upload(upload)
+        upload.close()
+        self.assertFalse(os.path.exists(spooled_path))
+        with open(stashed['path'], 'rb') as f:
+            self.assertEqual(f.read(), content)
+        jobs.discard_upload(stashed['path'])
+
+    def test_benchmark_runs_against_stand_in(self):
+        out = io.StringIO()
+        call_command('benchmark_uploads', sizes='0.1,20', repeat=1, stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Uploading to http://127.0.0.1:'))
+        self.assertEqual(len([line for line in lines if 'before' in line or 'current' in line]), 4)
+        self.assertIn('Stand-in received', lines[-1])
+
+
+class PatronVisibilityTestCase(TestCase):
+    def setUp(self):
+        make_google_app()
+        librarian = make_librarian()
+        self.public_item, self.private_item = make_items(librarian, 2)
+        user = User.objects.create_user(username='patron', email='patron@example.com', password='pw', user_type=2)
+        self.patron = Patron.objects.get(user=user)
+        self.collection = Collection.objects.create(
+            name='Private', description='Members only', created_by=librarian.user, is_private=True
+        )
+        self.private_item.collections.add(self.collection)
+        self.client.force_login(user)
+
+    def browse_ids(self):
+        return {item.id for item in self.client.get(reverse('browse')).context['items']}
+
+    def test_access_follows_allowed_patrons(self):
+        self.assertEqual(self.browse_ids(), {self.public_item.id})
+        self.collection.allowed_patrons.add(self.patron)
+        self.assertEqual(self.browse_ids(), {self.public_item.id, self.private_item.id})
+        self.patron.allowed_collections.remove(self.collection)
+        self.assertEqual(self.browse_ids(), {self.public_item.id})
+
+    def test_access_follows_collection_membership(self):
+        self.collection.allowed_patrons.add(self.patron)
+        self.collection.items.clear()
+        self.assertFalse(PatronItemAccess.objects.exists())
+        self.collection.items.add(self.public_item)
+        self.assertTrue(PatronItemAccess.objects.filter(patron=self.patron, item=self.public_item).exists())
+        self.collection.delete()
+        self.assertFalse(PatronItemAccess.objects.exists())
+
+    def test_item_in_two_private_collections_needs_access_to_both(self):
+        other = Collection.objects.create(name='Staff', description='Staff only',
+                                          created_by=self.collection.created_by, is_private=True)
+        self.private_item.collections.add(other)
+        self.collection.allowed_patrons.add(self.patron)
+        self.assertEqual(self.browse_ids(), {self.public_item.id})
+        self.assertFalse(self.client.get(reverse('item_detail', args=[self.private_item.id])).context['canview'])
+        other.allowed_patrons.add(self.patron)
+        self.assertEqual(self.browse_ids(), {self.public_item.id, self.private_item.id})
+        other.is_private = False
+        other.save()
+        self.collection.allowed_patrons.remove(self.patron)
+        self.assertEqual(self.browse_ids(), {self.public_item.id})
+
+
+class ItemPrivacyTestCase(TestCase):
+    def setUp(self):
+        librarian = make_librarian()
+        self.items = make_items(librarian, 3)
+        self.collection = Collection.objects.create(
+            name='Private', description='Members only', created_by=librarian.user, is_private=False
+        )
+        self.collection.items.add(*self.items)
+
+    def private_ids(self):
+        return set(Item.objects.filter(private_collection=True).values_list('id', flat=True))
+
+    def test_flag_follows_collection_privacy_and_membership(self):
+        self.assertEqual(self.private_ids(), set())
+        self.collection.is_private = True
+        self.collection.save()
+        self.assertEqual(self.private_ids(), {item.id for item in self.items})
+        self.collection.items.remove(self.items[0])
+        self.assertEqual(self.private_ids(), {item.id for item in self.items[1:]})
+        self.items[1].collections.clear()
+        self.assertFalse(self.items[1].private_collection)
+        self.assertEqual(self.private_ids(), {self.items[2].id})
+        self.collection.delete()
+        self.assertEqual(self.private_ids(), set())
+
+    def test_reconcile_repairs_drift(self):
+        Item.objects.filter(pk=self.items[0].pk).update(private_collection=True)
+        self.assertEqual(reconcile_item_privacy(dry_run=True), (0, 1))
+        self.assertEqual(reconcile_item_privacy(), (0, 1))
+        self.assertEqual(self.private_ids(), set())
+
+
+class BrowseQueryCountTestCase(TestCase):
+    def setUp(self):
+        make_google_app()
+        self.librarian = make_librarian()
+        self.categories = [Category.objects.create(name=f'Category {i}') for i in range(4)]
+        Collection.objects.create(name='Public', description='Open', created_by=self.librarian.user)
+
+    def add_items(self, count):
+        for item in make_items(self.librarian, count):
+            item.categories.add(*self.categories)
+
+    def browse_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('browse'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_query_count_does_not_grow_with_items(self):
+        self.add_items(2)
+        small_page = self.browse_queries()
+        self.add_items(20)
+        self.assertEqual(self.browse_queries(), small_page)
+        self.assertContains(self.client.get(reverse('browse')), '+2 more')
+
+
+class LibrarianDashboardTestCase(TestCase):
+    def setUp(self):
+        self.librarian = make_librarian()
+        user = User.objects.create_user(username='borrower', email='borrower@example.com', password='pw', user_type=2)
+        self.patron = Patron.objects.get(user=user)
+        self.category = Category.objects.create(name='Coats')
+        self.client.force_login(self.librarian.user)
+
+    def add_lendings(self, count):
+        now = timezone.now()
+        items = make_items(self.librarian, 2 * count)
+        for i, (requested, lent) in enumerate(zip(items[::2], items[1::2])):
+            requested.categories.add(self.category)
+            lent.categories.add(self.category)
+            Lending.objects.create(item=requested, borrower=self.patron, status='PENDING', request_date=now)
+            Lending.objects.create(item=lent, borrower=self.patron, status='APPROVED', approved_date=now,
+                                   return_requested=bool(i % 2))
+
+    def dashboard_queries(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('librarian_page'), params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_query_count_does_not_grow_with_lendings(self):
+        self.add_lendings(2)
+        _, small = self.dashboard_queries()
+        self.add_lendings(30)
+        _, large = self.dashboard_queries()
+        self.assertEqual(large, small)
+
+    def test_only_librarians_see_the_dashboard(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('librarian_page')).status_code, 302)
+        self.client.force_login(self.patron.user)
+        self.assertEqual(self.client.get(reverse('librarian_page')).status_code, 302)
+
+    def test_items_and_collections_are_paginated(self):
+        make_items(self.librarian, 25)
+        for i in range(21):
+            Collection.objects.create(name=f'Collection {i}', created_by=self.librarian.user)
+        first, _ = self.dashboard_queries()
+        self.assertEqual((len(first.context['recent_items']), first.context['recent_items'].count), (20, 25))
+        self.assertEqual(len(first.context['collections']), 20)
+        second, _ = self.dashboard_queries(items_page=2, collections_page=2)
+        self.assertEqual(len(second.context['recent_items']), 5)
+        self.assertEqual(len(second.context['collections']), 1)
+
+    def test_sections_are_paginated_independently(self):
+        self.add_lendings(30)
+        views.DASHBOARD_PAGE_SIZE, old_size = 20, views.DASHBOARD_PAGE_SIZE
+        try:
+            first, _ = self.dashboard_queries()
+            second, _ = self.dashboard_queries(pending_page=2)
+        finally:
+            views.DASHBOARD_PAGE_SIZE = old_size
+        self.assertEqual(len(first.context['pending_requests']), 20)
+        self.assertEqual(first.context['pending_requests'].count, 30)
+        self.assertEqual(len(second.context['pending_requests']), 10)
+        self.assertEqual(len(second.context['active_lendings']), 15)
+        self.assertEqual(len(second.context['returns_requested']), 15)
+        seen = [l.id for l in first.context['pending_requests']] + [l.id for l in second.context['pending_requests']]
+        self.assertEqual(sorted(seen), sorted(Lending.objects.filter(status='PENDING').values_list('id', flat=True)))
+
+
+class PatronDashboardTestCase(TestCase):
+    def setUp(self):
+        librarian = make_librarian()
+        self.item = make_items(librarian, 1)[0]
+        self.item.categories.add(Category.objects.create(name='Coats'))
+        user = User.objects.create_user(username='patron', email='patron@example.com', password='pw', user_type=2)
+        self.patron = Patron.objects.get(user=user)
+        collection = Collection.objects.create(name='Shared', description='Shared', created_by=user, is_private=True)
+        collection.allowed_patrons.add(self.patron)
+        self.client.force_login(user)
+
+    def add_history(self, count):
+        for i in range(count):
+            Lending.objects.create(item=self.item, borrower=self.patron, status='RETURNED' if i % 2 else 'REJECTED')
+
+    def get_page(self, url=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url or reverse('patron_page'))
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_history_pages_back_in_constant_queries(self):
+        self.add_history(3)
+        _, small = self.get_page()
+        self.add_history(40)
+        response, large = self.get_page()
+        self.assertEqual(large, small)
+        self.assertEqual(len(response.context['collections']), 1)
+
+        seen = []
+        while response:
+            seen.extend(l.id for l in response.context['borrowing_history'])
+            seen.extend(l.id for l in response.context['rejected_requests'])
+            next_url = response.context['history_next_url']
+            response = self.get_page(reverse('patron_page') + next_url)[0] if next_url else None
+        self.assertEqual(sorted(seen), sorted(Lending.objects.values_list('id', flat=True)))
+
+
+class RatingAggregateTestCase(TestCase):
+    def setUp(self):
+        make_google_app()
+        self.item = make_items(make_librarian(), 1)[0]
+        self.patrons = []
+        for i in range(2):
+            user = User.objects.create_user(username=f'rater{i}', email=f'rater{i}@example.com', password='pw', user_type=2)
+            self.patrons.append(user)
+
+    def rate(self, user, view, stars=None):
+        self.client.force_login(user)
+        data = {'num_rating': stars, 'comment': 'Nice'} if stars else {}
+        self.client.post(reverse(view, args=[self.item.id]), data)
+        self.item.refresh_from_db()
+
+    def test_views_keep_aggregates_in_step(self):
+        self.rate(self.patrons[0], 'rate_item', 5)
+        self.rate(self.patrons[1], 'rate_item', 2)
+        self.assertEqual((self.item.rating_count, self.item.rating_sum), (2, 7))
+        self.assertEqual(self.item.average_rating, 3.5)
+        self.rate(self.patrons[1], 'edit_rating', 4)
+        self.assertEqual((self.item.rating_2, self.item.rating_4, self.item.rating_sum), (0, 1, 9))
+        self.rate(self.patrons[0], 'delete_rating')
+        self.assertEqual((self.item.rating_count, self.item.rating_5, self.item.rating_sum), (1, 0, 4))
+
+        # Aggregates are read straight off the item row
+        with self.assertNumQueries(1):
+            item = Item.objects.get(pk=self.item.pk)
+            self.assertEqual(item.rating_histogram[1], {'stars': 4, 'count': 1, 'percent': 100})
+
+    def test_promoting_a_rater_removes_their_ratings(self):
+        other = make_items(Librarian.objects.get(), 1)[0]
+        self.rate(self.patrons[0], 'rate_item', 5)
+        self.rate(self.patrons[1], 'rate_item', 2)
+        self.client.force_login(self.patrons[0])
+        self.client.post(reverse('rate_item', args=[other.id]), {'num_rating': 4, 'comment': 'Nice'})
+
+        self.client.force_login(User.objects.get(username='librarian'))
+        self.client.post(reverse('promote_user'), {'email': self.patrons[0].email})
+        self.assertFalse(Patron.objects.filter(user=self.patrons[0]).exists())
+        self.item.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((self.item.rating_count, self.item.rating_sum, self.item.rating_5, self.item.rating_2), (1, 2, 0, 1))
+        self.assertEqual((other.rating_count, other.rating_sum, other.rating_4), (0, 0, 0))
+
+    def test_rebuild_repairs_drift(self):
+        self.rate(self.patrons[0], 'rate_item', 3)
+        Item.objects.filter(pk=self.item.pk).update(rating_count=9, rating_sum=0, rating_3=0)
+        rebuild_rating_aggregates()
+        self.item.refresh_from_db()
+        self.assertEqual((self.item.rating_count, self.item.rating_sum, self.item.rating_3), (1, 3, 1))
+
+
+class ItemReviewsTestCase(TestCase):
+    def setUp(self):
+        make_google_app()
+        self.item = make_items(make_librarian(), 1)[0]
+        now = timezone.now()
+        for i in range(25):
+            user = User.objects.create_user(username=f'reviewer{i}', email=f'r{i}@example.com', user_type=2)
+            Rating.objects.create(item=self.item, rater=user.patron, num_rating=4, comment=f'Review {i}',
+                                  rate_date=now - timedelta(minutes=i))
+
+    def test_first_page_is_inlined_and_rest_load_by_cursor(self):
+        views.REVIEW_PAGE_SIZE, old_size = 10, views.REVIEW_PAGE_SIZE
+        try:
+            response = self.client.get(reverse('item_detail', args=[self.item.id]))
+            self.assertEqual(len(response.context['ratings']), 10)
+            seen = [rating.comment for rating in response.context['ratings']]
+            url = response.context['next_reviews_url']
+            while url:
+                data = self.client.get(url + '&format=json').json()
+                seen.extend(review['comment'] for review in data['reviews'])
+                url = data['next_url']
+        finally:
+            views.REVIEW_PAGE_SIZE = old_size
+        self.assertEqual(seen, [f'Review {i}' for i in range(25)])
+
+    def test_fragment_links_to_next_page(self):
+        page = self.client.get(reverse('item_reviews', args=[self.item.id]))
+        self.assertContains(page, 'Review 0')
+        self.assertContains(page, 'data-next-url')
+
+    def test_tampered_cursor_is_rejected(self):
+        cursor = pagination.encode_cursor(['2024-01-01T00:00:00', 'not-a-uuid'])
+        response = self.client.get(reverse('item_reviews', args=[self.item.id]), {'cursor': cursor})
+        self.assertEqual(response.status_code, 400)
+
+    def test_one_review_per_patron(self):
+        rating = Rating.objects.first()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Rating.objects.create(item=self.item, rater=rating.rater, num_rating=1, comment='Again')
+
+
+class PermissionsTestCase(TestCase):
+    def setUp(self):
+        make_google_app()
+        librarian = make_librarian()
+        self.librarian_user = librarian.user
+        self.public_items = make_items(librarian, 3)
+        self.private_items = make_items(librarian, 3)
+        self.collections = []
+        for i in range(3):
+            collection = Collection.objects.create(
+                name=f'Private {i}', description='Members only', created_by=librarian.user, is_private=True
+            )
+            collection.items.add(self.private_items[i])
+            self.collections.append(collection)
+        self.user = User.objects.create_user(username='patron', email='patron@example.com', user_type=2)
+        self.collections[0].allowed_patrons.add(self.user.patron)
+        for item in self.private_items:
+            item.refresh_from_db()
+
+    def test_batches_cost_one_query_per_model(self):
+        from django.contrib.auth.models import AnonymousUser
+        objs = self.public_items + self.private_items + self.collections
+        with self.assertNumQueries(0):
+            self.assertEqual(permissions.can_view(self.librarian_user, objs), {obj.pk for obj in objs})
+        with self.assertNumQueries(0):
+            self.assertEqual(permissions.can_view(AnonymousUser(), objs), {item.pk for item in self.public_items})
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(3):  # patron row, then one query each for items and collections
+            visible = permissions.can_view(user, objs)
+        self.assertEqual(visible, {item.pk for item in self.public_items} | {self.private_items[0].pk, self.collections[0].pk})
+        self.assertFalse(permissions.can_view(user, self.private_items[1]))
+
+    def test_presigned_batch_skips_hidden_items(self):
+        Item.objects.update(s3_image_key='items/x.jpg')
+        ids = ','.join(str(item.id) for item in self.public_items + self.private_items)
+        urls = self.client.get(reverse('get_presigned_urls'), {'ids': ids}).json()['urls']
+        self.assertEqual(set(urls), {str(item.id) for item in self.public_items})
+
+
+class RequestBudgetTestCase(TestCase):
+    def setUp(self):
+        make_google_app()
+        make_items(make_librarian(), 3)
+
+    def test_server_timing_reports_request_costs(self):
+        response = self.client.get(reverse('browse'))
+        timing = dict(part.split(';', 1) for part in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timing), {'db', 's3', 'tpl', 'total'})
+        self.assertRegex(timing['db'], r'desc="[1-9]\d* queries"')
+
+    @override_settings(REQUEST_QUERY_BUDGETS={'browse': 1}, REQUEST_BUDGET_ACTION='raise')
+    def test_over_budget_view_raises(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get(reverse('browse'))
+
+    @override_settings(REQUEST_QUERY_BUDGETS={'browse': 1}, REQUEST_BUDGET_ACTION='warn')
+    def test_over_budget_view_warns(self):
+        with self.assertLogs('clothing_lending.requests', 'WARNING') as logs:
+            self.assertEqual(self.client.get(reverse('browse')).status_code, 200)
+        self.assertIn('over its budget of 1', logs.output[0])
+
+    def test_s3_calls_are_counted(self):
+        client = s3_utils.create_s3_client()
+        metrics, token = start_request_metrics()
+        with Stubber(client) as stubber:
+            stubber.add_response('head_object', {}, {'Bucket': 'b', 'Key': 'k'})
+            client.head_object(Bucket='b', Key='k')
+        finish_request_metrics(token)
+        self.assertEqual(metrics.s3_calls, 1)
+
+
+class FakeDataTestCase(TestCase):
+    def test_generated_library_is_consistent(self):
+        created = generate_fake_data(seed=1, **default_counts(200))
+        self.assertEqual(created, default_counts(200))
+        self.assertEqual(Item.objects.count(), 200)
+        self.assertEqual(Patron.objects.filter(user__username__startswith='fake-').count(), created['patrons'])
+        self.assertEqual(set(Lending.objects.values_list('status', flat=True)),
+                         {'PENDING', 'APPROVED', 'RETURNED', 'REJECTED'})
+        open_lendings = (Lending.objects.filter(status__in=['PENDING', 'APPROVED'])
+                         .values('item').annotate(n=Count('id')))
+        self.assertTrue(all(row['n'] == 1 for row in open_lendings))
+        self.assertFalse(Item.objects.filter(available=False).exclude(lending__status__in=['PENDING', 'APPROVED']).exists())
+        self.assertEqual(reconcile_item_privacy(dry_run=True), (0, 0))
+        item = Item.objects.order_by('-rating_count').first()
+        self.assertEqual(item.rating_count, Rating.objects.filter(item=item).count())
+
+    def test_same_seed_gives_same_catalog(self):
+        generate_fake_data(seed=3, **default_counts(50))
+        first = list(Item.objects.order_by('name', 'size', 'condition').values_list('name', 'size', 'condition'))
+        self.assertEqual(delete_fake_data(), default_counts(50)['librarians'] + default_counts(50)['patrons'])
+        self.assertFalse(Item.objects.exists())
+        generate_fake_data(seed=3, **default_counts(50))
+        second = list(Item.objects.order_by('name', 'size', 'condition').values_list('name', 'size', 'condition'))
+        self.assertEqual(first, second)
+
+    def test_benchmarks_record_and_compare_results(self):
+        make_google_app()
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'results.json')
+            call_command('run_benchmarks', scales='100', repeat=2, output=output, stdout=io.StringIO())
+            with open(output) as f:
+                results = json.load(f)['results']['100']
+            self.assertEqual(set(results), {'browse', 'item_detail', 'collection_detail', 'librarian_page',
+                                            'patron_page', 'borrow_cycle'})
+            self.assertTrue(all(page['queries'] for page in results.values()))
+            call_command('run_benchmarks', scales='100', repeat=2, compare=output, stdout=io.StringIO())
+        # Every scale is rolled back
+        self.assertFalse(Item.objects.exists())
+
+
+def make_image(width, height, fmt='PNG', mode='RGBA'):
+    buffer = io.BytesIO()
+    Image.new(mode, (width, height), (200, 30, 30, 128) if mode == 'RGBA' else 'red').save(buffer, fmt)
+    buffer.seek(0)
+    return buffer
+
+
+class ImageVariantTestCase(TestCase):
+    def setUp(self):
+        storage.reset_storage()
+
+    def test_renders_each_width_and_format_without_upscaling(self):
+        variants = images.render_variants(make_image(2000, 1000))
+        self.assertEqual(sorted((w, fmt) for w, fmt, data in variants),
+                         [(w, fmt) for w in (200, 600, 1200) for fmt in ('jpeg', 'webp')])
+        for width, fmt, data in variants:
+            with Image.open(io.BytesIO(data)) as image:
+                self.assertEqual(image.size, (width, width // 2))
+                self.assertEqual(image.format, 'WEBP' if fmt == 'webp' else 'JPEG')
+
+        small = images.render_variants(make_image(300, 300, 'JPEG', 'RGB'))
+        self.assertEqual(sorted({w for w, fmt, data in small}), [200, 300])
+
+    def test_add_item_uploads_variants(self):
+        make_librarian()
+        self.client.force_login(User.objects.get(username='librarian'))
+        upload = SimpleUploadedFile('coat.png', make_image(1600, 1200).read(), content_type='image/png')
+        self.client.post(reverse('add_item'), {
+            'name': 'Coat', 'description': 'Warm', 'size': 'M', 'condition': 'good', 'image': upload,
+        })
+        item = Item.objects.get(name='Coat')
+        base = item.s3_image_key[:-len('.png')]
+        self.assertEqual(item.image_variants['webp'], {
+            '200': f'{base}_w200.webp', '600': f'{base}_w600.webp', '1200': f'{base}_w1200.webp',
+        })
+        self.assertEqual(item.image_variants['jpeg']['600'], f'{base}_w600.jpg')
+        stored = storage.get_storage()
+        self.assertEqual(len(stored.keys()), 7)
+        self.assertEqual(stored.info(f'{base}_w600.webp')['content_type'], 'image/webp')
+
+    def test_presigned_batch_returns_srcsets(self):
+        item, plain = make_items(make_librarian(), 2, s3_image_key='items/abc.png')
+        item.image_variants = {fmt: {str(w): images.variant_key('items/abc.png', w, fmt) for w in (200, 600, 1200)}
+                               for fmt in ('webp', 'jpeg')}
+        item.save()
+        sign = lambda key, **kwargs: f'https://signed/{key}'
+        with mock.patch.object(storage.InMemoryStorage, 'signed_url', side_effect=sign):
+            data = self.client.get(reverse('get_presigned_urls'), {'ids': f'{item.id},{plain.id}'}).json()
+        self.assertEqual(data['urls'][str(item.id)], 'https://signed/items/abc_w600.jpg')
+        self.assertEqual(data['urls'][str(plain.id)], 'https://signed/items/abc.png')
+        self.assertEqual(data['srcsets'][str(item.id)]['webp'], ', '.join(
+            f'https://signed/items/abc_w{w}.webp {w}w' for w in (200, 600, 1200)
+        ))
+        self.assertNotIn(str(plain.id), data['srcsets'])
+
+
+def pending_deletions():
+    return sorted(PendingDeletion.objects.values_list('key', flat=True))
+
+
+flaky_calls = []
+
+
+@jobs.job('test_flaky', on_dead=lambda **payload: flaky_calls.append(('dead', payload)))
+def flaky_job(fail_times):
+    flaky_calls.append('run')
+    if flaky_calls.count('run') <= fail_times:
+        raise RuntimeError('S3 timed out')
+
+
+@override_settings(JOB_RUNNER='worker', JOB_MAX_ATTEMPTS=3)
+class JobTestCase(TestCase):
+    def setUp(self):
+        flaky_calls.clear()
+        storage.reset_storage()
+
+    def run_again(self, job):
+        # Skip the backoff wait
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        return jobs.run_job(job.pk)
+
+    def test_failed_jobs_retry_with_backoff_then_die(self):
+        job = jobs.enqueue('test_flaky', fail_times=5)
+        self.assertEqual(Job.objects.get(pk=job.pk).status, 'PENDING')
+        self.assertEqual(jobs.run_job(job.pk), 'retry')
+        job.refresh_from_db()
+        self.assertEqual(job.attempts, 1)
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIn('S3 timed out', job.last_error)
+        # Not due yet
+        self.assertIsNone(jobs.run_job(job.pk))
+
+        self.assertEqual(self.run_again(job), 'retry')
+        self.assertEqual(self.run_again(job), 'dead')
+        self.assertEqual(Job.objects.get(pk=job.pk).status, 'DEAD')
+        self.assertEqual(flaky_calls[-1], ('dead', {'fail_times': 5}))
+
+        self.assertEqual(jobs.retry_dead_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('PENDING', 0))
+
+    def test_job_succeeds_after_retry(self):
+        job = jobs.enqueue('test_flaky', fail_times=1)
+        self.assertEqual(jobs.run_due_jobs(), 1)
+        self.assertEqual(self.run_again(job), 'done')
+        self.assertEqual(Job.objects.get(pk=job.pk).status, 'DONE')
+
+    def test_running_job_is_not_run_twice(self):
+        job = jobs.enqueue('test_flaky', fail_times=0)
+        Job.objects.filter(pk=job.pk).update(status='RUNNING', locked_at=timezone.now())
+        self.assertIsNone(jobs.run_job(job.pk))
+        self.assertEqual(jobs.release_stale_jobs(), 0)
+        Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(jobs.release_stale_jobs(), 1)
+        self.assertEqual(jobs.run_job(job.pk), 'done')
+
+    @override_settings(JOB_RUNNER='thread')
+    def test_sweeper_submits_jobs_a_stopped_process_left_behind(self):
+        queued = Job.objects.create(kind='test_flaky', payload={'fail_times': 0})
+        retrying = Job.objects.create(kind='test_flaky', payload={'fail_times': 0},
+                                      run_after=timezone.now() + timedelta(minutes=5))
+        abandoned = Job.objects.create(kind='test_flaky', payload={'fail_times': 0}, status='RUNNING',
+                                       locked_at=timezone.now() - timedelta(hours=1))
+        with mock.patch.object(jobs, '_submit') as submit:
+            self.assertEqual(jobs.sweep_jobs(), 2)
+        self.assertEqual(sorted(call.args[0] for call in submit.call_args_list), sorted([queued.pk, abandoned.pk]))
+
+        Job.objects.filter(pk=retrying.pk).update(run_after=timezone.now())
+        with mock.patch.object(jobs, '_submit') as submit:
+            jobs.sweep_jobs()
+        self.assertIn(mock.call(retrying.pk), submit.call_args_list)
+
+    def test_edit_item_saves_immediately_and_job_swaps_image(self):
+        librarian = make_librarian()
+        item = make_items(librarian, 1, s3_image_key='items/old.png', image_status='READY',
+                          image_variants={'jpeg': {'200': 'items/old_w200.jpg'}})[0]
+        self.client.force_login(librarian.user)
+        upload = SimpleUploadedFile('coat.png', make_image(100, 100).read(), content_type='image/png')
+        self.client.post(reverse('edit_item', args=[item.id]), {
+            'name': 'Renamed', 'description': 'Warm', 'size': 'M', 'condition': 'good', 'image': upload,
+        })
+        item.refresh_from_db()
+        self.assertEqual((item.name, item.image_status, item.s3_image_key), ('Renamed', 'PROCESSING', 'items/old.png'))
+
+        stored = storage.get_storage()
+        stored.save('items/old.png', io.BytesIO(b'old'))
+        upload_job = Job.objects.get(kind='upload_item_image')
+        self.assertEqual(jobs.run_job(upload_job.pk), 'done')
+        item.refresh_from_db()
+        self.assertEqual(item.image_status, 'READY')
+        self.assertEqual(stored.info(item.s3_image_key)['content_type'], 'image/png')
+        self.assertFalse(os.path.exists(upload_job.payload['path']))
+
+        self.assertEqual(pending_deletions(), ['items/old.png', 'items/old_w200.jpg'])
+        flush_job = Job.objects.get(kind='flush_s3_deletions')
+        self.assertEqual(jobs.run_job(flush_job.pk), 'done')
+        self.assertIsNone(stored.info('items/old.png'))
+        self.assertEqual(pending_deletions(), [])
+
+    def test_upload_that_keeps_failing_marks_image_failed(self):
+        librarian = make_librarian()
+        self.client.force_login(librarian.user)
+        upload = SimpleUploadedFile('coat.png', make_image(100, 100).read(), content_type='image/png')
+        self.client.post(reverse('add_item'), {
+            'name': 'Coat', 'description': 'Warm', 'size': 'M', 'condition': 'good', 'image': upload,
+        })
+        upload_job = Job.objects.get(kind='upload_item_image')
+        failure = storage.StorageError('S3 timed out')
+        with mock.patch.object(storage.InMemoryStorage, 'save', side_effect=failure):
+            results = [self.run_again(upload_job) for _ in range(3)]
+        self.assertEqual(results, ['retry', 'retry', 'dead'])
+        self.assertEqual(Item.objects.get(name='Coat').image_status, 'FAILED')
+        self.assertFalse(os.path.exists(upload_job.payload['path']))
+
+    def test_failed_attempt_queues_the_image_it_saved_for_deletion(self):
+        librarian = make_librarian()
+        self.client.force_login(librarian.user)
+        upload = SimpleUploadedFile('coat.png', make_image(100, 100).read(), content_type='image/png')
+        self.client.post(reverse('add_item'), {
+            'name': 'Coat', 'description': 'Warm', 'size': 'M', 'condition': 'good', 'image': upload,
+        })
+        upload_job = Job.objects.get(kind='upload_item_image')
+        with mock.patch.object(tasks, '_attach_item_image', side_effect=RuntimeError('Database went away')):
+            self.assertEqual(self.run_again(upload_job), 'retry')
+        saved = [key for key in storage.get_storage().keys() if key.startswith('items/')]
+        self.assertTrue(saved)
+        self.assertEqual(pending_deletions(), saved)
+
+        self.assertEqual(self.run_again(upload_job), 'done')
+        item = Item.objects.get(name='Coat')
+        self.assertEqual(item.image_status, 'READY')
+        self.assertNotIn(item.s3_image_key, pending_deletions())
+
+    def test_profile_picture_upload_that_keeps_failing_is_discarded(self):
+        user = User.objects.create(username='patron', user_type=2)
+        self.client.force_login(user)
+        upload = SimpleUploadedFile('me.png', make_image(50, 50).read(), content_type='image/png')
+        self.client.post(reverse('update_patron_profile'), {'custom_username': 'me', 'profile_picture': upload})
+        upload_job = Job.objects.get(kind='upload_profile_picture')
+        failure = storage.StorageError('S3 timed out')
+        with mock.patch.object(storage.InMemoryStorage, 'save', side_effect=failure):
+            results = [self.run_again(upload_job) for _ in range(3)]
+        self.assertEqual(results, ['retry', 'retry', 'dead'])
+        self.assertFalse(os.path.exists(upload_job.payload['path']))
+
+    def test_profile_picture_uploads_in_background(self):
+        user = User.objects.create(username='patron', user_type=2)
+        patron = Patron.objects.get(user=user)
+        self.client.force_login(user)
+        Patron.objects.filter(pk=patron.pk).update(s3_profile_picture_key='profile_pics/old.png', profile_picture='https://old')
+        upload = SimpleUploadedFile('me.png', make_image(50, 50).read(), content_type='image/png')
+        self.client.post(reverse('update_patron_profile'), {'custom_username': 'me', 'profile_picture': upload})
+        patron.refresh_from_db()
+        self.assertEqual((patron.custom_username, patron.profile_picture), ('me', 'https://old'))
+
+        self.assertEqual(jobs.run_due_jobs(), 1)
+        patron.refresh_from_db()
+        self.assertRegex(patron.s3_profile_picture_key, rf'^profile_pics/{user.id}/[0-9a-f-]{{36}}_me\.png$')
+        self.assertEqual(patron.profile_picture, storage.get_storage().url(patron.s3_profile_picture_key))
+        self.assertEqual(pending_deletions(), ['profile_pics/old.png'])
+
+
+@override_settings(JOB_RUNNER='worker')
+class DirectUploadTestCase(TestCase):
+    def setUp(self):
+        storage.reset_storage()
+        self.s3_client = boto3.client('s3', region_name='us-east-1',
+                                      aws_access_key_id='test', aws_secret_access_key='test')
+
+    def presign(self, **data):
+        with mock.patch.object(s3_utils, 'get_s3_client', return_value=self.s3_client):
+            return self.client.post(reverse('presign_upload'), data)
+
+    def store(self, key, size=1000):
+        storage.get_storage().save(key, io.BytesIO(b'x' * size), content_type='image/png')
+
+    @override_settings(STORAGE_BACKEND='clothing_lending.storage.S3Storage')
+    def test_presigned_post_limits_key_type_and_size(self):
+        self.client.force_login(make_librarian().user)
+        response = self.presign(kind='item', filename='coat.PNG', content_type='image/png', size=1000)
+        data = response.json()
+        self.assertRegex(data['key'], r'^items/[0-9a-f-]{36}\.png$')
+        self.assertEqual(data['fields']['key'], data['key'])
+        self.assertEqual(data['token'], forms.sign_upload_key(data['key']))
+        policy = json.loads(base64.b64decode(data['fields']['policy']))
+        self.assertIn(['content-length-range', 1, images.MAX_IMAGE_SIZE], policy['conditions'])
+        self.assertIn({'Content-Type': 'image/png'}, policy['conditions'])
+
+        self.assertEqual(self.presign(kind='item', filename='a.txt', content_type='text/plain', size=10).status_code, 400)
+        self.assertEqual(self.presign(kind='item', filename='a.png', content_type='image/png',
+                                      size=images.MAX_IMAGE_SIZE + 1).status_code, 400)
+
+    def test_patrons_only_presign_profile_pictures(self):
+        user = User.objects.create(username='patron', user_type=2)
+        self.client.force_login(user)
+        self.assertEqual(self.presign(kind='item', filename='a.png', content_type='image/png', size=10).status_code, 403)
+        data = self.presign(kind='profile', filename='me.png', content_type='image/png', size=10).json()
+        self.assertTrue(data['key'].startswith(f'profile_pics/{user.id}/'))
+
+    def test_add_item_with_uploaded_key_resizes_in_background(self):
+        self.client.force_login(make_librarian().user)
+        stored = storage.get_storage()
+        stored.save('items/abc.png', make_image(1600, 800), content_type='image/png')
+        self.client.post(reverse('add_item'), {
+            'name': 'Coat', 'description': 'Warm', 'size': 'M', 'condition': 'good',
+            'uploaded_key': forms.sign_upload_key('items/abc.png'),
+        })
+        item = Item.objects.get(name='Coat')
+        self.assertEqual(item.image_status, 'PROCESSING')
+        process_job = Job.objects.get(kind='process_item_image')
+        self.assertEqual(process_job.payload, {'item_id': str(item.id), 'key': 'items/abc.png'})
+
+        self.assertEqual(jobs.run_job(process_job.pk), 'done')
+        item.refresh_from_db()
+        self.assertEqual((item.image_status, item.s3_image_key), ('READY', 'items/abc.png'))
+        self.assertEqual(item.image_url, stored.url('items/abc.png'))
+        self.assertEqual(item.image_variants['jpeg']['600'], 'items/abc_w600.jpg')
+        self.assertEqual(len(stored.keys()), 7)
+
+    def test_uploaded_key_is_checked(self):
+        self.client.force_login(make_librarian().user)
+        item_data = {'name': 'Coat', 'description': 'Warm', 'size': 'M', 'condition': 'good'}
+        response = self.client.post(reverse('add_item'), {**item_data, 'uploaded_key': forms.sign_upload_key('items/missing.png')})
+        self.assertContains(response, 'could not be found')
+        self.store('profile_pics/1/a.png', size=10)
+        response = self.client.post(reverse('add_item'), {**item_data, 'uploaded_key': forms.sign_upload_key('profile_pics/1/a.png')})
+        self.assertContains(response, 'Invalid upload')
+        self.assertFalse(Item.objects.exists())
+
+    def test_only_issued_keys_are_accepted(self):
+        librarian = make_librarian()
+        other = make_items(librarian, 1, s3_image_key='items/other.png', image_status='READY',
+                           image_variants={'jpeg': {'600': 'items/other_w600.jpg'}})[0]
+        self.store('items/other_w600.jpg')
+        self.client.force_login(librarian.user)
+        item_data = {'name': 'Coat', 'description': 'Warm', 'size': 'M', 'condition': 'good'}
+        for key in ('items/other_w600.jpg', forms.sign_upload_key('items/other_w600.jpg') + 'x'):
+            response = self.client.post(reverse('add_item'), {**item_data, 'uploaded_key': key})
+            self.assertContains(response, 'Invalid upload')
+        response = self.client.post(reverse('edit_item', args=[other.id]), {**item_data, 'uploaded_key': 'items/other_w600.jpg'})
+        self.assertContains(response, 'Invalid upload')
+        self.assertFalse(Item.objects.filter(name='Coat').exists())
+
+    def test_profile_uploaded_key_replaces_picture(self):
+        user = User.objects.create(username='patron', user_type=2)
+        patron = Patron.objects.get(user=user)
+        self.client.force_login(user)
+        Patron.objects.filter(pk=patron.pk).update(s3_profile_picture_key='profile_pics/old.png', profile_picture='https://old')
+        key = f'profile_pics/{user.id}/new.png'
+        self.store(key, size=10)
+        self.client.post(reverse('update_patron_profile'), {'custom_username': 'me', 'uploaded_key': forms.sign_upload_key(key)})
+        patron.refresh_from_db()
+        self.assertEqual(patron.s3_profile_picture_key, key)
+        self.assertEqual(patron.profile_picture, storage.get_storage().url(key))
+        self.assertEqual(pending_deletions(), ['profile_pics/old.png'])
+
+
+@override_settings(JOB_RUNNER='worker')
+class DeletionQueueTestCase(TestCase):
+    def setUp(self):
+        storage.reset_storage()
+
+    @override_settings(STORAGE_BACKEND='clothing_lending.storage.S3Storage')
+    def test_deletes_are_flushed_in_batches(self):
+        keys = [f'items/{i:04}.png' for i in range(2500)]
+        deletions.schedule_s3_deletion(keys)
+        deletions.schedule_s3_deletion(keys[:10])
+        self.assertEqual(PendingDeletion.objects.count(), 2500)
+        flush_job = Job.objects.get(kind='flush_s3_deletions')
+
+        s3_client = mock.Mock()
+        s3_client.delete_objects.side_effect = lambda Bucket, Delete: {
+            'Errors': [{'Key': 'items/0007.png', 'Code': 'AccessDenied', 'Message': 'Access Denied'}]
+            if Delete['Objects'][0]['Key'] == 'items/0000.png' else []
+        }
+        with mock.patch.object(s3_utils, 'get_s3_client', return_value=s3_client):
+            self.assertEqual(jobs.run_job(flush_job.pk), 'retry')
+        self.assertEqual([len(call.kwargs['Delete']['Objects']) for call in s3_client.delete_objects.call_args_list],
+                         [1000, 1000, 500])
+        failed = PendingDeletion.objects.get()
+        self.assertEqual((failed.key, failed.attempts, failed.last_error), ('items/0007.png', 1, 'AccessDenied: Access Denied'))
+
+    def test_cascaded_deletes_queue_images(self):
+        librarian = make_librarian()
+        make_items(librarian, 1, s3_image_key='items/a.png', image_variants={'jpeg': {'200': 'items/a_w200.jpg'}})
+        patron_user = User.objects.create(username='patron', user_type=2)
+        Patron.objects.filter(user=patron_user).update(s3_profile_picture_key='profile_pics/me.png')
+        with mock.patch.object(s3_utils, 'get_s3_client') as get_client:
+            librarian.user.delete()
+            patron_user.delete()
+            get_client.assert_not_called()
+        self.assertEqual(pending_deletions(), ['items/a.png', 'items/a_w200.jpg', 'profile_pics/me.png'])
+        self.assertEqual(Job.objects.filter(kind='flush_s3_deletions').count(), 1)
+
+    @override_settings(JOB_RUNNER='sync')
+    def test_replaced_profile_pictures_are_deleted_when_flushed_right_away(self):
+        user = User.objects.create(username='patron', user_type=2)
+        self.client.force_login(user)
+        stored = storage.get_storage()
+        old_key, new_key = f'profile_pics/{user.id}/old.png', f'profile_pics/{user.id}/new.png'
+        for key in (old_key, new_key):
+            stored.save(key, io.BytesIO(b'x'), content_type='image/png')
+        Patron.objects.filter(user=user).update(s3_profile_picture_key=old_key, profile_picture='https://old')
+
+        self.client.post(reverse('update_patron_profile'), {'custom_username': 'me', 'uploaded_key': forms.sign_upload_key(new_key)})
+        self.assertEqual(stored.keys(), [new_key])
+        self.client.post(reverse('remove_profile_picture'))
+        self.assertEqual(stored.keys(), [])
+        self.assertFalse(PendingDeletion.objects.exists())
+
+    def test_keys_back_in_use_are_kept(self):
+        make_items(make_librarian(), 1, s3_image_key='items/a.png')
+        stored = storage.get_storage()
+        for key in ('items/a.png', 'items/b.png'):
+            stored.save(key, io.BytesIO(b'x'))
+        deletions.schedule_s3_deletion(['items/a.png', 'items/b.png'])
+        self.assertEqual(deletions.flush_pending_deletions(), (1, 0))
+        self.assertEqual(stored.keys(), ['items/a.png'])
+        self.assertFalse(PendingDeletion.objects.exists())
+
+    def test_sweeper_queues_old_unreferenced_objects(self):
+        make_items(make_librarian(), 1, s3_image_key='items/a.png', image_variants={'jpeg': {'200': 'items/a_w200.jpg'}})
+        jobs.enqueue('process_item_image', item_id='0', key='items/uploading.png')
+        stored = storage.get_storage()
+        for key in ('items/a.png', 'items/a_w200.jpg', 'items/orphan.png', 'items/uploading.png',
+                    'profile_pics/1/gone.png', 'other/kept.png'):
+            stored.save(key, io.BytesIO(b'x'))
+        out = io.StringIO()
+        # Everything was just uploaded, so the default minimum age spares it
+        call_command('sweep_s3_orphans', stdout=out)
+        self.assertIn('Scanned 5 objects, queued for deletion 0 orphans.', out.getvalue())
+        call_command('sweep_s3_orphans', '--min-age-hours', '0', '--dry-run', stdout=out)
+        self.assertFalse(PendingDeletion.objects.exists())
+        with mock.patch.object(storage, 'LIST_PAGE_SIZE', 2):
+            call_command('sweep_s3_orphans', '--min-age-hours', '0', stdout=out)
+        self.assertIn('Scanned 5 objects, queued for deletion 2 orphans.', out.getvalue())
+        self.assertEqual(pending_deletions(), ['items/orphan.png', 'profile_pics/1/gone.png'])
+
+
+class LocalStorageTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        settings = override_settings(STORAGE_BACKEND='clothing_lending.storage.LocalFileSystemStorage',
+                                     STORAGE_LOCAL_ROOT=self.root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(shutil.rmtree, self.root)
+        self.addCleanup(storage.reset_storage)
+        storage.reset_storage()
+
+    def test_browser_upload_and_signed_download(self):
+        self.client.force_login(make_librarian().user)
+        data = self.client.post(reverse('presign_upload'), {
+            'kind': 'item', 'filename': 'coat.png', 'content_type': 'image/png', 'size': 3,
+        }).json()
+        self.assertEqual(data['url'], reverse('storage_upload'))
+        upload = SimpleUploadedFile('coat.png', b'png', content_type='image/png')
+        response = self.client.post(data['url'], {**data['fields'], 'file': upload})
+        self.assertEqual(response.status_code, 204)
+        self.assertTrue(os.path.exists(os.path.join(self.root, data['key'])))
+
+        stored = storage.get_storage()
+        for url in (stored.url(data['key']), stored.signed_url(data['key'], expiration=60)):
+            response = self.client.get(url)
+            self.assertEqual(b''.join(response.streaming_content), b'png')
+            self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(self.client.get(stored.url('items/other.png')).status_code, 404)
+        self.assertEqual(self.client.get(f"{reverse('storage_object', args=[data['key']])}?sig=forged").status_code, 403)
+        expired = stored.signed_url(data['key'], expiration=-1)
+        self.assertEqual(self.client.get(expired).status_code, 403)
+
+    def test_upload_must_match_policy(self):
+        stored = storage.get_storage()
+        fields = stored.presigned_post('items/a.png', 'image/png', 5)['fields']
+        upload = lambda content: SimpleUploadedFile('a.png', content, content_type='image/png')
+        url = reverse('storage_upload')
+        self.assertEqual(self.client.post(url, {**fields, 'key': 'items/b.png', 'file': upload(b'x')}).status_code, 403)
+        self.assertEqual(self.client.post(url, {**fields, 'policy': 'forged', 'file': upload(b'x')}).status_code, 403)
+        self.assertEqual(self.client.post(url, {**fields, 'file': upload(b'toolong')}).status_code, 400)
+        self.assertIsNone(stored.info('items/a.png'))
+
+    def test_keys_stay_under_root(self):
+        stored = storage.get_storage()
+        with self.assertRaises(storage.StorageError):
+            stored.save('../outside.png', io.BytesIO(b'x'))
+        self.assertIsNone(stored.info('../../etc/passwd'))
+
+        stored.save('items/a/b.png', io.BytesIO(b'x'))
+        stored.save('items/c.png', io.BytesIO(b'x'))
+        self.assertEqual([key for page in stored.list('items/') for key, modified in page], ['items/a/b.png', 'items/c.png'])
+        self.assertEqual(stored.delete_many(['items/c.png', 'items/missing.png']), {})
+        self.assertEqual([key for page in stored.list('items/') for key, modified in page], ['items/a/b.png'])
+
+
+def make_patrons(count):
+    return [Patron.objects.get(user=User.objects.create(username=f'patron{i}', user_type=2)) for i in range(count)]
+
+
+class BorrowTestCase(TestCase):
+    def setUp(self):
+        self.item = make_items(make_librarian(), 1)[0]
+        self.first, self.second = make_patrons(2)
+
+    def borrow(self, patron):
+        self.client.force_login(patron.user)
+        response = self.client.post(reverse('request_borrow', args=[self.item.id]))
+        return [str(message) for message in get_messages(response.wsgi_request)][-1]
+
+    def test_only_the_first_request_gets_the_item(self):
+        self.assertEqual(self.borrow(self.first), 'Your borrow request has been submitted and is pending approval.')
+        self.assertEqual(self.borrow(self.first), 'You already have a pending or approved request for this item.')
+        self.assertEqual(self.borrow(self.second), 'This item is not available for borrowing.')
+        self.assertEqual(Lending.objects.get(item=self.item).borrower, self.first)
+        self.assertFalse(Item.objects.get(pk=self.item.pk).available)
+
+    def test_item_is_released_if_an_active_lending_already_exists(self):
+        # available out of step with the lendings: the constraint refuses the second one
+        Lending.objects.create(item=self.item, borrower=self.first)
+        with self.assertRaises(lending.ItemUnavailable):
+            lending.borrow_item(self.item.pk, self.second)
+        self.assertTrue(Item.objects.get(pk=self.item.pk).available)
+        self.assertEqual(Lending.objects.filter(item=self.item).count(), 1)
+
+        Lending.objects.filter(item=self.item).update(status='RETURNED')
+        self.assertEqual(lending.borrow_item(self.item.pk, self.second).status, 'PENDING')
+
+
+def borrow_in_child_process(item_id, patron_id):
+    # The parent's connection was closed before forking, so this opens a new one
+    try:
+        lending.borrow_item(item_id, Patron.objects.get(pk=patron_id))
+    except lending.ItemUnavailable:
+        os._exit(1)
+    finally:
+        connections.close_all()
+    os._exit(0)
+
+
+class ConcurrentBorrowTestCase(TransactionTestCase):
+    BORROWERS = 8
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # Shared-cache in-memory SQLite fails concurrent writers with "table is locked"
+            # instead of making them wait, and child processes can't open it at all
+            self.skipTest("Needs a test database that concurrent connections can share")
+        self.item = make_items(make_librarian(), 1)[0]
+        self.patrons = make_patrons(self.BORROWERS)
+
+    def assert_one_borrower(self, outcomes):
+        self.assertEqual(sorted(outcomes), ['borrowed'] + ['unavailable'] * (self.BORROWERS - 1))
+        self.assertEqual(Lending.objects.filter(item=self.item, status='PENDING').count(), 1)
+        self.assertFalse(Item.objects.get(pk=self.item.pk).available)
+
+    def test_threads(self):
+        barrier = threading.Barrier(self.BORROWERS)
+        outcomes = []
+
+        def borrow(patron):
+            barrier.wait()
+            try:
+                lending.borrow_item(self.item.pk, patron)
+                outcomes.append('borrowed')
+            except lending.ItemUnavailable:
+                outcomes.append('unavailable')
+            except Exception as e:
+                outcomes.append(repr(e))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=borrow, args=(patron,)) for patron in self.patrons]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assert_one_borrower(outcomes)
+
+    def test_processes(self):
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=borrow_in_child_process, args=(self.item.pk, patron.pk))
+                     for patron in self.patrons]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        self.assert_one_borrower(['borrowed' if process.exitcode == 0 else 'unavailable' for process in processes])
+
+
+class LendingStateMachineTestCase(TestCase):
+    def setUp(self):
+        self.librarian = make_librarian()
+        self.item = make_items(self.librarian, 1)[0]
+        self.patron = make_patrons(1)[0]
+        self.lending = lending.borrow_item(self.item.pk, self.patron)
+
+    def manage(self, action):
+        self.client.force_login(self.librarian.user)
+        response = self.client.post(reverse('manage_lending_request', args=[self.lending.id]), {'action': action})
+        return [str(message) for message in get_messages(response.wsgi_request)][-1]
+
+    def history(self):
+        return list(LendingEvent.objects.filter(lending=self.lending).order_by('pk').values_list('action', 'from_status', 'to_status'))
+
+    def test_full_loan(self):
+        self.assertEqual(self.manage('approve'), 'Lending request for Item 0 has been approved.')
+        self.client.force_login(self.patron.user)
+        self.client.post(reverse('request_return', args=[self.lending.id]))
+        self.client.post(reverse('request_return', args=[self.lending.id]))
+        self.assertEqual(self.manage('return'), 'Item 0 has been marked as returned.')
+
+        self.lending.refresh_from_db()
+        self.assertEqual(self.lending.status, 'RETURNED')
+        self.assertEqual(self.lending.due_date, self.lending.approved_date + lending.LOAN_PERIOD)
+        self.assertIsNotNone(self.lending.return_date)
+        self.assertTrue(Item.objects.get(pk=self.item.pk).available)
+        self.assertEqual(self.history(), [
+            ('request', '', 'PENDING'), ('approve', 'PENDING', 'APPROVED'),
+            ('request_return', 'APPROVED', 'APPROVED'), ('return', 'APPROVED', 'RETURNED'),
+        ])
+        self.assertEqual(LendingEvent.objects.get(action='approve').actor, self.librarian.user)
+
+    def test_transitions_check_the_current_status(self):
+        self.assertEqual(self.manage('return'), 'This lending is pending and can no longer be changed that way.')
+        self.assertEqual(self.manage('reject'), 'Lending request for Item 0 has been rejected.')
+        self.assertEqual(self.manage('approve'), 'This lending is rejected and can no longer be changed that way.')
+        self.assertEqual(self.manage('bogus'), 'Unknown action.')
+        self.lending.refresh_from_db()
+        self.assertEqual((self.lending.status, self.lending.approved_date), ('REJECTED', None))
+        self.assertTrue(Item.objects.get(pk=self.item.pk).available)
+        self.assertEqual(len(self.history()), 2)
+
+        # A stale copy can't apply a move the database has moved past
+        with self.assertRaises(lending.InvalidTransition):
+            lending.transition(Lending(pk=self.lending.pk, item=self.item, status='PENDING'), 'approve')
+
+    def test_events_are_read_incrementally(self):
+        lending.transition(self.lending, 'approve')
+        first = lending.events_after(0, limit=1)
+        self.assertEqual([event.action for event in first], ['request'])
+        self.assertEqual([event.action for event in lending.events_after(first[-1].pk)], ['approve'])
+        self.assertEqual(lending.events_after(LendingEvent.objects.latest('pk').pk), [])
@@ -23,7 +23,7 @@ from .views import (
     add_collection, collection_detail, edit_collection, delete_collection, request_invite, remove_item_from_collection, remove_patron_access,
     
     # Item management
-    add_item, edit_item, item_detail, rate_item, edit_rating, delete_rating, delete_item, request_borrow, request_return,
+    add_item, edit_item, item_detail, item_reviews, rate_item, edit_rating, delete_rating, delete_item, request_borrow, request_return,
     
     # Lending management
     manage_lending_request,
@@ -31,8 +31,9 @@ from .views import (
     # Invite management
     manage_invite,
 
-    # Debug & S3 helpers
-    test_s3_connection, get_presigned_url, test_s3_upload, test_s3_permissions,
+    # Debug & storage helpers
+    test_s3_connection, get_presigned_url, get_presigned_urls, presign_upload, test_s3_upload, test_s3_permissions,
+    storage_object, storage_upload,
     
     # Test views
     test_view
@@ -68,12 +69,18 @@ urlpatterns = [
     path('librarian/items/add/', add_item, name='add_item'),
     path('items/<uuid:item_id>/edit/', edit_item, name='edit_item'),
     path('items/<uuid:item_id>/', item_detail, name='item_detail'),
+    path('items/<uuid:item_id>/reviews/', item_reviews, name='item_reviews'),
     path('items/<uuid:item_id>/review/', rate_item, name='rate_item'),
     path('items/<uuid:item_id>/edit-review/', edit_rating, name='edit_rating'),
     path('items/<uuid:item_id>/delete-review/', delete_rating, name='delete_rating'),
     path('items/<uuid:item_id>/delete/', delete_item, name='delete_item'),
     path('items/<uuid:item_id>/request-borrow/', request_borrow, name='request_borrow'),
     path('items/<uuid:item_id>/presigned-url/', get_presigned_url, name='get_presigned_url'),
+    path('items/presigned-urls/', get_presigned_urls, name='get_presigned_urls'),
+    path('uploads/presign/', presign_upload, name='presign_upload'),
+    # Files and browser uploads for the local filesystem and in-memory storage backends
+    path('storage/upload/', storage_upload, name='storage_upload'),
+    path('storage/<path:key>', storage_object, name='storage_object'),
     
     # Lending management routes
     path('lending/<int:lending_id>/manage/', manage_lending_request, name='manage_lending_request'),
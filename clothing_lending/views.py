@@ -1,17 +1,56 @@
 from allauth.account.views import logout
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse, JsonResponse
+from django.urls import reverse
+from django.http import HttpResponse, JsonResponse, Http404, FileResponse
 from django.contrib import messages
+from django.conf import settings
+from django.db import transaction, IntegrityError
+import io
+import os
 import uuid
-from django.db.models import Q
+from django.db.models import Q, F, Case, When, Value, CharField, IntegerField, Count, Exists, OuterRef, Prefetch, Subquery, Window
+from django.db.models.functions import Coalesce, RowNumber
 from django.utils import timezone
+from django.utils.text import get_valid_filename
 from datetime import timedelta
 
 from clothing_lending.models import User, Patron, Librarian, Collection, Item, Lending, Invite, Category, Rating
-from clothing_lending.forms import CollectionForm, ItemForm, PromoteUserForm, AddItemToCollectionForm, AddItemToCollectionFromCollectionForm, PatronProfileForm, RateItemForm
-from clothing_lending.s3_utils import upload_file_to_s3, get_s3_client, generate_presigned_url, delete_file_from_s3
+from clothing_lending.forms import CollectionForm, ItemForm, PromoteUserForm, AddItemToCollectionForm, AddItemToCollectionFromCollectionForm, PatronProfileForm, RateItemForm, sign_upload_key
+from clothing_lending.s3_utils import get_presigned_url_cache_stats
+from clothing_lending.storage import get_storage, S3Storage, StorageError
+from clothing_lending.images import MAX_IMAGE_SIZE, fallback_key, signed_srcsets
+from clothing_lending.lending import borrow_item, transition, ItemUnavailable, InvalidTransition
+from clothing_lending.jobs import enqueue, stash_upload
+from clothing_lending.deletions import schedule_s3_deletion
+from clothing_lending.pagination import keyset_paginate, InvalidCursor, OffsetPage, get_page_number
+from clothing_lending.search import search_items
+from clothing_lending.ratings import record_rating, change_rating, remove_rating
+from clothing_lending import permissions
+
+# Browse pages are ordered newest first; id breaks ties between items created
+# in the same instant so the keyset cursor always points at exactly one row.
+BROWSE_ORDERING = ('-created_at', '-id')
+BROWSE_PAGE_SIZE = getattr(settings, 'BROWSE_PAGE_SIZE', 24)
+
+# Patron lending history (returned and rejected requests) is paged newest first
+HISTORY_ORDERING = ('-request_date', '-id')
+
+# Reviews on an item page are listed newest first and loaded a page at a time
+REVIEW_ORDERING = ('-rate_date', '-id')
+REVIEW_PAGE_SIZE = getattr(settings, 'REVIEW_PAGE_SIZE', 10)
+
+# Each dashboard table shows this many rows per page
+DASHBOARD_PAGE_SIZE = getattr(settings, 'DASHBOARD_PAGE_SIZE', 20)
+
+# Lending tables on the librarian dashboard, keyed by their ?<name>_page parameter
+LENDING_SECTIONS = {
+    'pending': Q(status='PENDING'),
+    'active': Q(status='APPROVED', return_requested=False),
+    'returns': Q(status='APPROVED', return_requested=True),
+}
 
 
 # Create your views here.
@@ -32,56 +71,127 @@ def is_librarian(user):
     return user.is_authenticated and user.user_type == 1
 
 
+def page_url(request, param, number):
+    """
+    Link to page `number` of one dashboard table, keeping the other tables' pages.
+    """
+    params = request.GET.copy()
+    params[param] = number
+    return f"?{params.urlencode()}"
+
+
+def with_page_urls(request, param, page):
+    page.previous_url = page_url(request, param, page.number - 1) if page.has_previous else None
+    page.next_url = page_url(request, param, page.number + 1) if page.has_next else None
+    return page
+
+
+def get_dashboard_page(request, param, queryset):
+    """
+    The page of `queryset` named by ?<param>, DASHBOARD_PAGE_SIZE rows long.
+
+    :param queryset: Ordered queryset; costs one COUNT and one sliced query
+    :return: OffsetPage with previous/next links
+    """
+    count = queryset.count()
+    page = OffsetPage([], get_page_number(request.GET.get(param), count, DASHBOARD_PAGE_SIZE), DASHBOARD_PAGE_SIZE, count)
+    page.object_list = list(queryset[page.start_row - 1:page.end_row])
+    return with_page_urls(request, param, page)
+
+
+def get_lending_sections(request, lendings):
+    """
+    Fetch the current page of every lending section in one query.
+
+    Rows are numbered per section with ROW_NUMBER() and only the rows inside
+    each section's requested page are returned, so the cost is bounded by the
+    page size rather than by how many loans the librarian has.
+
+    :param request: Request carrying the ?<section>_page parameters
+    :param lendings: Lending queryset to split into LENDING_SECTIONS
+    :return: Dict of section name to OffsetPage
+    """
+    counts = lendings.aggregate(**{
+        name: Count('pk', filter=condition) for name, condition in LENDING_SECTIONS.items()
+    })
+    numbers = {
+        name: get_page_number(request.GET.get(f'{name}_page'), counts[name], DASHBOARD_PAGE_SIZE)
+        for name in LENDING_SECTIONS
+    }
+
+    section = Case(
+        *[When(condition, then=Value(name)) for name, condition in LENDING_SECTIONS.items()],
+        output_field=CharField(),
+    )
+    # Requests are listed by when they were made, loans by when they started
+    sort_date = Case(When(status='PENDING', then=F('request_date')), default=F('approved_date'))
+
+    def page_bound(offset):
+        return Case(
+            *[When(section=name, then=Value((numbers[name] - 1) * DASHBOARD_PAGE_SIZE + offset))
+              for name in LENDING_SECTIONS],
+            output_field=IntegerField(),
+        )
+
+    rows = (
+        lendings.annotate(section=section)
+        .exclude(section=None)
+        .annotate(row_number=Window(
+            RowNumber(), partition_by=[F('section')], order_by=[sort_date.desc(), F('id').desc()]
+        ))
+        .filter(row_number__gt=page_bound(0), row_number__lte=page_bound(DASHBOARD_PAGE_SIZE))
+        .order_by('row_number')
+        .select_related('item', 'borrower__user')
+        .prefetch_related(Prefetch('item__categories', queryset=Category.objects.only('id', 'name').order_by('name')))
+    )
+
+    sections = {name: [] for name in LENDING_SECTIONS}
+    for lending in rows:
+        sections[lending.section].append(lending)
+
+    return {
+        name: with_page_urls(request, f'{name}_page',
+                             OffsetPage(sections[name], numbers[name], DASHBOARD_PAGE_SIZE, counts[name]))
+        for name in LENDING_SECTIONS
+    }
+
+
 @user_passes_test(is_librarian)
 def librarian_page(request):
     # Get the librarian instance for the current user
     librarian = get_object_or_404(Librarian, user=request.user)
 
     # Show only collections owned by this librarian
-    collections = Collection.objects.filter(created_by=request.user)
+    collections = get_dashboard_page(
+        request, 'collections_page',
+        Collection.objects.filter(created_by=request.user).annotate(item_count=Count('items')).order_by('-created_at', '-id'),
+    )
 
     # Show only items created by this librarian
-    recent_items = Item.objects.filter(created_by=librarian).order_by('-created_at')
+    recent_items = get_dashboard_page(
+        request, 'items_page', with_card_data(Item.objects.filter(created_by=librarian)).order_by('-created_at', '-id')
+    )
 
     promote_form = PromoteUserForm()
 
     # Show only lending requests for items created by this librarian
-    pending_requests = Lending.objects.filter(
-        item__created_by=librarian,
-        status='PENDING'
-    ).order_by('-request_date')
-
-    active_lendings = Lending.objects.filter(
-        item__created_by=librarian,
-        status='APPROVED',
-        return_requested=False
-    ).order_by('-approved_date')
-
-    #print(active_lendings)
-
-    # filter returns requested
-    returns_requested = Lending.objects.filter(
-        item__created_by=librarian,
-        status='APPROVED',
-        return_requested=True
-    ).order_by('-approved_date')
-
-    #print(returns_requested)
+    sections = get_lending_sections(request, Lending.objects.filter(item__created_by=librarian))
 
     # Finally, show pending invites!
-    pending_invites = Invite.objects.filter(
-        collection__created_by=request.user,
-        status='PENDING'
-    ).order_by('-request_date')
+    pending_invites = get_dashboard_page(
+        request, 'invites_page',
+        Invite.objects.filter(collection__created_by=request.user, status='PENDING')
+        .select_related('collection', 'requester__user').order_by('-request_date', '-id'),
+    )
 
     context = {
         'collections': collections,
         'recent_items': recent_items,
         'form': promote_form,
-        'pending_requests': pending_requests,
-        'active_lendings': active_lendings,
-        'returns_requested': returns_requested,
-        'pending_invites': pending_invites
+        'pending_requests': sections['pending'],
+        'active_lendings': sections['active'],
+        'returns_requested': sections['returns'],
+        'pending_invites': pending_invites,
     }
 
     return render(request, 'librarian/page.html', context)
@@ -157,85 +267,169 @@ def google_oauth_callback(request):
     return redirect('index.html')
 
 
-def browse(request):
-    query = request.GET.get('q')
+# Query parameters browse understands as item filters. Every parameter may be
+# repeated (?size=S&size=M) and values within one parameter are OR-ed together.
+BROWSE_FILTER_PARAMS = ('size', 'condition', 'category', 'available')
 
-    if request.user.is_authenticated and request.user.user_type == 1:
-        collections = Collection.objects.all()
 
-        if query:
-            items = Item.objects.filter(
-                Q(name__icontains=query) | Q(categories__name__icontains=query)
-            ).distinct()
-            collections = Collection.objects.filter(
-                Q(name__icontains=query)
-            ).distinct()
-        else:
-            items = Item.objects.all()
-            collections = Collection.objects.all()
+def get_browse_filters(request):
+    """
+    Read the item filters from the query string, dropping values we don't know.
+    """
+    valid_values = {
+        'size': {code for code, label in Item.SIZE_CHOICES},
+        'condition': {code for code, label in Item.CONDITION_CHOICES},
+        'available': {'true', 'false'},
+    }
+    filters = {}
+    for param in BROWSE_FILTER_PARAMS:
+        values = [v for v in request.GET.getlist(param) if v]
+        if param in valid_values:
+            values = [v for v in values if v in valid_values[param]]
+        if values:
+            filters[param] = values
+    return filters
 
-        restricted_collections = Collection.objects.none()
 
-    elif request.user.is_authenticated and request.user.user_type == 2:
-        try:
-            patron = request.user.patron
-
-            if query:
-                items = Item.objects.filter(
-                    Q(available=True) &
-                    (Q(private_collection=False) | Q(collections__allowed_patrons=patron)) &
-                    (Q(name__icontains=query) | Q(categories__name__icontains=query))
-                ).distinct()
-                collections = Collection.objects.filter(
-                    (Q(is_private=False) | Q(allowed_patrons=patron)) &
-                    Q(name__icontains=query))
-            else:
-                items = Item.objects.filter(
-                    Q(available=True) &
-                    (Q(private_collection=False) | Q(collections__allowed_patrons=patron))
-                ).distinct()
-                collections = Collection.objects.filter(Q(is_private=False) | Q(allowed_patrons=patron))
-            restricted_collections = Collection.objects.exclude(Q(is_private=False) | Q(allowed_patrons=patron))
-
-        except Patron.DoesNotExist:
-            if query:
-                items = Item.objects.filter(
-                    Q(available=True) &
-                    Q(private_collection=False) &
-                    (Q(name__icontains=query) | Q(categories__name__icontains=query))
-                ).distinct()
-                collections = Collection.objects.filter(Q(is_private=False) & Q(name__icontains=query)).distinct()
-            else:
-                items = Item.objects.filter(
-                    Q(available=True) &
-                    Q(private_collection=False)
-                ).distinct()
-                collections = Collection.objects.filter(Q(is_private=False)).distinct()
-            restricted_collections = Collection.objects.none()
-
-    else:  # guest user
-        if query:
-            items = Item.objects.filter(
-                Q(available=True) &
-                Q(private_collection=False) &
-                (Q(name__icontains=query) | Q(categories__name__icontains=query))
-            ).distinct()
-            collections = Collection.objects.filter(Q(is_private=False) & Q(name__icontains=query)).distinct()
-        else:
-            items = Item.objects.filter(
-                Q(available=True) &
-                Q(private_collection=False)
-            ).distinct()
-            collections = Collection.objects.filter(is_private=False)
-        restricted_collections = Collection.objects.none()
+def apply_item_filters(items, filters, exclude=None):
+    """
+    Narrow an item queryset with the browse filters, skipping `exclude` so a
+    facet can be counted as if its own selection weren't applied.
+    """
+    for param, values in filters.items():
+        if param == exclude:
+            continue
+        if param == 'size':
+            items = items.filter(size__in=values)
+        elif param == 'condition':
+            items = items.filter(condition__in=values)
+        elif param == 'available':
+            items = items.filter(available__in=[v == 'true' for v in values])
+        elif param == 'category':
+            # Subquery rather than a join so an item in two selected categories isn't duplicated
+            tagged = Item.categories.through.objects.filter(category__name__in=values).values('item_id')
+            items = items.filter(pk__in=tagged)
+    return items
+
+
+def with_card_data(items):
+    """
+    Load everything an item card renders in a fixed number of queries: the
+    category count as an annotation and the category names as one prefetch.
+    Large text columns the cards never show are left out of the page query.
+    """
+    category_count = (
+        Item.categories.through.objects.filter(item=OuterRef('pk'))
+        .order_by().values('item').annotate(count=Count('pk')).values('count')
+    )
+    return items.defer('description', 'image_url').annotate(
+        category_count=Coalesce(Subquery(category_count), 0)
+    ).prefetch_related(
+        Prefetch('categories', queryset=Category.objects.only('id', 'name').order_by('name'))
+    )
+
+
+def get_facet_counts(items, filters, param, field):
+    """
+    Count visible items per value of `field` with one grouped aggregation.
+    """
+    rows = (
+        apply_item_filters(items, filters, exclude=param)
+        .order_by()
+        .values(field)
+        .annotate(count=Count('id', distinct=True))
+    )
+    return {row[field]: row['count'] for row in rows if row[field] is not None}
+
+
+def build_facet(request, items, filters, param, field, choices):
+    """
+    Build the sidebar options for one facet: label, exact count, whether it is
+    selected and the URL that toggles it.
+    """
+    counts = get_facet_counts(items, filters, param, field)
+    selected = filters.get(param, [])
+    options = []
+    for value, label in choices:
+        params = request.GET.copy()
+        params.pop('cursor', None)  # a new filter starts again from the first page
+        toggled = [v for v in selected if v != value] if value in selected else selected + [value]
+        params.setlist(param, toggled)
+        options.append({
+            'value': value,
+            'label': label,
+            'count': counts.get(value if param != 'available' else value == 'true', 0),
+            'active': value in selected,
+            'url': f"?{params.urlencode()}",
+        })
+    return options
+
+
+def browse(request):
+    query = request.GET.get('q')
+
+    # Visibility is part of the page query itself (see permissions.py)
+    items = permissions.visible_items(request.user)
+    collections = permissions.visible_collections(request.user)
+    restricted_collections = Collection.objects.none()
+    if not is_librarian(request.user):
+        # Only librarians see unavailable items
+        items = items.filter(available=True)
+        if permissions.get_patron(request.user) is not None:
+            # Patrons can see that private collections exist and ask to join them
+            restricted_collections = Collection.objects.exclude(permissions.collection_visibility(request.user))
+
+    ordering = BROWSE_ORDERING
+    if query:
+        # Matches come from the full-text index and are listed most relevant first
+        items = search_items(items, query)
+        ordering = ('-search_rank',) + BROWSE_ORDERING
+        collections = collections.filter(name__icontains=query)
 
     categories = Category.objects.all()
 
+    # Facets are counted over everything visible to this user, then the page is cut
+    filters = get_browse_filters(request)
+    facets = {
+        'category': build_facet(request, items, filters, 'category', 'categories__name',
+                                [(c.name, c.name) for c in categories]),
+        'size': build_facet(request, items, filters, 'size', 'size', Item.SIZE_CHOICES),
+        'condition': build_facet(request, items, filters, 'condition', 'condition', Item.CONDITION_CHOICES),
+        'available': build_facet(request, items, filters, 'available', 'available',
+                                 [('true', 'Available'), ('false', 'Unavailable')]),
+    }
+    items = with_card_data(apply_item_filters(items, filters))
+    collections = collections.select_related('created_by')
+    restricted_collections = restricted_collections.select_related('created_by')
+
+    # Only ever read one page of items, no matter how large the catalog is
+    cursor = request.GET.get('cursor')
+    try:
+        page = keyset_paginate(items, ordering, cursor, BROWSE_PAGE_SIZE)
+    except InvalidCursor:
+        page = keyset_paginate(items, ordering, None, BROWSE_PAGE_SIZE)
+
+    next_page_url = None
+    if page.has_next:
+        params = request.GET.copy()
+        params['cursor'] = page.next_cursor
+        next_page_url = f"?{params.urlencode()}"
+
+    first_page_url = None
+    if not page.is_first:
+        params = request.GET.copy()
+        params.pop('cursor', None)
+        first_page_url = f"?{params.urlencode()}"
+
     context = {
-        'items': items,
+        'items': page,
         'collections': collections,
         'restrictedcollections': restricted_collections,
-        'categories': categories
+        'categories': categories,
+        'facets': facets,
+        'active_filters': [(param, value) for param, values in filters.items() for value in values],
+        'next_page_url': next_page_url,
+        'first_page_url': first_page_url,
     }
 
     return render(request, 'browse.html', context)
@@ -297,22 +491,6 @@ def edit_collection(request, collection_id):
     return render(request, 'edit_collection.html', {'form': form, 'user': user, 'collection': collection})
 
 
-def user_can_view_collection(user, collection):
-    if not collection.is_private:
-        return True
-    if user.user_type == 1:
-        return True
-    return user.patron in collection.allowed_patrons.all() # thanks to https://stackoverflow.com/questions/20931571/check-if-item-is-in-manytomany-field
-
-# janky code to see if a user can view an item
-def user_can_view_item(user, item):
-    cv = True
-    collections = item.collections.all()
-    for collection in collections:
-        if not user_can_view_collection(user, collection):
-            cv = False
-    return cv
-
 @user_passes_test(is_librarian)
 def add_item(request):
     if request.method == 'POST':
@@ -325,7 +503,12 @@ def add_item(request):
             item.created_by = librarian
 
             # Handle image upload to S3
-            if 'image' in request.FILES:
+            pending_upload = None
+            uploaded_key = form.cleaned_data.get('uploaded_key')
+            if uploaded_key:
+                # The browser already put the image in S3; only the resizing is left
+                item.image_status = 'PROCESSING'
+            elif 'image' in request.FILES:
                 print(f"Image found in request.FILES: {request.FILES['image']}")
                 file_obj = request.FILES['image']
 
@@ -334,18 +517,12 @@ def add_item(request):
                 print(f"File size: {file_obj.size}")
                 print(f"File content type: {file_obj.content_type}")
 
-                # Try to upload to S3
+                # Copy the file aside; a background job uploads it to S3 once the item is saved
                 try:
-                    s3_upload = upload_file_to_s3(file_obj)
-                    if s3_upload:
-                        print(f"S3 upload successful: {s3_upload}")
-                        item.image_url = s3_upload['url']
-                        item.s3_image_key = s3_upload['key']
-                    else:
-                        print("S3 upload failed - returned None")
-                        messages.error(request, "Failed to upload image to S3. Item saved without image.")
+                    pending_upload = stash_upload(file_obj)
+                    item.image_status = 'PROCESSING'
                 except Exception as e:
-                    print(f"Exception during S3 upload: {e}")
+                    print(f"Exception while saving upload: {e}")
                     import traceback
                     traceback.print_exc()
                     messages.error(request, f"Error uploading image: {str(e)}")
@@ -356,6 +533,10 @@ def add_item(request):
             try:
                 item.save()
                 form.save_m2m()
+                if uploaded_key:
+                    enqueue('process_item_image', item_id=str(item.id), key=uploaded_key)
+                elif pending_upload:
+                    enqueue('upload_item_image', item_id=str(item.id), **pending_upload)
 
                 new_category_name = form.cleaned_data.get('new_category')
                 if new_category_name:
@@ -366,7 +547,10 @@ def add_item(request):
                 print(f"Item saved with ID: {item.id}")
                 print(f"Item image_url: {item.image_url}")
                 print(f"Item s3_image_key: {item.s3_image_key}")
-                messages.success(request, 'Item created successfully!')
+                if uploaded_key or pending_upload:
+                    messages.success(request, 'Item created successfully! The image will appear once it has finished uploading.')
+                else:
+                    messages.success(request, 'Item created successfully!')
                 return redirect('librarian_page')
             except Exception as e:
                 print(f"Error saving item: {e}")
@@ -378,7 +562,7 @@ def add_item(request):
     else:
         form = ItemForm()
 
-    return render(request, 'librarian/add_item.html', {'form': form})
+    return render(request, 'librarian/add_item.html', {'form': form, 'direct_uploads': settings.S3_DIRECT_UPLOADS})
 
 
 # janky code to edit an item
@@ -399,7 +583,12 @@ def edit_item(request, item_id):
             item.created_at = created_at
 
             # Replace image upload to S3
-            if 'image' in request.FILES:
+            pending_upload = None
+            uploaded_key = form.cleaned_data.get('uploaded_key')
+            if uploaded_key:
+                # The browser already put the image in S3; only the resizing is left
+                item.image_status = 'PROCESSING'
+            elif 'image' in request.FILES:
                 print(f"Image found in request.FILES: {request.FILES['image']}")
                 file_obj = request.FILES['image']
 
@@ -408,23 +597,13 @@ def edit_item(request, item_id):
                 print(f"File size: {file_obj.size}")
                 print(f"File content type: {file_obj.content_type}")
 
-                # Try to upload to S3
+                # Copy the file aside; a background job uploads it to S3 once the item is saved
+                # and deletes the old one when it's done
                 try:
-                    s3_upload = upload_file_to_s3(file_obj)
-                    if s3_upload:
-                        print(f"S3 upload successful: {s3_upload}")
-                        # Delete old item picture from S3 if it exists
-                        if item.s3_image_key:
-                            from clothing_lending.s3_utils import delete_file_from_s3
-                            delete_file_from_s3(item.s3_image_key)
-                        # update item
-                        item.image_url = s3_upload['url']
-                        item.s3_image_key = s3_upload['key']
-                    else:
-                        print("S3 upload failed - returned None")
-                        messages.error(request, "Failed to upload image to S3. Item saved without image.")
+                    pending_upload = stash_upload(file_obj)
+                    item.image_status = 'PROCESSING'
                 except Exception as e:
-                    print(f"Exception during S3 upload: {e}")
+                    print(f"Exception while saving upload: {e}")
                     import traceback
                     traceback.print_exc()
                     messages.error(request, f"Error uploading image: {str(e)}")
@@ -435,6 +614,10 @@ def edit_item(request, item_id):
             try:
                 item.save()
                 form.save_m2m()
+                if uploaded_key:
+                    enqueue('process_item_image', item_id=str(item.id), key=uploaded_key)
+                elif pending_upload:
+                    enqueue('upload_item_image', item_id=str(item.id), **pending_upload)
 
 
                 new_category_name = form.cleaned_data.get('new_category')
@@ -446,7 +629,10 @@ def edit_item(request, item_id):
                 print(f"Item saved with ID: {item.id}")
                 #print(f"Item image_url: {item.image_url}")
                 #print(f"Item s3_image_key: {item.s3_image_key}")
-                messages.success(request, 'Item edited successfully!')
+                if uploaded_key or pending_upload:
+                    messages.success(request, 'Item edited successfully! The image will appear once it has finished uploading.')
+                else:
+                    messages.success(request, 'Item edited successfully!')
                 return redirect('librarian_page')
             except Exception as e:
                 print(f"Error editing item: {e}")
@@ -458,38 +644,26 @@ def edit_item(request, item_id):
     else:
         form = ItemForm(instance=orig_item) # thanks to https://stackoverflow.com/questions/31406276/how-to-load-an-instance-in-django-modelforms
     # I am adding a comment as a test please deploy github pretty please please pleaseeee
-    return render(request, 'edit_item.html', {'item': item, 'form': form})
+    return render(request, 'edit_item.html', {'item': item, 'form': form, 'direct_uploads': settings.S3_DIRECT_UPLOADS})
 
 
 def item_detail(request, item_id):
     item = get_object_or_404(Item, pk=item_id)
     # Get ratings
-    ratings = Rating.objects.filter(item=item).order_by('-rate_date')
-    avg = 0
-    if ratings: # get average rating
-        sum = 0
-        for rating in ratings:
-            sum = sum + rating.num_rating
-        avg = round(sum / ratings.count(), 1)
+    # Only the first page of reviews is rendered; the rest load from item_reviews on scroll
+    ratings = get_review_page(item)
     
     # Get patron for the current user if authenticated
     patron = None
     if request.user.is_authenticated and request.user.user_type == 2:
         patron, created = Patron.objects.get_or_create(user=request.user)
     
-    if request.user.is_authenticated:
-        can_view = user_can_view_item(request.user, item)
-    else:
-        can_view = True
-        collections = item.collections.all()
-        for collection in collections:
-            if collection.is_private:
-                can_view = False
+    can_view = permissions.can_view(request.user, item)
 
-    # check if you can review
+    # check if you can review (one lookup on the unique (item, rater) index)
     can_review = False
     if request.user.is_authenticated and request.user.user_type == 2:
-        if not Rating.objects.filter(Q(item=item) & Q(rater=patron)).exists():
+        if not Rating.objects.filter(item=item, rater=patron).exists():
             can_review = True
 
     print(can_review)
@@ -512,7 +686,7 @@ def item_detail(request, item_id):
             item=item
         )
 
-    return render(request, 'item_detail.html', {'item': item, 'form': form, 'ratings': ratings, 'avg': avg, 'canview': can_view, 'patron': patron, 'canreview': can_review})
+    return render(request, 'item_detail.html', {'item': item, 'form': form, 'ratings': ratings, 'next_reviews_url': review_page_url(item, ratings), 'avg': item.average_rating, 'canview': can_view, 'patron': patron, 'canreview': can_review})
 
 # stuff to rate an item yippeee
 @user_passes_test(is_patron)
@@ -543,9 +717,16 @@ def rate_item(request, item_id):
             rating.rater = patron
             rating.item = item
 
-            # Save the rating
-            rating.save()
-            form.save_m2m()
+            # Save the rating and count it on the item together
+            try:
+                with transaction.atomic():
+                    rating.save()
+                    form.save_m2m()
+                    record_rating(item.pk, rating.num_rating)
+            except IntegrityError:
+                # Lost a race with another submission of the same review
+                messages.warning(request, 'You cannot review the same item twice.')
+                return redirect('item_detail', item_id=item_id)
             messages.success(request, 'Your review has been added!')
             return redirect('item_detail', item_id=item_id)
         else:
@@ -590,9 +771,12 @@ def edit_rating(request, item_id):
             rating.item = item
             rating.rate_date = orig_rate_date # don't overwrite original rate date
 
-            # Save the rating
-            rating.save()
-            form.save_m2m()
+            # Save the rating and move it between star buckets together
+            with transaction.atomic():
+                old_stars = Rating.objects.select_for_update().values_list('num_rating', flat=True).get(pk=rating.pk)
+                rating.save()
+                form.save_m2m()
+                change_rating(item.pk, old_stars, rating.num_rating)
             messages.success(request, 'Your review has been updated!')
             return redirect('item_detail', item_id=item_id)
         else:
@@ -613,60 +797,103 @@ def delete_rating(request, item_id):
         return redirect('item_detail', item_id=item_id)
     rating = get_object_or_404(Rating, Q(item=item) & Q(rater=patron))
     if request.method == 'POST':
-        rating.delete()
+        with transaction.atomic():
+            stars = Rating.objects.select_for_update().values_list('num_rating', flat=True).get(pk=rating.pk)
+            rating.delete()
+            remove_rating(item.pk, stars)
         messages.success(request, 'Review deleted successfully!')
         return redirect('item_detail', item_id=item_id)
 
-def test_s3_connection(request):
+def get_review_page(item, cursor=None):
     """
-    A debug view to test S3 connection and image access.
+    One page of an item's reviews, newest first.
     """
+    ratings = Rating.objects.filter(item=item).select_related('rater__user')
+    return keyset_paginate(ratings, REVIEW_ORDERING, cursor, REVIEW_PAGE_SIZE)
+
+
+def review_page_url(item, page):
+    if not page.has_next:
+        return None
+    return f"{reverse('item_reviews', args=[item.id])}?cursor={page.next_cursor}"
+
+
+def item_reviews(request, item_id):
+    """
+    Next page of an item's reviews after `cursor`, as an HTML fragment for the
+    item page's infinite scroll, or as JSON with ?format=json.
+    """
+    item = get_object_or_404(Item, pk=item_id)
+    if not permissions.can_view(request.user, item):
+        raise Http404("Item not found")
+
     try:
-        # Get bucket info
-        s3_client = get_s3_client()
+        page = get_review_page(item, request.GET.get('cursor'))
+    except InvalidCursor:
+        return JsonResponse({'success': False, 'error': 'Invalid cursor'}, status=400)
+    next_url = review_page_url(item, page)
+
+    if request.GET.get('format') == 'json':
+        return JsonResponse({
+            'success': True,
+            'reviews': [{
+                'id': rating.id,
+                'num_rating': rating.num_rating,
+                'comment': rating.comment,
+                'rate_date': rating.rate_date.isoformat(),
+                'rater': str(rating.rater),
+            } for rating in page],
+            'next_cursor': page.next_cursor,
+            'next_url': next_url,
+        })
 
-        # List all buckets
-        response = s3_client.list_buckets()
-        buckets = [bucket['Name'] for bucket in response['Buckets']]
+    return render(request, 'item_reviews.html', {'ratings': page, 'next_reviews_url': next_url})
 
-        # Check if our bucket exists
-        bucket_name = settings.AWS_STORAGE_BUCKET_NAME
-        bucket_exists = bucket_name in buckets
+
+def test_s3_connection(request):
+    """
+    A debug view to test the storage connection and image access.
+    """
+    try:
+        storage = get_storage()
+        health = storage.health()
 
         # Test bucket permissions
-        bucket_permissions = test_bucket_permissions(bucket_name, s3_client)
+        bucket_permissions = test_bucket_permissions(storage)
 
-        # List objects in our bucket (if it exists)
+        # List a few objects
         bucket_objects = []
-        if (bucket_exists):
+        if health['success']:
             try:
-                objects = s3_client.list_objects_v2(Bucket=bucket_name, MaxKeys=10)
-                if 'Contents' in objects:
+                for page in storage.list('items/'):
                     bucket_objects = [
                         {
-                            'key': obj['Key'],
-                            'url': f"https://{bucket_name}.s3.amazonaws.com/{obj['Key']}",
-                            'last_modified': obj['LastModified'].isoformat(),
-                            'size': obj['Size']
+                            'key': key,
+                            'url': storage.url(key),
+                            'last_modified': modified.isoformat(),
                         }
-                        for obj in objects['Contents']
+                        for key, modified in page[:10]
                     ]
+                    break
             except Exception as e:
                 bucket_objects = [f"Error listing objects: {str(e)}"]
 
-        # Check if any actual objects are in our bucket
-        bucket_contents = len(bucket_objects) > 0
-
-        return JsonResponse({
+        response = {
             'success': True,
-            'buckets': buckets,
-            'our_bucket': bucket_name,
-            'bucket_exists': bucket_exists,
+            'backend': type(storage).__name__,
+            'healthy': health['success'],
+            'health_error': health.get('error'),
             'bucket_permissions': bucket_permissions,
             'bucket_objects': bucket_objects,
-            'bucket_has_contents': bucket_contents,
-            'region': settings.AWS_S3_REGION_NAME
-        })
+            'bucket_has_contents': len(bucket_objects) > 0,
+        }
+        if isinstance(storage, S3Storage):
+            response.update({
+                'our_bucket': storage.bucket_name,
+                'region': settings.AWS_S3_REGION_NAME,
+                'presigned_url_cache': get_presigned_url_cache_stats(),
+            })
+        return JsonResponse(response)
 
     except Exception as e:
         return JsonResponse({
@@ -675,18 +902,18 @@ def test_s3_connection(request):
         })
 
 
-def test_bucket_permissions(bucket_name, s3_client=None):
+def test_bucket_permissions(storage=None):
     """
-    Test if we have the necessary permissions on the bucket.
+    Test if we have the necessary permissions on storage.
     """
-    if s3_client is None:
-        s3_client = get_s3_client()
+    if storage is None:
+        storage = get_storage()
 
     results = {}
 
     # Test 1: Can we list objects?
     try:
-        s3_client.list_objects_v2(Bucket=bucket_name, MaxKeys=1)
+        next(iter(storage.list('test/')), None)
         results['list_objects'] = True
     except Exception as e:
         results['list_objects'] = False
@@ -695,23 +922,14 @@ def test_bucket_permissions(bucket_name, s3_client=None):
     # Test 2: Can we put a test object?
     test_key = f"test/permission_test_{uuid.uuid4()}.txt"
     try:
-        # Use put_object instead of upload_fileobj
-        test_content = b"This is a test file to check permissions"
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=test_key,
-            Body=test_content,
-            ContentType='text/plain'
-        )
+        storage.save(test_key, io.BytesIO(b"This is a test file to check permissions"), content_type='text/plain')
         results['put_object'] = True
 
         # If we successfully uploaded, try to delete it
-        try:
-            s3_client.delete_object(Bucket=bucket_name, Key=test_key)
-            results['delete_object'] = True
-        except Exception as e:
-            results['delete_object'] = False
-            results['delete_object_error'] = str(e)
+        errors = storage.delete_many([test_key])
+        results['delete_object'] = not errors
+        if errors:
+            results['delete_object_error'] = errors[test_key]
 
     except Exception as e:
         results['put_object'] = False
@@ -727,6 +945,12 @@ def get_presigned_url(request, item_id):
     try:
         item = get_object_or_404(Item, pk=item_id)
 
+        if not permissions.can_view(request.user, item):
+            return JsonResponse({
+                'success': False,
+                'error': 'Item not found'
+            }, status=404)
+
         if not item.s3_image_key:
             return JsonResponse({
                 'success': False,
@@ -734,7 +958,8 @@ def get_presigned_url(request, item_id):
             })
 
         # Generate a fresh presigned URL valid for 1 hour
-        url = generate_presigned_url(item.s3_image_key, expiration=3600)
+        url = get_storage().signed_url(item.s3_image_key, expiration=3600)
+        srcsets = signed_srcsets(item.image_variants, expiration=3600)
 
         if not url:
             return JsonResponse({
@@ -746,6 +971,65 @@ def get_presigned_url(request, item_id):
             'success': True,
             'url': url,
             'key': item.s3_image_key,
+            'srcsets': srcsets,
+            'expires': '1 hour'
+        })
+
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        })
+
+
+# Enough for a full browse page with room to spare, while keeping one
+# request from signing the whole catalog
+MAX_PRESIGNED_URL_BATCH = 200
+
+
+def get_presigned_urls(request):
+    """
+    Generate fresh presigned URLs for many items' images in one request.
+
+    Takes a comma-separated `ids` query parameter and returns a mapping of
+    item id to URL, plus WebP and JPEG srcsets for items with resized copies
+    (the URL is then a card-sized copy rather than the original). Items
+    without an image (or unknown ids) are left out.
+    """
+    item_ids = []
+    for raw_id in request.GET.get('ids', '').split(','):
+        try:
+            item_ids.append(uuid.UUID(raw_id.strip()))
+        except ValueError:
+            continue
+
+    if len(item_ids) > MAX_PRESIGNED_URL_BATCH:
+        return JsonResponse({
+            'success': False,
+            'error': f'At most {MAX_PRESIGNED_URL_BATCH} items can be requested at once'
+        }, status=400)
+
+    try:
+        # Private items the user can't see are dropped as if they didn't exist
+        keys = (
+            permissions.visible_items(request.user, Item.objects.filter(pk__in=item_ids))
+            .exclude(s3_image_key='').values_list('id', 's3_image_key', 'image_variants')
+        )
+
+        storage = get_storage()
+        urls = {}
+        srcsets = {}
+        for item_id, key, variants in keys:
+            url = storage.signed_url(fallback_key(variants) or key, expiration=3600)
+            if url:
+                urls[str(item_id)] = url
+                if variants:
+                    srcsets[str(item_id)] = signed_srcsets(variants, expiration=3600)
+
+        return JsonResponse({
+            'success': True,
+            'urls': urls,
+            'srcsets': srcsets,
             'expires': '1 hour'
         })
 
@@ -756,17 +1040,104 @@ def get_presigned_url(request, item_id):
         })
 
 
+
+@login_required
+def presign_upload(request):
+    """
+    Issue a presigned POST so the browser can upload an image straight to storage.
+
+    Takes `kind` ('item' for librarians, 'profile' for patrons), `filename`,
+    `content_type` and `size`. Returns the POST url and fields, plus the key
+    signed token the form submits in place of the file once the upload has
+    finished.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'POST required'}, status=405)
+
+    kind = request.POST.get('kind')
+    filename = get_valid_filename(os.path.basename(request.POST.get('filename', ''))) or 'image'
+    content_type = request.POST.get('content_type', '')
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        size = 0
+
+    if kind == 'item' and is_librarian(request.user):
+        key = f"items/{uuid.uuid4()}{os.path.splitext(filename)[1].lower()}"
+    elif kind == 'profile' and is_patron(request.user):
+        key = f"profile_pics/{request.user.id}/{uuid.uuid4()}_{filename}"
+    else:
+        return JsonResponse({'success': False, 'error': 'Not allowed to upload this kind of image'}, status=403)
+
+    if not content_type.startswith('image/'):
+        return JsonResponse({'success': False, 'error': 'File is not an image'}, status=400)
+    if not 0 < size <= MAX_IMAGE_SIZE:
+        return JsonResponse({'success': False, 'error': 'Image file too large (> 10MB)'}, status=400)
+
+    post = get_storage().presigned_post(key, content_type, MAX_IMAGE_SIZE)
+    if post is None:
+        return JsonResponse({'success': False, 'error': 'Failed to generate upload URL'}, status=502)
+    return JsonResponse({'success': True, 'url': post['url'], 'fields': post['fields'], 'key': key,
+                         'token': sign_upload_key(key)})
+
+
+def storage_object(request, key):
+    """
+    Serve a stored file for backends without their own URLs (local
+    filesystem, in-memory). Needs the signature from Storage.url() or an
+    unexpired one from Storage.signed_url().
+    """
+    storage = get_storage()
+    if not storage.verify_url(key, request.GET.get('sig', ''), request.GET.get('expires')):
+        return HttpResponse('Invalid or expired signature', status=403)
+    info = storage.info(key)
+    if info is None:
+        raise Http404("No such file")
+    return FileResponse(storage.open(key), content_type=info['content_type'])
+
+
+@csrf_exempt
+def storage_upload(request):
+    """
+    Accept a browser upload made with Storage.presigned_post() for backends
+    without their own upload endpoint. Like S3, the signed policy is the only
+    authorization, and the file must match its key, content type and size.
+    """
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+    storage = get_storage()
+    policy = storage.read_policy(request.POST.get('policy', ''))
+    upload = request.FILES.get('file')
+    if policy is None or upload is None:
+        return HttpResponse('Invalid or expired upload policy', status=403)
+    if request.POST.get('key') != policy['key'] or request.POST.get('Content-Type') != policy['content_type']:
+        return HttpResponse('Upload does not match its policy', status=403)
+    if not 0 < upload.size <= policy['max_size']:
+        return HttpResponse('File size is outside the allowed range', status=400)
+    try:
+        storage.save(policy['key'], upload, content_type=policy['content_type'])
+    except StorageError as e:
+        return HttpResponse(str(e), status=500)
+    return HttpResponse(status=204)
+
+
 def test_s3_upload(request):
     """
-    A debug view to test S3 uploads directly.
+    A debug view to test storage uploads directly.
     """
     if request.method == 'POST':
         if 'test_file' in request.FILES:
             file_obj = request.FILES['test_file']
 
             # Try to upload the file
-            from clothing_lending.s3_utils import upload_file_to_s3
-            result = upload_file_to_s3(file_obj)
+            storage = get_storage()
+            key = f"items/{uuid.uuid4()}{os.path.splitext(file_obj.name)[1]}"
+            try:
+                storage.save(key, file_obj)
+                result = {'url': storage.url(key), 'key': key}
+            except StorageError as e:
+                print(f"Test upload failed: {e}")
+                result = None
 
             return JsonResponse({
                 'success': result is not None,
@@ -789,62 +1160,32 @@ def test_s3_upload(request):
 
 def test_s3_permissions(request):
     """
-    A debug view to test S3 bucket permissions directly.
+    A debug view to test storage permissions directly.
     """
-    from django.conf import settings
-    import boto3
-    from io import BytesIO
-    import uuid
-
     try:
-        # Get S3 client
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-            region_name=settings.AWS_S3_REGION_NAME
-        )
+        storage = get_storage()
 
-        # Create a test file
-        test_content = b"This is a test file to check S3 permissions"
-        test_file = BytesIO(test_content)
+        # Try to upload a test file
         test_key = f"test/permission_test_{uuid.uuid4()}.txt"
-
-        # Try to upload the file - removed ACL parameter
-        response = s3_client.put_object(
-            Bucket=settings.AWS_STORAGE_BUCKET_NAME,
-            Key=test_key,
-            Body=test_content,
-            ContentType='text/plain'
-        )
+        storage.save(test_key, io.BytesIO(b"This is a test file to check S3 permissions"), content_type='text/plain')
 
         # Generate a presigned URL
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={
-                'Bucket': settings.AWS_STORAGE_BUCKET_NAME,
-                'Key': test_key
-            },
-            ExpiresIn=3600
-        )
+        presigned_url = storage.signed_url(test_key, expiration=3600)
 
         # Standard URL
-        standard_url = f"https://{settings.AWS_STORAGE_BUCKET_NAME}.s3.amazonaws.com/{test_key}"
+        standard_url = storage.url(test_key)
 
         # Try to delete the test file
-        delete_response = s3_client.delete_object(
-            Bucket=settings.AWS_STORAGE_BUCKET_NAME,
-            Key=test_key
-        )
+        delete_errors = storage.delete_many([test_key])
 
         return JsonResponse({
             'success': True,
-            'upload_response': str(response),
-            'delete_response': str(delete_response),
+            'backend': type(storage).__name__,
+            'delete_errors': delete_errors,
             'presigned_url': presigned_url,
             'standard_url': standard_url,
             'test_key': test_key,
-            'bucket': settings.AWS_STORAGE_BUCKET_NAME
+            'bucket': getattr(storage, 'bucket_name', None)
         })
 
     except Exception as e:
@@ -886,10 +1227,7 @@ def promote_user(request):
 def delete_item(request, item_id):
     item = get_object_or_404(Item, pk=item_id)
     if request.method == 'POST':
-        # Delete item picture from S3 if it exists
-        if item.s3_image_key:
-            from clothing_lending.s3_utils import delete_file_from_s3
-            delete_file_from_s3(item.s3_image_key)
+        # Its images are queued for deletion from S3 by a post_delete signal
         item.categories.clear()
         item.delete()
         messages.success(request, 'Item deleted successfully!')
@@ -897,24 +1235,21 @@ def delete_item(request, item_id):
 
 
 def collection_detail(request, collection_id):
-    collection = get_object_or_404(Collection, pk=collection_id)
-    items = collection.items.all()
+    collection = get_object_or_404(
+        Collection.objects.prefetch_related(Prefetch('allowed_patrons', queryset=Patron.objects.select_related('user'))),
+        pk=collection_id,
+    )
+    items = with_card_data(permissions.visible_items(request.user, collection.items.all()))
     
     # Get patron for the current user if authenticated
     patron = None
     if request.user.is_authenticated and request.user.user_type == 2:
         patron, created = Patron.objects.get_or_create(user=request.user)
     
-    if request.user.is_authenticated:
-        can_view = user_can_view_collection(request.user, collection)
-    else:
-        if collection.is_private:
-            can_view = False
-        else:
-            can_view = True
+    can_view = permissions.can_view(request.user, collection)
     
     # Get all librarians for display in private collections
-    librarians = Librarian.objects.all()
+    librarians = Librarian.objects.select_related('user')
 
     # Now let's have some other fun conditions
     can_add = False
@@ -993,41 +1328,55 @@ def delete_collection(request, collection_id):
 @user_passes_test(is_patron)
 def patron_page(request):
     patron, created = Patron.objects.get_or_create(user=request.user)
-    collections = Collection.objects.filter(Q(created_by=request.user) | Q(allowed_patrons=patron))  # Fetch collections created by the patron
-
-    # Get all lending requests for this 
-    pending_requests = Lending.objects.filter(
-        borrower=patron,
-        status='PENDING'
-    ).order_by('-request_date')
-
-    approved_items = Lending.objects.filter(
-        borrower=patron,
-        status='APPROVED'
-    ).order_by('-approved_date')
-
-    #print(approved_items)
-
-    borrowing_history = Lending.objects.filter(
-        borrower=patron,
-        status__in=['RETURNED']
-    ).order_by('-request_date')[:10]  # Show last 10 items
+    # Exists rather than a join on allowed_patrons so each collection appears once
+    allowed = Collection.allowed_patrons.through.objects.filter(collection=OuterRef('pk'), patron=patron)
+    collections = Collection.objects.filter(
+        Q(created_by=request.user) | Exists(allowed)
+    ).annotate(item_count=Count('items'))  # Fetch collections created by or shared with the patron
+
+    lendings = Lending.objects.filter(borrower=patron).select_related('item').prefetch_related(
+        Prefetch('item__categories', queryset=Category.objects.only('id', 'name').order_by('name'))
+    )
+
+    # Open requests and loans are few per patron, so fetch them together and split them here
+    pending_requests = []
+    approved_items = []
+    for lending in lendings.filter(status__in=['PENDING', 'APPROVED']).order_by('-request_date', '-id'):
+        if lending.status == 'PENDING':
+            pending_requests.append(lending)
+        else:
+            approved_items.append(lending)
+    approved_items.sort(key=lambda lending: lending.approved_date or lending.request_date, reverse=True)
 
-    rejected_requests = Lending.objects.filter(
-        borrower=patron,
-        status__in=['REJECTED']
-    ).order_by('-request_date')[:10]  # Show last 10 items
+    # History grows forever, so page through it newest first
+    history = lendings.filter(status__in=['RETURNED', 'REJECTED'])
+    cursor = request.GET.get('history_cursor')
+    try:
+        history_page = keyset_paginate(history, HISTORY_ORDERING, cursor, DASHBOARD_PAGE_SIZE)
+    except InvalidCursor:
+        history_page = keyset_paginate(history, HISTORY_ORDERING, None, DASHBOARD_PAGE_SIZE)
+    borrowing_history = [lending for lending in history_page if lending.status == 'RETURNED']
+    rejected_requests = [lending for lending in history_page if lending.status == 'REJECTED']
+
+    history_next_url = None
+    if history_page.has_next:
+        history_next_url = page_url(request, 'history_cursor', history_page.next_cursor)
+    history_first_url = None
+    if not history_page.is_first:
+        params = request.GET.copy()
+        params.pop('history_cursor', None)
+        history_first_url = f"?{params.urlencode()}"
 
     # Now get invites!
     pending_invites = Invite.objects.filter(
         requester=patron,
         status='PENDING'
-    ).order_by('-request_date')
+    ).select_related('collection').order_by('-request_date')
 
     # and reviews!
     my_ratings = Rating.objects.filter(
         rater=patron
-    ).order_by('-rate_date')[:10]  # Show last 10 items rated
+    ).select_related('item').order_by('-rate_date')[:10]  # Show last 10 items rated
 
     context = {
         'collections': collections,
@@ -1037,6 +1386,8 @@ def patron_page(request):
         'approved_items': approved_items,
         'borrowing_history': borrowing_history,
         'rejected_requests': rejected_requests,
+        'history_next_url': history_next_url,
+        'history_first_url': history_first_url,
         'my_ratings': my_ratings
     }
 
@@ -1045,6 +1396,7 @@ def patron_page(request):
 
 def update_patron_profile(request):
     patron, created = Patron.objects.get_or_create(user=request.user)
+    current_picture = patron.profile_picture
     if request.method == 'POST':
         form = PatronProfileForm(request.POST, request.FILES, instance=patron)
         print(f"Form submitted. Files in request: {request.FILES}")
@@ -1053,39 +1405,31 @@ def update_patron_profile(request):
             print("Form is valid")
 
             # Handle profile picture upload to S3
-            if 'profile_picture' in request.FILES:
+            uploaded_key = form.cleaned_data.get('uploaded_key')
+            if uploaded_key:
+                # The browser uploaded the picture straight to S3
+                old_key = patron.s3_profile_picture_key
+                patron.profile_picture = get_storage().url(uploaded_key)
+                patron.s3_profile_picture_key = uploaded_key
+                patron.save()
+                # Only once nothing points at it, or the flush would keep it
+                if old_key:
+                    schedule_s3_deletion([old_key])
+                messages.success(request, "Profile updated successfully!")
+            elif 'profile_picture' in request.FILES:
                 file_obj = request.FILES['profile_picture']
                 print(f"Profile picture found: {file_obj.name}")
                 print(f"File size: {file_obj.size}")
                 print(f"Content type: {file_obj.content_type}")
 
+                # The picture is uploaded by a background job; the page shows the
+                # old one until it finishes
                 try:
-                    from clothing_lending.s3_utils import upload_file_to_s3
-                    # Add more specific object name
-                    object_name = f"profile_pics/{request.user.id}/{uuid.uuid4()}_{file_obj.name}"
-                    print(f"Attempting to upload to S3 with object_name: {object_name}")
-
-                    s3_upload = upload_file_to_s3(
-                        file_obj,
-                        object_name=object_name
-                    )
-                    print(f"S3 upload result: {s3_upload}")
-
-                    if s3_upload:
-                        # Delete old profile picture from S3 if it exists
-                        if patron.s3_profile_picture_key:
-                            from clothing_lending.s3_utils import delete_file_from_s3
-                            delete_file_from_s3(patron.s3_profile_picture_key)
-
-                        # Update patron with new S3 info
-                        patron.profile_picture = s3_upload['url']
-                        patron.s3_profile_picture_key = s3_upload['key']
-                        patron.save()
-                        print(f"Patron updated with new profile picture: {patron.profile_picture}")
-                        messages.success(request, "Profile updated successfully!")
-                    else:
-                        print("S3 upload failed - returned None")
-                        messages.error(request, "Failed to upload profile picture - S3 upload returned None")
+                    pending_upload = stash_upload(file_obj)
+                    patron.profile_picture = current_picture
+                    patron.save()
+                    enqueue('upload_profile_picture', patron_id=patron.id, **pending_upload)
+                    messages.success(request, "Profile updated successfully! Your new picture will appear shortly.")
                 except Exception as e:
                     print(f"Error during upload: {str(e)}")
                     import traceback
@@ -1101,7 +1445,7 @@ def update_patron_profile(request):
     else:
         form = PatronProfileForm(instance=patron)
 
-    context = {'form': form, 'patron': patron}
+    context = {'form': form, 'patron': patron, 'direct_uploads': settings.S3_DIRECT_UPLOADS}
     return render(request, 'patron/update_profile.html', context)
 
 
@@ -1109,14 +1453,13 @@ def update_patron_profile(request):
 def remove_profile_picture(request):
     patron, created = Patron.objects.get_or_create(user=request.user)
     if patron.s3_profile_picture_key:
-        # Delete the file from S3
-        if delete_file_from_s3(patron.s3_profile_picture_key):
-            patron.profile_picture = None
-            patron.s3_profile_picture_key = None
-            patron.save()
-            messages.success(request, "Profile picture removed successfully.")
-        else:
-            messages.error(request, "Failed to remove profile picture.")
+        # The file itself is deleted from S3 in the background, once nothing points at it
+        old_key = patron.s3_profile_picture_key
+        patron.profile_picture = None
+        patron.s3_profile_picture_key = None
+        patron.save()
+        schedule_s3_deletion([old_key])
+        messages.success(request, "Profile picture removed successfully.")
     else:
         messages.info(request, "No profile picture to remove.")
     return redirect('update_patron_profile')
@@ -1133,38 +1476,18 @@ def request_borrow(request, item_id):
 
             print(f"Found item: {item.name} and patron: {patron}")  # Debug print
 
-            # Check if item is available
-            if not item.available:
-                messages.error(request, 'This item is not available for borrowing.')
-                return redirect(f'/lending/items/{item_id}/')
-
-            # Check if user already has a pending or approved request for this item
-            existing_request = Lending.objects.filter(
-                item=item,
-                borrower=patron,
-                status__in=['PENDING', 'APPROVED']
-            ).exists()
-
-            print(f"Existing request check: {existing_request}")  # Debug print
-
-            if existing_request:
-                messages.warning(request, 'You already have a pending or approved request for this item.')
+            try:
+                lending = borrow_item(item.pk, patron)
+            except ItemUnavailable:
+                # Someone's request got there first, possibly this patron's own
+                if Lending.objects.filter(item=item, borrower=patron, status__in=Lending.ACTIVE_STATUSES).exists():
+                    messages.warning(request, 'You already have a pending or approved request for this item.')
+                else:
+                    messages.error(request, 'This item is not available for borrowing.')
                 return redirect(f'/lending/items/{item_id}/')
 
-            # Create new lending request
-            lending = Lending.objects.create(
-                item=item,
-                borrower=patron,
-                status='PENDING',
-                request_date=timezone.now()
-            )
-
             print(f"Created new lending request: {lending.id}")  # Debug print
 
-            # Update item availability
-            item.available = False
-            item.save()
-
             messages.success(request, 'Your borrow request has been submitted and is pending approval.')
             return redirect(f'/lending/items/{item_id}/')
 
@@ -1240,46 +1563,49 @@ def request_return(request, lending_id):
     patron = get_object_or_404(Patron, user=request.user)
 
     # check if user borrowed item and lending is approved
-    if lending.borrower == patron and lending.status == "APPROVED":
-        lending.return_requested = True
-        lending.save()
+    if lending.borrower == patron:
+        try:
+            transition(lending, 'request_return', actor=request.user)
+        except InvalidTransition:
+            messages.error(request, "This item can't be returned right now.")
+            return redirect('/lending/patron/page/')
         messages.success(request, "Return requested successfully.")
         return redirect('/lending/patron/page/')
     else:
         messages.error(request, "You don't have permission to return this item.")
         return redirect('/lending/patron/page/')
 
+# Success messages for manage_lending_request, by action
+LENDING_ACTION_MESSAGES = {
+    'approve': 'Lending request for {name} has been approved.',
+    'reject': 'Lending request for {name} has been rejected.',
+    'return': '{name} has been marked as returned.',
+}
+
 @user_passes_test(is_librarian)
 def manage_lending_request(request, lending_id):
-    lending = get_object_or_404(Lending, pk=lending_id)
+    lending = get_object_or_404(Lending.objects.select_related('item'), pk=lending_id)
     librarian = get_object_or_404(Librarian, user=request.user)
 
     # Check if the current librarian is the creator of the item
-    if lending.item.created_by != librarian:
+    if lending.item.created_by_id != librarian.pk:
         messages.error(request, "You don't have permission to manage this lending request. Only the librarian who created the item can approve or reject requests for it.")
         return redirect('/lending/librarian/page/')
 
     action = request.POST.get('action')
+    if action not in LENDING_ACTION_MESSAGES:
+        messages.error(request, 'Unknown action.')
+        return redirect('/lending/librarian/page/')
 
-    if action == 'approve':
-        lending.status = 'APPROVED'
-        lending.approved_date = timezone.now()
-        lending.due_date = timezone.now() + timedelta(days=14)
-        messages.success(request, f'Lending request for {lending.item.name} has been approved.')
-    elif action == 'reject':
-        lending.status = 'REJECTED'
-        lending.rejected_date = timezone.now()
-        lending.item.available = True
-        lending.item.save()
-        messages.success(request, f'Lending request for {lending.item.name} has been rejected.')
-    elif action == 'return':
-        lending.status = 'RETURNED'
-        lending.return_date = timezone.now()
-        lending.item.available = True
-        lending.item.save()
-        messages.success(request, f'{lending.item.name} has been marked as returned.')
-
-    lending.save()
+    try:
+        transition(lending, action, actor=request.user)
+    except InvalidTransition:
+        # Already handled, e.g. in another tab
+        lending.refresh_from_db(fields=['status'])
+        messages.error(request, f'This lending is {lending.get_status_display().lower()} and can no longer be changed that way.')
+        return redirect('/lending/librarian/page/')
+
+    messages.success(request, LENDING_ACTION_MESSAGES[action].format(name=lending.item.name))
     return redirect('/lending/librarian/page/')
 
 # Now to approve patron invites to private collection
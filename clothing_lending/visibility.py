@@ -0,0 +1,105 @@
+"""
+Maintenance of the PatronItemAccess visibility table and the Q objects that
+read it.
+
+A patron can see an item when it isn't in a private collection, or when they
+are an allowed patron of every private collection containing it. The second half
+is materialized as PatronItemAccess rows; the collection-level equivalent is
+the Collection.allowed_patrons through table, which already has a unique
+(collection, patron) index.
+"""
+
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery
+
+from .models import Collection, Item, PatronItemAccess
+
+CollectionItem = Item.collections.through
+CollectionPatron = Collection.allowed_patrons.through
+
+
+def item_visible_to_patron(patron):
+    """
+    Q matching items the patron is allowed to see.
+    """
+    granted = PatronItemAccess.objects.filter(patron=patron, item=OuterRef('pk'))
+    return Q(private_collection=False) | Q(Exists(granted))
+
+
+def collection_allowed_for_patron(patron):
+    """
+    Q matching collections the patron has been let into.
+    """
+    return Q(Exists(CollectionPatron.objects.filter(patron=patron, collection=OuterRef('pk'))))
+
+
+def collection_visible_to_patron(patron):
+    """
+    Q matching collections the patron is allowed to see.
+    """
+    return Q(is_private=False) | collection_allowed_for_patron(patron)
+
+
+def refresh_item_access(item_ids=None, patron_ids=None):
+    """
+    Recompute the PatronItemAccess rows for the given items and patrons.
+
+    Either argument may be a list, a values() queryset (used as a subquery) or
+    None for "all". Rows in that scope are deleted and the correct set is
+    re-inserted from the private collections' memberships: a patron gets a
+    row for an item when they are allowed into all of its private collections.
+    """
+    stale = PatronItemAccess.objects.all()
+    memberships = CollectionItem.objects.filter(collection__is_private=True)
+    if item_ids is not None:
+        stale = stale.filter(item_id__in=item_ids)
+        memberships = memberships.filter(item_id__in=item_ids)
+    if patron_ids is not None:
+        stale = stale.filter(patron_id__in=patron_ids)
+        memberships = memberships.filter(collection__allowed_patrons__in=patron_ids)
+    else:
+        memberships = memberships.filter(collection__allowed_patrons__isnull=False)
+
+    private_count = CollectionItem.objects.filter(item_id=OuterRef('item_id'), collection__is_private=True).values(
+        'item_id').annotate(total=Count('pk')).values('total')
+    pairs = memberships.values('item_id', patron_id=F('collection__allowed_patrons')).annotate(
+        allowed=Count('collection_id', distinct=True)).filter(allowed=Subquery(private_count)).values_list(
+        'item_id', 'patron_id')
+
+    stale.delete()
+    PatronItemAccess.objects.bulk_create(
+        (PatronItemAccess(item_id=item_id, patron_id=patron_id) for item_id, patron_id in pairs.iterator()),
+        batch_size=1000,
+        ignore_conflicts=True,
+    )
+
+
+def items_in_collections(collection_ids):
+    return CollectionItem.objects.filter(collection_id__in=collection_ids).values('item_id')
+
+
+def _in_private_collection():
+    return Exists(CollectionItem.objects.filter(item_id=OuterRef('pk'), collection__is_private=True))
+
+
+def recompute_item_privacy(item_ids=None):
+    """
+    Set Item.private_collection for the given items (or all items) with one
+    UPDATE. Returns the number of rows updated.
+    """
+    items = Item.objects.all()
+    if item_ids is not None:
+        items = items.filter(pk__in=item_ids)
+    return items.update(private_collection=_in_private_collection())
+
+
+def reconcile_item_privacy(dry_run=False):
+    """
+    Repair items whose private_collection flag disagrees with their collections.
+
+    :return: (number of items wrongly public, number of items wrongly private)
+    """
+    wrongly_public = Item.objects.filter(private_collection=False).filter(_in_private_collection())
+    wrongly_private = Item.objects.filter(private_collection=True).exclude(_in_private_collection())
+    if dry_run:
+        return wrongly_public.count(), wrongly_private.count()
+    return wrongly_public.update(private_collection=True), wrongly_private.update(private_collection=False)
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
 
 application = get_wsgi_application()
+
+# Picks up background jobs a previous web process left queued (see clothing_lending/jobs.py)
+from clothing_lending.jobs import start_job_sweeper  # noqa: E402
+start_job_sweeper()